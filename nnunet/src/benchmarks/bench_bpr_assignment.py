@@ -0,0 +1,224 @@
+"""
+    ----------------------------------------
+    IDC-MedImA-misc - BPR slice assignment benchmark
+    ----------------------------------------
+
+    Compare the precomputed BPR region/landmark assignment (`bpr.load_bpr_output`) with the
+    per-slice lookups used by the notebooks to build the structured reports, on synthetic
+    BPR outputs, in terms of time and output equivalence. Run from the `nnunet` folder:
+
+      python -m src.benchmarks.bench_bpr_assignment --num_slices 1000
+
+    ----------------------------------------
+    Author: Dennis Bontempi
+    Email:  dennis_bontempi@dfci.harvard.edu
+    ----------------------------------------
+
+"""
+
+import os
+import json
+import time
+import shutil
+import argparse
+import tempfile
+
+import numpy as np
+
+import src.utils.bpr as bpr
+
+REGION_BOUNDARY_DICT = {"legs" : ("pelvis_start", "femur_end"),
+                        "pelvis" : ("pelvis_start", "pelvis_end"),
+                        "abdomen" : ("pelvis_end", "L1"),
+                        "chest" : ("L1", "lung_end"),
+                        "shoulder-neck" : ("lung_end", "teeth"),
+                        "head" : ("teeth", "head_end")}
+
+
+def write_synthetic_bpr_output(path_to_json_file, num_slices = 1000, num_landmarks = 20,
+                               reverse = False, seed = 0):
+
+  """
+  Synthetic BodyPartRegression output: monotonic cleaned slice scores spanning the whole
+  body, a look-up table of `num_landmarks` landmarks and the slice indices of six regions.
+  """
+
+  rng = np.random.default_rng(seed)
+
+  slice_scores = np.linspace(-5, 105, num_slices) + rng.normal(0, 0.05, num_slices)
+  slice_scores = np.maximum.accumulate(slice_scores)
+
+  if reverse:
+    slice_scores = slice_scores[::-1]
+
+  named_landmark_list = sorted(set(sum(REGION_BOUNDARY_DICT.values(), tuple())))
+  landmark_list = named_landmark_list + ["landmark_%02d"%idx
+                                         for idx in range(num_landmarks - len(named_landmark_list))]
+
+  landmark_means = rng.permutation(np.linspace(0, 100, len(landmark_list)))
+  lookup_table = {landmark : {"mean" : float(mean), "std" : 1.0}
+                  for landmark, mean in zip(landmark_list, landmark_means)}
+
+  body_part_examined = dict()
+  for region, (tag_start, tag_end) in REGION_BOUNDARY_DICT.items():
+    low, high = sorted([lookup_table[tag_start]["mean"], lookup_table[tag_end]["mean"]])
+    body_part_examined[region] = np.nonzero((slice_scores >= low) & (slice_scores <= high))[0].tolist()
+
+  json_data = {"cleaned slice scores" : slice_scores.tolist(),
+               "valid z-spacing" : -2.5 if reverse else 2.5,
+               "look-up table" : lookup_table,
+               "body part examined" : body_part_examined}
+
+  with open(path_to_json_file, "w") as fp:
+    json.dump(json_data, fp)
+
+# ----------------------------------
+# ----------------------------------
+
+def legacy_crop_scores(scores, start_score, end_score):
+
+  """
+  Reference implementation of `bpreg`'s `crop_scores`.
+  """
+
+  scores = np.array(scores)
+  min_scores = np.where(scores < start_score)[0]
+  max_scores = np.where(scores > end_score)[0]
+
+  min_index = 0
+  max_index = len(scores)
+
+  if len(min_scores) > 0:
+    min_index = np.nanmax(min_scores)
+
+  if len(max_scores) > 0:
+    max_index = np.nanmin(max_scores)
+
+  return min_index, max_index
+
+# ----------------------------------
+# ----------------------------------
+
+def legacy_assignment(json_file):
+
+  """
+  Per-slice region and landmark lists, computed as in the notebooks' SR functions.
+  """
+
+  # regions - `convert_slice_to_region` for every slice
+  with open(json_file) as fp:
+    json_data = json.load(fp)
+
+  bpr_data = json_data["body part examined"]
+  num_slices = len(json_data["cleaned slice scores"])
+
+  regions = list()
+  for slice_index in range(num_slices):
+    regions.append([region for region, vals in bpr_data.items() if slice_index in vals])
+
+  # landmarks - `get_landmark_indices_from_json`, then `get_landmark_indices_list_in_slice`
+  with open(json_file) as fp:
+    x = json.load(fp)
+
+  landmark_dict_sorted = dict(sorted({landmark : x["look-up table"][landmark]["mean"]
+                                      for landmark in x["look-up table"]}.items(),
+                                     key = lambda item: item[1]))
+
+  landmark_indices = dict()
+  for landmark, score in landmark_dict_sorted.items():
+    min_index, _ = legacy_crop_scores(x["cleaned slice scores"], score, score)
+    landmark_indices[landmark] = min_index if x["valid z-spacing"] > 0 else num_slices - min_index
+
+  landmark_indices = {landmark : index for landmark, index in landmark_indices.items()
+                      if index != 0 and index != num_slices - 1}
+
+  landmarks = list()
+  for slice_index in range(num_slices):
+    landmarks.append([landmark for landmark, index in landmark_indices.items() if index == slice_index])
+
+  # region boundaries - `get_indices_from_json`, re-parsing the JSON file for every region
+  region_indices = dict()
+  for region, (tag_start, tag_end) in REGION_BOUNDARY_DICT.items():
+    with open(json_file) as fp:
+      x = json.load(fp)
+    region_indices[region] = legacy_crop_scores(x["cleaned slice scores"],
+                                                x["look-up table"][tag_start]["mean"],
+                                                x["look-up table"][tag_end]["mean"])
+
+  return regions, landmarks, region_indices
+
+# ----------------------------------
+# ----------------------------------
+
+def precomputed_assignment(json_file):
+
+  """
+  Per-slice region and landmark lists, computed from the precomputed BPR output.
+  """
+
+  bpr_output = bpr.load_bpr_output(json_file)
+
+  regions, landmarks = list(), list()
+  for _, region_list, landmark_list in bpr.iter_slice_annotations(bpr_output):
+    regions.append(region_list)
+    landmarks.append(landmark_list)
+
+  region_indices = {region : bpr.get_indices(bpr_output, tag_start, tag_end)
+                    for region, (tag_start, tag_end) in REGION_BOUNDARY_DICT.items()}
+
+  return regions, landmarks, region_indices
+
+# ----------------------------------
+# ----------------------------------
+
+def main():
+
+  parser = argparse.ArgumentParser(description = "BPR slice assignment benchmark.")
+  parser.add_argument("--num_slices", type = int, default = 1000)
+  parser.add_argument("--num_landmarks", type = int, default = 20)
+  parser.add_argument("--num_series", type = int, default = 10)
+  args = parser.parse_args()
+
+  base_path = tempfile.mkdtemp(prefix = "bench_bpr_")
+
+  try:
+    json_file_list = list()
+
+    for idx in range(args.num_series):
+      json_file = os.path.join(base_path, "bpr_%03d.json"%idx)
+      write_synthetic_bpr_output(json_file, num_slices = args.num_slices,
+                                 num_landmarks = args.num_landmarks, reverse = idx%2 == 1, seed = idx)
+      json_file_list.append(json_file)
+
+    print("Synthetic BPR outputs: %g series, %g slices each."%(args.num_series, args.num_slices))
+
+    start_time = time.time()
+    legacy_output_list = [legacy_assignment(json_file) for json_file in json_file_list]
+    elapsed_legacy = time.time() - start_time
+    print("Per-slice lookups: %g seconds."%elapsed_legacy)
+
+    start_time = time.time()
+    precomputed_output_list = [precomputed_assignment(json_file) for json_file in json_file_list]
+    elapsed_precomputed = time.time() - start_time
+    print("Precomputed masks: %g seconds."%elapsed_precomputed)
+    print("Speed-up: %.2fx"%(elapsed_legacy/elapsed_precomputed))
+
+    for legacy_output, precomputed_output in zip(legacy_output_list, precomputed_output_list):
+      legacy_regions, legacy_landmarks, legacy_region_indices = legacy_output
+      regions, landmarks, region_indices = precomputed_output
+
+      assert(legacy_regions == regions)
+      assert(legacy_landmarks == landmarks)
+      assert({region : tuple(int(idx) for idx in indices)
+              for region, indices in legacy_region_indices.items()} == region_indices)
+
+    print("Outputs are equivalent.")
+
+  finally:
+    shutil.rmtree(base_path)
+
+# ----------------------------------
+# ----------------------------------
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,91 @@
+"""
+    ----------------------------------------
+    IDC-MedImA-misc - CT volume builder benchmark
+    ----------------------------------------
+
+    Compare `preprocessing.dicom_ct_to_volumes` (one decode, NRRD + NIfTI written from
+    the same buffer) with `pypla_dicom_ct_to_nrrd` + `pypla_dicom_ct_to_nifti` on a
+    synthetic DICOM CT series. Run from the `nnunet` folder:
+
+      python -m src.benchmarks.bench_ct_volume --num_slices 500
+
+    ----------------------------------------
+    Author: Dennis Bontempi
+    Email:  dennis_bontempi@dfci.harvard.edu
+    ----------------------------------------
+
+"""
+
+import os
+import time
+import shutil
+import argparse
+import tempfile
+
+import numpy as np
+import SimpleITK as sitk
+
+import src.utils.preprocessing as preprocessing
+
+from src.benchmarks.synthetic import write_synthetic_ct_series
+
+
+def main():
+
+  parser = argparse.ArgumentParser(description = "DICOM CT to NRRD/NIfTI conversion benchmark.")
+  parser.add_argument("--num_slices", type = int, default = 500)
+  parser.add_argument("--num_workers", type = int, default = 8)
+  parser.add_argument("--skip_pypla", action = "store_true",
+                      help = "skip the plastimatch baseline (e.g., if it is not installed).")
+  args = parser.parse_args()
+
+  base_path = tempfile.mkdtemp(prefix = "bench_ct_volume_")
+  pat_id = "SYNTH-001"
+
+  try:
+    sorted_base_path = os.path.join(base_path, "sorted")
+
+    print("Writing a synthetic %g-slice CT series..."%(args.num_slices))
+    volume = write_synthetic_ct_series(os.path.join(sorted_base_path, pat_id, "CT"),
+                                       num_slices = args.num_slices, pat_id = pat_id)
+
+    # native path
+    native_nrrd_path = os.path.join(base_path, "native", "nrrd")
+    native_nifti_path = os.path.join(base_path, "native", "nii")
+    os.makedirs(native_nrrd_path)
+    os.makedirs(native_nifti_path)
+
+    start_time = time.time()
+    output_path_list = preprocessing.dicom_ct_to_volumes(sorted_base_path = sorted_base_path,
+                                                         pat_id = pat_id,
+                                                         processed_nrrd_path = native_nrrd_path,
+                                                         processed_nifti_path = native_nifti_path,
+                                                         num_workers = args.num_workers)
+    elapsed_native = time.time() - start_time
+    print("Native (NRRD + NIfTI): %g seconds."%elapsed_native)
+
+    for output_path in output_path_list:
+      assert(np.array_equal(sitk.GetArrayFromImage(sitk.ReadImage(output_path)), volume))
+
+    # plastimatch path
+    if not args.skip_pypla:
+      pypla_nrrd_path = os.path.join(base_path, "pypla", "nrrd")
+      pypla_nifti_path = os.path.join(base_path, "pypla", "nii")
+      os.makedirs(pypla_nrrd_path)
+      os.makedirs(pypla_nifti_path)
+
+      start_time = time.time()
+      preprocessing.pypla_dicom_ct_to_nrrd(sorted_base_path, pypla_nrrd_path, pat_id, verbose = False)
+      preprocessing.pypla_dicom_ct_to_nifti(sorted_base_path, pypla_nifti_path, pat_id, verbose = False)
+      elapsed_pypla = time.time() - start_time
+      print("pyplastimatch (NRRD + NIfTI): %g seconds."%elapsed_pypla)
+      print("Speed-up: %.2fx"%(elapsed_pypla/elapsed_native))
+
+  finally:
+    shutil.rmtree(base_path)
+
+# ----------------------------------
+# ----------------------------------
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,134 @@
+"""
+    ----------------------------------------
+    IDC-MedImA-misc - DICOM SEG encoder benchmark
+    ----------------------------------------
+
+    Compare `dicomseg.label_to_dicomseg` (in-memory label map, no subprocess) with
+    `postprocessing.nrrd_to_dicomseg` (NRRD written to disk, then dcmqi's `itkimage2segimage`)
+    on synthetic data, in terms of time and output equivalence. Run from the `nnunet` folder:
+
+      python -m src.benchmarks.bench_dicomseg --num_slices 200
+
+    ----------------------------------------
+    Author: Dennis Bontempi
+    Email:  dennis_bontempi@dfci.harvard.edu
+    ----------------------------------------
+
+"""
+
+import os
+import time
+import shutil
+import argparse
+import tempfile
+
+import numpy as np
+import pydicom
+import SimpleITK as sitk
+
+import src.utils.dicomseg as dicomseg
+import src.utils.preprocessing as preprocessing
+import src.utils.postprocessing as postprocessing
+
+from src.benchmarks.synthetic import write_synthetic_ct_series, synthetic_label_map
+
+DICOMSEG_JSON_PATH = os.path.join(os.path.dirname(__file__), "..", "..", "data", "dicomseg_metadata.json")
+
+
+def frames_by_reference(path_to_dicomseg_file):
+
+  """
+  Map every frame of a DICOM SEG object to (segment label, referenced SOPInstanceUID).
+  """
+
+  dcm_seg = pydicom.dcmread(path_to_dicomseg_file)
+  frame_array = dcm_seg.pixel_array.reshape(-1, dcm_seg.Rows, dcm_seg.Columns)
+
+  segment_label_dict = {segment.SegmentNumber : segment.SegmentLabel for segment in dcm_seg.SegmentSequence}
+
+  frame_dict = dict()
+
+  for frame, frame_item in zip(frame_array, dcm_seg.PerFrameFunctionalGroupsSequence):
+    segment_number = frame_item.SegmentIdentificationSequence[0].ReferencedSegmentNumber
+    sop_instance_uid = frame_item.DerivationImageSequence[0].SourceImageSequence[0].ReferencedSOPInstanceUID
+
+    frame_dict[(segment_label_dict[segment_number], sop_instance_uid)] = frame.astype(bool)
+
+  return frame_dict
+
+# ----------------------------------
+# ----------------------------------
+
+def main():
+
+  parser = argparse.ArgumentParser(description = "DICOM SEG encoding benchmark.")
+  parser.add_argument("--num_slices", type = int, default = 200)
+  args = parser.parse_args()
+
+  base_path = tempfile.mkdtemp(prefix = "bench_dicomseg_")
+  pat_id = "SYNTH-001"
+
+  try:
+    sorted_base_path = os.path.join(base_path, "sorted")
+    processed_base_path = os.path.join(base_path, "processed")
+    path_to_ct_dir = os.path.join(sorted_base_path, pat_id, "CT")
+
+    print("Writing a synthetic %g-slice CT series..."%(args.num_slices))
+    write_synthetic_ct_series(path_to_ct_dir, num_slices = args.num_slices, pat_id = pat_id)
+
+    sitk_ct = preprocessing.read_dicom_ct_volume(path_to_ct_dir)
+    label_array = synthetic_label_map(sitk.GetArrayViewFromImage(sitk_ct).shape)
+
+    # native encoder (the CT headers are parsed once, like the pipeline would)
+    ct_geometry = dicomseg.read_ct_geometry(path_to_ct_dir)
+
+    native_seg_path = os.path.join(base_path, "native_SEG.dcm")
+
+    start_time = time.time()
+    dicomseg.label_to_dicomseg(label_array = label_array,
+                               path_to_ct_dir = path_to_ct_dir,
+                               dicomseg_json_path = DICOMSEG_JSON_PATH,
+                               dicom_seg_out_path = native_seg_path,
+                               ct_geometry = ct_geometry)
+    elapsed_native = time.time() - start_time
+    print("Native encoder: %g seconds."%elapsed_native)
+
+    if shutil.which("itkimage2segimage") is None:
+      print("`itkimage2segimage` not found - skipping the dcmqi baseline.")
+      return
+
+    # dcmqi path (label map written to NRRD first, as in the pipeline)
+    os.makedirs(os.path.join(processed_base_path, "nrrd", pat_id))
+    os.makedirs(os.path.join(processed_base_path, "dicomseg"))
+
+    start_time = time.time()
+    sitk_label = sitk.GetImageFromArray(label_array)
+    sitk_label.CopyInformation(sitk_ct)
+    sitk.WriteImage(sitk_label, os.path.join(processed_base_path, "nrrd", pat_id,
+                                             pat_id + "_pred_segthor.nrrd"), useCompression = True)
+    postprocessing.nrrd_to_dicomseg(sorted_base_path = sorted_base_path,
+                                    processed_base_path = processed_base_path,
+                                    dicomseg_json_path = DICOMSEG_JSON_PATH,
+                                    pat_id = pat_id)
+    elapsed_dcmqi = time.time() - start_time
+    print("NRRD + dcmqi: %g seconds."%elapsed_dcmqi)
+    print("Speed-up: %.2fx"%(elapsed_dcmqi/elapsed_native))
+
+    # output equivalence - same frames, referencing the same CT slices, with the same content
+    native_frame_dict = frames_by_reference(native_seg_path)
+    dcmqi_frame_dict = frames_by_reference(os.path.join(processed_base_path, "dicomseg",
+                                                        pat_id, pat_id + "_SEG.dcm"))
+
+    assert(set(native_frame_dict.keys()) == set(dcmqi_frame_dict.keys()))
+    assert(all(np.array_equal(native_frame_dict[key], dcmqi_frame_dict[key]) for key in native_frame_dict))
+
+    print("Outputs are equivalent (%g frames)."%(len(native_frame_dict)))
+
+  finally:
+    shutil.rmtree(base_path)
+
+# ----------------------------------
+# ----------------------------------
+
+if __name__ == "__main__":
+  main()
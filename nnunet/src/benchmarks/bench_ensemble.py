@@ -0,0 +1,127 @@
+"""
+    ----------------------------------------
+    IDC-MedImA-misc - softmax ensembling benchmark
+    ----------------------------------------
+
+    Compare the slab-by-slab `ensemble.ensemble_softmax` with the straightforward ensembling
+    (every `.npz` loaded at once, averaged in memory) in terms of time and peak (NumPy) memory,
+    on synthetic SegTHOR-like softmax maps from several models. Run from the `nnunet` folder:
+
+      python -m src.benchmarks.bench_ensemble --shape 120 256 256 --num_models 3
+
+    ----------------------------------------
+    Author: Dennis Bontempi
+    Email:  dennis_bontempi@dfci.harvard.edu
+    ----------------------------------------
+
+"""
+
+import os
+import time
+import shutil
+import argparse
+import tempfile
+import tracemalloc
+
+import numpy as np
+import SimpleITK as sitk
+
+import src.utils.ensemble as ensemble
+
+NUM_CHANNELS = 5
+
+
+def write_synthetic_softmax(npz_path, shape, seed = 0):
+
+  """
+  Write a synthetic softmax `.npz` (float16, compressed - like `nnUNet_predict --save_npz`).
+  """
+
+  rng = np.random.default_rng(seed)
+
+  softmax = np.exp(rng.standard_normal((NUM_CHANNELS,) + tuple(shape), dtype = np.float32))
+  softmax /= softmax.sum(axis = 0, keepdims = True)
+
+  np.savez_compressed(npz_path, softmax = softmax.astype(np.float16))
+
+# ----------------------------------
+# ----------------------------------
+
+def in_memory_ensemble(npz_path_list, output_label_path, reference_image_path):
+
+  """
+  Baseline: load all the softmax maps, average them and take the argmax.
+  """
+
+  softmax_list = [np.load(npz_path)["softmax"].astype(np.float32) for npz_path in npz_path_list]
+  label_array = np.mean(softmax_list, axis = 0).argmax(axis = 0).astype(np.uint8)
+
+  sitk_label = sitk.GetImageFromArray(label_array)
+  sitk_label.CopyInformation(sitk.ReadImage(reference_image_path))
+  sitk.WriteImage(sitk_label, output_label_path, useCompression = True)
+
+# ----------------------------------
+# ----------------------------------
+
+def run_and_measure(func, **kwargs):
+
+  tracemalloc.start()
+  start_time = time.time()
+
+  func(**kwargs)
+
+  elapsed = time.time() - start_time
+  _, peak = tracemalloc.get_traced_memory()
+  tracemalloc.stop()
+
+  return elapsed, peak
+
+# ----------------------------------
+# ----------------------------------
+
+def main():
+
+  parser = argparse.ArgumentParser(description = "Softmax ensembling benchmark.")
+  parser.add_argument("--shape", type = int, nargs = 3, default = [120, 256, 256])
+  parser.add_argument("--num_models", type = int, default = 3)
+  parser.add_argument("--slab_size", type = int, default = 16)
+  args = parser.parse_args()
+
+  base_path = tempfile.mkdtemp(prefix = "bench_ensemble_")
+
+  try:
+    print("Writing %g synthetic %s softmax maps..."%(args.num_models, str(args.shape)))
+
+    npz_path_list = [os.path.join(base_path, "model_%d.npz"%(idx)) for idx in range(args.num_models)]
+
+    for idx, npz_path in enumerate(npz_path_list):
+      write_synthetic_softmax(npz_path, args.shape, seed = idx)
+
+    reference_image_path = os.path.join(base_path, "reference.nii.gz")
+    sitk.WriteImage(sitk.GetImageFromArray(np.zeros(args.shape, dtype = np.uint8)), reference_image_path)
+
+    elapsed, peak = run_and_measure(in_memory_ensemble, npz_path_list = npz_path_list,
+                                    output_label_path = os.path.join(base_path, "in_memory.nii.gz"),
+                                    reference_image_path = reference_image_path)
+    print("In memory:      %8.2f seconds, peak memory %8.1f MB"%(elapsed, peak/2**20))
+
+    elapsed, peak = run_and_measure(ensemble.ensemble_softmax, npz_path_list = npz_path_list,
+                                    output_label_path = os.path.join(base_path, "slab.nii.gz"),
+                                    reference_image_path = reference_image_path,
+                                    slab_size = args.slab_size)
+    print("Slab by slab:   %8.2f seconds, peak memory %8.1f MB"%(elapsed, peak/2**20))
+
+    in_memory = sitk.GetArrayFromImage(sitk.ReadImage(os.path.join(base_path, "in_memory.nii.gz")))
+    slab = sitk.GetArrayFromImage(sitk.ReadImage(os.path.join(base_path, "slab.nii.gz")))
+
+    # the sum and the mean can round differently on (near) ties
+    print("Voxels differing from the in-memory ensemble: %g."%np.count_nonzero(in_memory != slab))
+
+  finally:
+    shutil.rmtree(base_path)
+
+# ----------------------------------
+# ----------------------------------
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,160 @@
+"""
+    ----------------------------------------
+    IDC-MedImA-misc - shape features benchmark
+    ----------------------------------------
+
+    Compare `shape_features.compute_shape_features_from_file` (single integer label map, no
+    intermediate files) with the notebooks' `split_nii` + per-structure pyradiomics extraction
+    on a synthetic SegTHOR-like label map, in terms of time, peak memory and (if pyradiomics
+    is installed) output equivalence. Run from the `nnunet` folder:
+
+      python -m src.benchmarks.bench_shape_features --num_slices 300
+
+    ----------------------------------------
+    Author: Dennis Bontempi
+    Email:  dennis_bontempi@dfci.harvard.edu
+    ----------------------------------------
+
+"""
+
+import os
+import time
+import shutil
+import argparse
+import tempfile
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+import nibabel as nib
+
+import src.utils.shape_features as shape_features
+
+from src.benchmarks.synthetic import synthetic_label_map
+
+LABEL_DICT = {1 : "Esophagus", 2 : "Heart", 3 : "Trachea", 4 : "Aorta"}
+
+
+def legacy_split_nii(input_file, output_directory, label_names):
+
+  """
+  The notebooks' `split_nii`: one full-size float64 NIfTI per structure.
+  """
+
+  if not os.path.isdir(output_directory):
+    os.mkdir(output_directory)
+
+  nii = nib.load(input_file)
+  img = nii.get_fdata()
+  unique_labels = list(np.unique(img))
+  unique_labels.remove(0)
+
+  for n in range(0, len(unique_labels)):
+    ind = np.where(img == unique_labels[n])
+    vol = np.zeros((img.shape))
+    vol[ind] = 1
+    new_img = nib.Nifti1Image(vol, nii.affine, nii.header)
+    nib.save(new_img, os.path.join(output_directory, label_names[n] + ".nii.gz"))
+
+# ----------------------------------
+# ----------------------------------
+
+def legacy_shape_features(ct_nifti_path, split_pred_nifti_path, label_names):
+
+  """
+  The notebooks' `compute_pyradiomics_3D_features` (None if pyradiomics is not installed).
+  """
+
+  try:
+    from radiomics import featureextractor
+  except ImportError:
+    return None
+
+  extractor = featureextractor.RadiomicsFeatureExtractor()
+  extractor.settings["minimumROIDimensions"] = 3
+  extractor.disableAllFeatures()
+  extractor.enableFeaturesByName(shape = shape_features.SHAPE_FEATURE_LIST)
+
+  row_list = list()
+
+  for label_value, label_name in enumerate(label_names, start = 1):
+    result = extractor.execute(ct_nifti_path, os.path.join(split_pred_nifti_path, label_name + ".nii.gz"))
+
+    row = {"ReferencedSegment" : label_value, "label_name" : label_name}
+    row.update({key.replace("original_shape_", "") : float(val)
+                for key, val in result.items() if "original_shape" in key})
+    row_list.append(row)
+
+  return pd.DataFrame(row_list)
+
+# ----------------------------------
+# ----------------------------------
+
+def main():
+
+  parser = argparse.ArgumentParser(description = "Shape features benchmark.")
+  parser.add_argument("--num_slices", type = int, default = 300)
+  parser.add_argument("--num_workers", type = int, default = 4)
+  args = parser.parse_args()
+
+  base_path = tempfile.mkdtemp(prefix = "bench_shape_")
+
+  try:
+    shape = (args.num_slices, 512, 512)
+    affine = np.diag([0.7, 0.7, 2.5, 1.0])
+
+    # NIfTI arrays are stored (x, y, z)
+    label_array = synthetic_label_map(shape)
+    label_path = os.path.join(base_path, "pred.nii.gz")
+    nib.save(nib.Nifti1Image(label_array.transpose(2, 1, 0), affine), label_path)
+
+    ct_path = os.path.join(base_path, "ct.nii.gz")
+    nib.save(nib.Nifti1Image(np.zeros(shape[::-1], dtype = np.int16), affine), ct_path)
+
+    print("Synthetic label map: %s voxels, %g structures."%("x".join(str(s) for s in shape), len(LABEL_DICT)))
+
+    # legacy - split + (if available) pyradiomics
+    tracemalloc.start()
+    start_time = time.time()
+
+    split_pred_nifti_path = os.path.join(base_path, "split")
+    legacy_split_nii(label_path, split_pred_nifti_path, list(LABEL_DICT.values()))
+    legacy_df = legacy_shape_features(ct_path, split_pred_nifti_path, list(LABEL_DICT.values()))
+
+    elapsed_legacy = time.time() - start_time
+    peak_legacy = tracemalloc.get_traced_memory()[1]/2**20
+    tracemalloc.stop()
+
+    print("split_nii%s: %g seconds, peak memory %.1f MB."%(" + pyradiomics" if legacy_df is not None
+                                                           else " (pyradiomics not installed)",
+                                                           elapsed_legacy, peak_legacy))
+
+    # single pass
+    tracemalloc.start()
+    start_time = time.time()
+
+    features_df = shape_features.compute_shape_features_from_file(label_path, LABEL_DICT,
+                                                                  num_workers = args.num_workers)
+
+    elapsed = time.time() - start_time
+    peak = tracemalloc.get_traced_memory()[1]/2**20
+    tracemalloc.stop()
+
+    print("Single pass: %g seconds, peak memory %.1f MB."%(elapsed, peak))
+    print("Speed-up: %.2fx, memory reduction: %.2fx"%(elapsed_legacy/elapsed, peak_legacy/peak))
+
+    if legacy_df is not None:
+      for feature in shape_features.SHAPE_FEATURE_LIST:
+        rel_diff = np.abs(features_df[feature].values - legacy_df[feature].values)/np.abs(legacy_df[feature].values)
+        print("%-24s max relative difference: %.2e"%(feature, rel_diff.max()))
+
+    print(features_df.to_string(index = False))
+
+  finally:
+    shutil.rmtree(base_path)
+
+# ----------------------------------
+# ----------------------------------
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,135 @@
+"""
+    ----------------------------------------
+    IDC-MedImA-misc - cohort sharding benchmark
+    ----------------------------------------
+
+    Compare the makespan (time until the last worker is done) of a synthetic NLST-like cohort
+    split in contiguous chunks (the notebooks' DataFrame order), with the cost-balanced shards
+    (`sharding.plan_shards`), with and without the work stealing of `sharding.LeaseQueue`.
+    The per-series processing times are simulated (cost times a random factor), while the lease
+    protocol runs for real on a temporary directory. Run from the `nnunet` folder:
+
+      python -m src.benchmarks.bench_sharding --num_series 1000 --num_workers 8
+
+    ----------------------------------------
+    Author: Dennis Bontempi
+    Email:  dennis_bontempi@dfci.harvard.edu
+    ----------------------------------------
+
+"""
+
+import time
+import heapq
+import shutil
+import argparse
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+import src.utils.sharding as sharding
+
+
+def synthetic_cohort(num_series, seed = 0):
+
+  """
+  Synthetic cohort table (one row per series) with NLST-like sizes: mostly 100-150 slice
+  series, and a tail of 300-600 slice (thin-slice) ones.
+  """
+
+  rng = np.random.default_rng(seed)
+
+  num_instances = rng.choice([110, 130, 150, 300, 450, 600], size = num_series,
+                             p = [0.3, 0.25, 0.2, 0.1, 0.08, 0.07])
+  min_difference = np.where(num_instances > 200, 1.0, 2.5)
+
+  # the large series are often consecutive (e.g., the same study protocol across a site)
+  order = np.argsort(rng.normal(0, 1, num_series) + (num_instances > 200)*1.5, kind = "stable")
+
+  return pd.DataFrame({"SeriesInstanceUID" : ["1.2.826.0.1.%d"%idx for idx in range(num_series)],
+                       "num_instances" : num_instances[order],
+                       "min_difference" : min_difference[order]})
+
+# ----------------------------------
+# ----------------------------------
+
+def static_makespan(series_time_dict, shard_series_list):
+  return max(sum(series_time_dict[series_id] for series_id in series_list) for series_list in shard_series_list)
+
+# ----------------------------------
+# ----------------------------------
+
+def lease_makespan(plan_df, series_time_dict, num_workers, root_path):
+
+  """
+  Simulate `num_workers` nodes pulling work from a `LeaseQueue`: the worker that becomes free
+  first claims the next series (from its own shard first).
+  """
+
+  queue_list = [sharding.LeaseQueue(root_path, worker_id = "worker-%d"%worker) for worker in range(num_workers)]
+  queue_list[0].publish(plan_df)
+
+  # (time at which the worker is free, worker)
+  worker_heap = [(0.0, worker) for worker in range(num_workers)]
+  makespan = 0.0
+
+  while worker_heap:
+    free_time, worker = heapq.heappop(worker_heap)
+    series_id_list = queue_list[worker].claim(shard = worker)
+
+    if len(series_id_list) == 0:
+      makespan = max(makespan, free_time)
+      continue
+
+    queue_list[worker].complete(series_id_list[0])
+    heapq.heappush(worker_heap, (free_time + series_time_dict[series_id_list[0]], worker))
+
+  return makespan
+
+# ----------------------------------
+# ----------------------------------
+
+def main():
+
+  parser = argparse.ArgumentParser(description = "Cohort sharding benchmark.")
+  parser.add_argument("--num_series", type = int, default = 1000)
+  parser.add_argument("--num_workers", type = int, default = 8)
+  parser.add_argument("--noise", type = float, default = 0.2)
+  args = parser.parse_args()
+
+  cohort_df = synthetic_cohort(args.num_series)
+
+  # "true" processing time of every series (in seconds) - the estimated cost, with some noise
+  rng = np.random.default_rng(1)
+  cost_df = sharding.estimate_series_cost(cohort_df)
+  series_time_dict = dict(zip(cost_df["SeriesInstanceUID"],
+                              cost_df["cost"].values*0.2*rng.lognormal(0, args.noise, len(cost_df))))
+
+  print("Synthetic cohort: %g series, %g workers (ideal makespan: %.0f seconds)."%(args.num_series, args.num_workers,
+                                                                                  sum(series_time_dict.values())/args.num_workers))
+
+  chunk_list = np.array_split(cohort_df["SeriesInstanceUID"].values, args.num_workers)
+  print("Contiguous chunks:      makespan %.0f seconds."%static_makespan(series_time_dict, chunk_list))
+
+  plan_df = sharding.plan_shards(cohort_df, args.num_workers)
+  shard_list = [shard_df["SeriesInstanceUID"].values for _, shard_df in plan_df.groupby("shard")]
+  print("Cost-balanced shards:   makespan %.0f seconds."%static_makespan(series_time_dict, shard_list))
+
+  root_path = tempfile.mkdtemp(prefix = "bench_sharding_")
+
+  try:
+    start_time = time.time()
+    makespan = lease_makespan(plan_df, series_time_dict, args.num_workers, root_path)
+    elapsed = time.time() - start_time
+
+    print("Shards + lease queue:   makespan %.0f seconds (protocol overhead: %.2f ms per series)."%(makespan,
+                                                                                                  1000*elapsed/args.num_series))
+
+  finally:
+    shutil.rmtree(root_path)
+
+# ----------------------------------
+# ----------------------------------
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,169 @@
+"""
+    ----------------------------------------
+    IDC-MedImA-misc - softmax export benchmark
+    ----------------------------------------
+
+    Compare the streaming `postprocessing.numpy_to_nrrd` with the previous implementation
+    (whole `.npz` loaded at once, several full-volume copies per channel) in terms of time
+    and peak (NumPy) memory, on a synthetic SegTHOR-like softmax. Run from the `nnunet` folder:
+
+      python -m src.benchmarks.bench_softmax_export --shape 300 512 512
+
+    ----------------------------------------
+    Author: Dennis Bontempi
+    Email:  dennis_bontempi@dfci.harvard.edu
+    ----------------------------------------
+
+"""
+
+import os
+import time
+import shutil
+import argparse
+import tempfile
+import tracemalloc
+
+import numpy as np
+import SimpleITK as sitk
+
+import src.utils.postprocessing as postprocessing
+
+STRUCTURE_LIST = ["Background", "Esophagus", "Heart", "Trachea", "Aorta"]
+
+
+def legacy_numpy_to_nrrd(model_output_folder, processed_nrrd_path, pat_id,
+                         output_folder_name = "pred_softmax", output_dtype = "uint8",
+                         structure_list = STRUCTURE_LIST):
+
+  """
+  Previous `numpy_to_nrrd` implementation (with `np.int` replaced by `int`, as the
+  former does not exist in recent NumPy versions), kept as the benchmark baseline.
+  """
+
+  pred_softmax_path = os.path.join(model_output_folder, pat_id + ".npz")
+
+  ct_nrrd_path = os.path.join(processed_nrrd_path, pat_id, pat_id + "_CT.nrrd")
+  sitk_ct = sitk.ReadImage(ct_nrrd_path)
+
+  output_folder_path = os.path.join(processed_nrrd_path, pat_id, output_folder_name)
+  
+  if not os.path.exists(output_folder_path):
+    os.mkdir(output_folder_path)
+
+  pred_softmax_all = np.load(pred_softmax_path)["softmax"]
+
+  for channel, structure in enumerate(structure_list):
+    pred_softmax_segmask = pred_softmax_all[channel].astype(dtype = np.float32)
+
+    if output_dtype == "float32":
+      sitk_dtype = sitk.sitkFloat32
+    elif output_dtype == "uint8":
+      pred_softmax_segmask = (255*pred_softmax_segmask).astype(int)
+      sitk_dtype = sitk.sitkUInt8
+    elif output_dtype == "uint16":
+      pred_softmax_segmask = (65536*pred_softmax_segmask).astype(int)
+      sitk_dtype = sitk.sitkUInt16
+    
+    pred_softmax_segmask_sitk = sitk.GetImageFromArray(pred_softmax_segmask)
+    pred_softmax_segmask_sitk.CopyInformation(sitk_ct)
+    pred_softmax_segmask_sitk = sitk.Cast(pred_softmax_segmask_sitk, sitk_dtype)
+
+    writer = sitk.ImageFileWriter()
+    writer.UseCompressionOn()
+    writer.SetFileName(os.path.join(output_folder_path, "%s.nrrd"%(structure)))
+    writer.Execute(pred_softmax_segmask_sitk)
+
+# ----------------------------------
+# ----------------------------------
+
+def write_synthetic_softmax(model_output_folder, processed_nrrd_path, pat_id, shape, seed = 0):
+
+  """
+  Write a synthetic softmax `.npz` (float16, like nnU-Net) and the matching CT NRRD.
+  """
+
+  rng = np.random.default_rng(seed)
+
+  logits = rng.standard_normal((len(STRUCTURE_LIST),) + tuple(shape), dtype = np.float32)
+  softmax = np.exp(logits)
+  softmax /= softmax.sum(axis = 0, keepdims = True)
+
+  np.savez_compressed(os.path.join(model_output_folder, pat_id + ".npz"),
+                      softmax = softmax.astype(np.float16))
+
+  os.makedirs(os.path.join(processed_nrrd_path, pat_id))
+  sitk_ct = sitk.GetImageFromArray(np.zeros(shape, dtype = np.int16))
+  sitk_ct.SetSpacing((0.7, 0.7, 2.5))
+  sitk.WriteImage(sitk_ct, os.path.join(processed_nrrd_path, pat_id, pat_id + "_CT.nrrd"))
+
+# ----------------------------------
+# ----------------------------------
+
+def run_and_measure(func, **kwargs):
+
+  tracemalloc.start()
+  start_time = time.time()
+
+  func(**kwargs)
+
+  elapsed = time.time() - start_time
+  _, peak = tracemalloc.get_traced_memory()
+  tracemalloc.stop()
+
+  return elapsed, peak
+
+# ----------------------------------
+# ----------------------------------
+
+def main():
+
+  parser = argparse.ArgumentParser(description = "Softmax to NRRD export benchmark.")
+  parser.add_argument("--shape", type = int, nargs = 3, default = [300, 512, 512])
+  parser.add_argument("--output_dtype", type = str, default = "uint8",
+                      choices = ["uint8", "uint16", "float32"])
+  parser.add_argument("--num_workers", type = int, default = 2)
+  args = parser.parse_args()
+
+  base_path = tempfile.mkdtemp(prefix = "bench_softmax_export_")
+  pat_id = "SYNTH-001"
+
+  try:
+    model_output_folder = os.path.join(base_path, "nnunet_output")
+    processed_nrrd_path = os.path.join(base_path, "nrrd")
+    os.makedirs(model_output_folder)
+
+    print("Writing a synthetic %s softmax..."%(str(args.shape)))
+    write_synthetic_softmax(model_output_folder, processed_nrrd_path, pat_id, args.shape)
+
+    elapsed, peak = run_and_measure(legacy_numpy_to_nrrd,
+                                    model_output_folder = model_output_folder,
+                                    processed_nrrd_path = processed_nrrd_path,
+                                    pat_id = pat_id, output_folder_name = "legacy",
+                                    output_dtype = args.output_dtype)
+    print("Legacy:    %8.2f seconds, peak memory %8.1f MB"%(elapsed, peak/2**20))
+
+    elapsed, peak = run_and_measure(postprocessing.numpy_to_nrrd,
+                                    model_output_folder = model_output_folder,
+                                    processed_nrrd_path = processed_nrrd_path,
+                                    pat_id = pat_id, output_folder_name = "streaming",
+                                    output_dtype = args.output_dtype,
+                                    num_workers = args.num_workers)
+    print("Streaming: %8.2f seconds, peak memory %8.1f MB"%(elapsed, peak/2**20))
+
+    # sanity check - the outputs should match (except for the uint16 overflow the legacy code had)
+    if args.output_dtype != "uint16":
+      for structure in STRUCTURE_LIST:
+        legacy = sitk.GetArrayFromImage(sitk.ReadImage(os.path.join(processed_nrrd_path, pat_id,
+                                                                    "legacy", structure + ".nrrd")))
+        streaming = sitk.GetArrayFromImage(sitk.ReadImage(os.path.join(processed_nrrd_path, pat_id,
+                                                                       "streaming", structure + ".nrrd")))
+        assert(np.array_equal(legacy, streaming))
+
+  finally:
+    shutil.rmtree(base_path)
+
+# ----------------------------------
+# ----------------------------------
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,100 @@
+"""
+    ----------------------------------------
+    IDC-MedImA-misc - compressed volume writer benchmark
+    ----------------------------------------
+
+    Compare `volume_writer.write_volume` (block-parallel gzip) with SimpleITK's single-threaded
+    compressed writer on a synthetic CT-like volume, for NRRD and NIfTI outputs, in terms of
+    time and file size - and check that the volumes read back are identical. Run from the
+    `nnunet` folder:
+
+      python -m src.benchmarks.bench_volume_writer --shape 500 512 512 --num_threads 1 4 8
+
+    ----------------------------------------
+    Author: Dennis Bontempi
+    Email:  dennis_bontempi@dfci.harvard.edu
+    ----------------------------------------
+
+"""
+
+import os
+import time
+import shutil
+import argparse
+import tempfile
+
+import numpy as np
+import SimpleITK as sitk
+
+import src.utils.volume_writer as volume_writer
+
+
+def synthetic_ct_volume(shape, seed = 0):
+
+  """
+  Synthetic CT-like volume (int16): air around an elliptic body, with noise.
+  """
+
+  rng = np.random.default_rng(seed)
+
+  num_slices, rows, columns = shape
+  yy, xx = np.mgrid[:rows, :columns]
+
+  body_mask = ((yy - rows/2)/(0.4*rows))**2 + ((xx - columns/2)/(0.45*columns))**2 < 1
+  volume = np.where(body_mask, 40, -1000).astype(np.int16)[None].repeat(num_slices, axis = 0)
+  volume += rng.normal(0, 20, volume.shape).astype(np.int16)
+
+  sitk_ct = sitk.GetImageFromArray(volume)
+  sitk_ct.SetSpacing((0.7, 0.7, 2.5))
+  sitk_ct.SetOrigin((-180.0, -180.0, -400.0))
+
+  return sitk_ct
+
+# ----------------------------------
+# ----------------------------------
+
+def main():
+
+  parser = argparse.ArgumentParser(description = "Compressed volume writer benchmark.")
+  parser.add_argument("--shape", type = int, nargs = 3, default = [500, 512, 512])
+  parser.add_argument("--num_threads", type = int, nargs = "+", default = [1, 4, 8])
+  parser.add_argument("--level", type = int, default = volume_writer.get_compression_level("ct"))
+  args = parser.parse_args()
+
+  base_path = tempfile.mkdtemp(prefix = "bench_volume_writer_")
+
+  try:
+    sitk_ct = synthetic_ct_volume(args.shape)
+    volume = sitk.GetArrayViewFromImage(sitk_ct)
+
+    for extension in [".nrrd", ".nii.gz"]:
+      output_path = os.path.join(base_path, "sitk" + extension)
+
+      start_time = time.time()
+      sitk.WriteImage(sitk_ct, output_path, useCompression = True)
+      elapsed_sitk = time.time() - start_time
+
+      print("%-7s SimpleITK:            %6.2f seconds, %7.1f MB"%(extension, elapsed_sitk,
+                                                                  os.path.getsize(output_path)/2**20))
+
+      for num_threads in args.num_threads:
+        output_path = os.path.join(base_path, "writer_%d%s"%(num_threads, extension))
+
+        start_time = time.time()
+        volume_writer.write_volume(sitk_ct, output_path, level = args.level, num_threads = num_threads)
+        elapsed = time.time() - start_time
+
+        assert(np.array_equal(sitk.GetArrayFromImage(sitk.ReadImage(output_path)), volume))
+
+        print("%-7s write_volume (%2d th.): %6.2f seconds, %7.1f MB (%.2fx)"%(extension, num_threads, elapsed,
+                                                                              os.path.getsize(output_path)/2**20,
+                                                                              elapsed_sitk/elapsed))
+
+  finally:
+    shutil.rmtree(base_path)
+
+# ----------------------------------
+# ----------------------------------
+
+if __name__ == "__main__":
+  main()
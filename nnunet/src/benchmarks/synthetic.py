@@ -0,0 +1,125 @@
+"""
+    ----------------------------------------
+    IDC-MedImA-misc - synthetic benchmark data
+    ----------------------------------------
+
+    ----------------------------------------
+    Author: Dennis Bontempi
+    Email:  dennis_bontempi@dfci.harvard.edu
+    ----------------------------------------
+
+"""
+
+import os
+
+import numpy as np
+
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.uid import ExplicitVRLittleEndian, generate_uid
+
+CT_IMAGE_STORAGE = "1.2.840.10008.5.1.4.1.1.2"
+
+
+def write_synthetic_ct_series(path_to_ct_dir, num_slices = 500, rows = 512, columns = 512,
+                              pixel_spacing = (0.7, 0.7), slice_thickness = 2.5,
+                              pat_id = "SYNTH-001", seed = 0):
+
+  """
+  Write a synthetic DICOM CT series (one file per slice, shuffled file names) to disk.
+
+  Arguments:
+    path_to_ct_dir  : required - path to the folder where the DICOM CT slices will be written.
+    num_slices      : optional - number of slices. Defaults to 500.
+    rows            : optional - number of rows of every slice. Defaults to 512.
+    columns         : optional - number of columns of every slice. Defaults to 512.
+    pixel_spacing   : optional - in-plane spacing (mm). Defaults to (0.7, 0.7).
+    slice_thickness : optional - distance between slices (mm). Defaults to 2.5.
+    pat_id          : optional - PatientID of the series. Defaults to "SYNTH-001".
+    seed            : optional - random seed. Defaults to 0.
+
+  Returns:
+    volume : numpy array (z, y, x) storing the HU values written to the series.
+  """
+
+  rng = np.random.default_rng(seed)
+
+  if not os.path.exists(path_to_ct_dir):
+    os.makedirs(path_to_ct_dir)
+
+  study_uid = generate_uid()
+  series_uid = generate_uid()
+  frame_of_reference_uid = generate_uid()
+
+  # smooth-ish synthetic "body": an ellipsoid of soft tissue in air, plus noise
+  zz, yy, xx = np.ogrid[:num_slices, :rows, :columns]
+  body = (((zz - num_slices/2)/(num_slices/2 + 1))**2 + ((yy - rows/2)/(rows/2.5))**2
+          + ((xx - columns/2)/(columns/2.2))**2) < 1
+  volume = np.where(body, 40, -1000).astype(np.int16)
+  volume += rng.integers(-20, 20, size = volume.shape, dtype = np.int16)
+
+  for z in rng.permutation(num_slices):
+    dcm = Dataset()
+    dcm.PatientID = pat_id
+    dcm.Modality = "CT"
+    dcm.SOPClassUID = CT_IMAGE_STORAGE
+    dcm.SOPInstanceUID = generate_uid()
+    dcm.StudyInstanceUID = study_uid
+    dcm.SeriesInstanceUID = series_uid
+    dcm.FrameOfReferenceUID = frame_of_reference_uid
+    dcm.InstanceNumber = int(z) + 1
+
+    dcm.ImageOrientationPatient = [1, 0, 0, 0, 1, 0]
+    dcm.ImagePositionPatient = [-columns*pixel_spacing[1]/2, -rows*pixel_spacing[0]/2,
+                                -z*slice_thickness]
+    dcm.PixelSpacing = list(pixel_spacing)
+    dcm.SliceThickness = slice_thickness
+
+    dcm.Rows = rows
+    dcm.Columns = columns
+    dcm.SamplesPerPixel = 1
+    dcm.PhotometricInterpretation = "MONOCHROME2"
+    dcm.BitsAllocated = 16
+    dcm.BitsStored = 16
+    dcm.HighBit = 15
+    dcm.PixelRepresentation = 0
+    dcm.RescaleIntercept = -1024
+    dcm.RescaleSlope = 1
+    dcm.PixelData = (volume[z].astype(np.int32) + 1024).astype(np.uint16).tobytes()
+
+    dcm.file_meta = FileMetaDataset()
+    dcm.file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    dcm.file_meta.MediaStorageSOPClassUID = dcm.SOPClassUID
+    dcm.file_meta.MediaStorageSOPInstanceUID = dcm.SOPInstanceUID
+
+    dcm.save_as(os.path.join(path_to_ct_dir, "%s.dcm"%(dcm.SOPInstanceUID)),
+                enforce_file_format = True)
+
+  # slices are written at decreasing z - the volume ordered by increasing z is flipped
+  return volume[::-1]
+
+# ----------------------------------
+# ----------------------------------
+
+def synthetic_label_map(shape, seed = 0):
+
+  """
+  Synthetic SegTHOR-like label map: four ellipsoids (labels 1 to 4) in the middle third of the volume.
+  """
+
+  rng = np.random.default_rng(seed)
+
+  label_array = np.zeros(shape, dtype = np.uint8)
+  zz, yy, xx = np.ogrid[:shape[0], :shape[1], :shape[2]]
+
+  for label in range(1, 5):
+    center = rng.uniform(0.35, 0.65, size = 3)*np.array(shape)
+    radii = rng.uniform(0.05, 0.15, size = 3)*np.array(shape)
+
+    ellipsoid = (((zz - center[0])/radii[0])**2 + ((yy - center[1])/radii[1])**2
+                 + ((xx - center[2])/radii[2])**2) < 1
+    label_array[ellipsoid] = label
+
+  return label_array
+
+# ----------------------------------
+# ----------------------------------
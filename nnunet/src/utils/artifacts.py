@@ -0,0 +1,332 @@
+"""
+    ----------------------------------------
+    IDC-MedImA-misc - artifact cache utils
+    ----------------------------------------
+
+    ----------------------------------------
+    Author: Dennis Bontempi
+    Email:  dennis_bontempi@dfci.harvard.edu
+    ----------------------------------------
+
+"""
+
+import os
+import json
+import time
+import shutil
+import hashlib
+import tempfile
+import threading
+
+from . import series_index
+
+# bump to invalidate all the cached artifacts (e.g., if a converter changes its output)
+CACHE_VERSION = 1
+
+# name of the file storing the metadata of every cache entry
+_META_FN = "_artifact.json"
+
+
+def compute_key(input_uid_list, converter, params = None):
+
+  """
+  Content-addressed key of an artifact: hash of the set of inputs (e.g., the SeriesInstanceUID
+  and the SOPInstanceUIDs of a series, or the key of another artifact), of the converter
+  name and of its parameters. The same inputs converted in the same way always share the key,
+  across cohorts and machines.
+
+  Arguments:
+    input_uid_list : required - list of strings identifying the inputs (the order is irrelevant).
+    converter      : required - name (and version, if relevant) of the converter.
+    params         : optional - JSON-serializable dictionary storing the parameters of the
+                                converter. Defaults to None.
+
+  Returns:
+    key : hexadecimal SHA-256 digest.
+  """
+
+  key_dict = {"version" : CACHE_VERSION,
+              "inputs" : sorted(str(uid) for uid in input_uid_list),
+              "converter" : converter,
+              "params" : params if params is not None else dict()}
+
+  return hashlib.sha256(json.dumps(key_dict, sort_keys = True).encode("utf-8")).hexdigest()
+
+# ----------------------------------
+# ----------------------------------
+
+def ct_series_uids(path_to_ct_dir):
+
+  """
+  Identity of a DICOM CT series (SeriesInstanceUID and SOPInstanceUIDs), from the cached
+  header-only series index (see `series_index.build_series_index`) - to be used with `compute_key`.
+  """
+
+  ct_index = series_index.build_series_index(path_to_ct_dir)
+
+  return [str(ct_index["series_instance_uid"])] + ct_index["sop_instance_uid"].tolist()
+
+# ----------------------------------
+# ----------------------------------
+
+def _path_size(path):
+
+  if os.path.isfile(path):
+    return os.path.getsize(path)
+
+  return sum(os.path.getsize(os.path.join(root, fn)) for root, _, fn_list in os.walk(path) for fn in fn_list)
+
+# ----------------------------------
+# ----------------------------------
+
+def _copy_path(src_path, dst_path, link_mode):
+
+  """
+  Copy (or hard-link) a file or a folder.
+  """
+
+  if os.path.isdir(src_path):
+    shutil.copytree(src_path, dst_path, copy_function = (shutil.copy2 if link_mode == "copy"
+                                                         else _link_or_copy))
+  elif link_mode == "copy":
+    shutil.copy2(src_path, dst_path)
+  else:
+    _link_or_copy(src_path, dst_path)
+
+def _link_or_copy(src_path, dst_path):
+
+  try:
+    os.link(src_path, dst_path)
+  except OSError:
+    shutil.copy2(src_path, dst_path)
+
+# ----------------------------------
+# ----------------------------------
+
+class LocalArtifactStore:
+
+  """
+  Artifact store backed by a local directory (which can also be a shared mount, so that the
+  artifacts are reused across VMs). Every artifact is stored as `root_path`/objects/<key>/,
+  and published atomically: it is copied to a temporary folder on the same filesystem first,
+  then renamed - so that a partial artifact is never visible.
+  """
+
+  def __init__(self, root_path):
+
+    self.root_path = root_path
+    self.objects_path = os.path.join(root_path, "objects")
+    self.tmp_path = os.path.join(root_path, "tmp")
+
+    os.makedirs(self.objects_path, exist_ok = True)
+    os.makedirs(self.tmp_path, exist_ok = True)
+
+  def entry_path(self, key):
+    return os.path.join(self.objects_path, key)
+
+  def contains(self, key):
+    return os.path.exists(os.path.join(self.entry_path(key), _META_FN))
+
+  def get(self, key, dst_path, link_mode = "copy"):
+
+    meta_path = os.path.join(self.entry_path(key), _META_FN)
+
+    try:
+      with open(meta_path, "r") as fp:
+        meta = json.load(fp)
+    except (OSError, ValueError):
+      return False
+
+    artifact_path = os.path.join(self.entry_path(key), meta["name"])
+
+    # materialize next to the destination first, then rename (never leave a partial output)
+    dst_dir_path = os.path.dirname(os.path.abspath(dst_path))
+    os.makedirs(dst_dir_path, exist_ok = True)
+
+    tmp_dst_path = tempfile.mkdtemp(prefix = ".artifact_", dir = dst_dir_path)
+
+    try:
+      _copy_path(artifact_path, os.path.join(tmp_dst_path, "artifact"), link_mode)
+
+      if os.path.isdir(dst_path):
+        shutil.rmtree(dst_path)
+
+      os.replace(os.path.join(tmp_dst_path, "artifact"), dst_path)
+
+    finally:
+      shutil.rmtree(tmp_dst_path, ignore_errors = True)
+
+    self.touch(key)
+
+    return True
+
+  def put(self, key, src_path, meta):
+
+    if self.contains(key):
+      self.touch(key)
+      return
+
+    tmp_entry_path = tempfile.mkdtemp(prefix = key + "_", dir = self.tmp_path)
+
+    try:
+      name = os.path.basename(os.path.normpath(src_path))
+      _copy_path(src_path, os.path.join(tmp_entry_path, name), "copy")
+
+      meta = dict(meta, name = name, size = _path_size(os.path.join(tmp_entry_path, name)),
+                  created = time.time())
+
+      with open(os.path.join(tmp_entry_path, _META_FN), "w") as fp:
+        json.dump(meta, fp)
+
+      # the rename fails if another process published the same key in the meantime - keep that one
+      try:
+        os.rename(tmp_entry_path, self.entry_path(key))
+      except OSError:
+        pass
+
+    finally:
+      shutil.rmtree(tmp_entry_path, ignore_errors = True)
+
+  def touch(self, key):
+
+    # the mtime of the metadata file is the last access time used for the LRU eviction
+    try:
+      os.utime(os.path.join(self.entry_path(key), _META_FN))
+    except OSError:
+      pass
+
+  def list_entries(self):
+
+    entry_list = list()
+
+    for key in os.listdir(self.objects_path):
+      meta_path = os.path.join(self.entry_path(key), _META_FN)
+
+      try:
+        with open(meta_path, "r") as fp:
+          size = json.load(fp)["size"]
+        entry_list.append({"key" : key, "size" : size, "last_access" : os.path.getmtime(meta_path)})
+      except (OSError, ValueError, KeyError):
+        continue
+
+    return entry_list
+
+  def delete(self, key):
+
+    # rename first, so that the entry disappears atomically for the readers
+    tmp_entry_path = tempfile.mkdtemp(prefix = key + "_deleted_", dir = self.tmp_path)
+
+    try:
+      os.rename(self.entry_path(key), os.path.join(tmp_entry_path, key))
+    except OSError:
+      pass
+
+    shutil.rmtree(tmp_entry_path, ignore_errors = True)
+
+# ----------------------------------
+# ----------------------------------
+
+class ArtifactCache:
+
+  """
+  Content-addressed cache for the intermediate products of the pipeline (e.g., CT NRRD/NIfTI
+  volumes, RTSTRUCT masks, model outputs), keyed by `compute_key`. Unlike the `os.path.exists`
+  checks on the output paths, a cached artifact is only reused if it was produced from the same
+  inputs by the same converter with the same parameters, and it is always complete. The size of
+  the cache is bounded: the least recently used artifacts are evicted first.
+  """
+
+  def __init__(self, store, max_size_gb = 50, link_mode = "copy"):
+
+    """
+    Arguments:
+      store       : required - artifact store (`LocalArtifactStore`) or path to a local folder.
+      max_size_gb : optional - maximum size of the cache (GB). Defaults to 50.
+      link_mode   : optional - how the artifacts are materialized at the output paths, "copy" or
+                               "hardlink" (saves space, but the outputs must never be modified
+                               in place). Defaults to "copy".
+    """
+
+    assert(link_mode in ["copy", "hardlink"])
+
+    self.store = LocalArtifactStore(store) if isinstance(store, str) else store
+    self.max_size_bytes = max_size_gb*2**30
+    self.link_mode = link_mode
+
+    self._lock = threading.Lock()
+
+  # ----------------------------------
+
+  def fetch(self, key, output_path):
+
+    """
+    Materialize the artifact `key` at `output_path` (file or folder).
+
+    Returns:
+      hit : True if the artifact was found in the cache, False otherwise.
+    """
+
+    return self.store.get(key, output_path, link_mode = self.link_mode)
+
+  # ----------------------------------
+
+  def publish(self, key, output_path, meta = None):
+
+    """
+    Store the file (or folder) at `output_path` as the artifact `key`, then evict the least
+    recently used artifacts if the cache grew past its maximum size.
+    """
+
+    self.store.put(key, output_path, meta if meta is not None else dict())
+    self.evict()
+
+  # ----------------------------------
+
+  def cached_call(self, key, output_path, fn, meta = None):
+
+    """
+    Materialize the artifact `key` at `output_path` if it is cached; otherwise call `fn()`
+    (which is expected to produce `output_path`) and publish the result.
+
+    Returns:
+      hit : True if the artifact was found in the cache, False if `fn` was called.
+    """
+
+    if self.fetch(key, output_path):
+      print("Artifact %s... found in the cache - skipping."%(key[:12]))
+      return True
+
+    fn()
+    self.publish(key, output_path, meta)
+
+    return False
+
+  # ----------------------------------
+
+  def evict(self):
+
+    """
+    Remove the least recently used artifacts until the cache is within its maximum size.
+
+    Returns:
+      evicted_list : list of the evicted keys.
+    """
+
+    with self._lock:
+      entry_list = sorted(self.store.list_entries(), key = lambda entry: entry["last_access"])
+      total_size = sum(entry["size"] for entry in entry_list)
+
+      evicted_list = list()
+
+      for entry in entry_list:
+        if total_size <= self.max_size_bytes:
+          break
+
+        self.store.delete(entry["key"])
+        total_size -= entry["size"]
+        evicted_list.append(entry["key"])
+
+    return evicted_list
+
+# ----------------------------------
+# ----------------------------------
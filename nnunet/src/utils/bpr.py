@@ -0,0 +1,256 @@
+"""
+    ----------------------------------------
+    IDC-MedImA-misc - body part regression utils
+    ----------------------------------------
+
+    ----------------------------------------
+    Author: Dennis Bontempi
+    Email:  dennis_bontempi@dfci.harvard.edu
+    ----------------------------------------
+
+"""
+
+import json
+
+import numpy as np
+
+
+def load_bpr_output(path_to_json_file):
+
+  """
+  Parse the JSON output of BodyPartRegression once, and precompute everything the SR
+  construction needs per slice: a boolean (slice x region) mask for the regions and the
+  slice index of every landmark. The result can be reused for all the regions/landmarks
+  (see `get_indices`, `get_landmark_indices`, `iter_slice_annotations`), instead of
+  re-parsing the JSON file and scanning the region/landmark lists for every slice.
+
+  Arguments:
+    path_to_json_file : required - path to the JSON file created by the BPR prediction.
+
+  Returns:
+    bpr_output : dictionary storing the "slice_scores" (cleaned slice scores), the
+                 "valid_z_spacing", the "region_list" and the "region_mask" (num_slices x
+                 num_regions, boolean), the "landmark_list" (sorted by increasing look-up
+                 table mean) with the corresponding "landmark_scores", and the "landmark_indices"
+                 (see `get_landmark_indices`).
+  """
+
+  with open(path_to_json_file, "r") as fp:
+    json_data = json.load(fp)
+
+  bpr_output = dict()
+
+  slice_scores = np.array(json_data["cleaned slice scores"], dtype = np.float64)
+  num_slices = len(slice_scores)
+
+  bpr_output["slice_scores"] = slice_scores
+  bpr_output["valid_z_spacing"] = json_data["valid z-spacing"]
+  bpr_output["lookup_table"] = json_data["look-up table"]
+
+  # scatter the slice indices of each region in a (slice x region) mask
+  region_dict = json_data["body part examined"]
+  region_mask = np.zeros((num_slices, len(region_dict)), dtype = bool)
+
+  for region_idx, slice_index_list in enumerate(region_dict.values()):
+    slice_index_arr = np.asarray(slice_index_list, dtype = np.int64)
+    slice_index_arr = slice_index_arr[(slice_index_arr >= 0) & (slice_index_arr < num_slices)]
+    region_mask[slice_index_arr, region_idx] = True
+
+  bpr_output["region_list"] = list(region_dict.keys())
+  bpr_output["region_mask"] = region_mask
+
+  # landmarks sorted by their look-up table mean, in ascending order (stable, like `sorted`)
+  landmark_list = list(json_data["look-up table"].keys())
+  landmark_scores = np.array([json_data["look-up table"][landmark]["mean"] for landmark in landmark_list],
+                             dtype = np.float64)
+  sorted_ind = np.argsort(landmark_scores, kind = "stable")
+
+  bpr_output["landmark_list"] = [landmark_list[idx] for idx in sorted_ind]
+  bpr_output["landmark_scores"] = landmark_scores[sorted_ind]
+
+  bpr_output["landmark_indices"] = _compute_landmark_indices(bpr_output)
+
+  return bpr_output
+
+# ----------------------------------
+# ----------------------------------
+
+def crop_scores(slice_scores, start_score, end_score):
+
+  """
+  Vectorized equivalent of `bpreg`'s `crop_scores`: the index of the last slice whose score
+  is below `start_score` (0 if there is none), and the index of the first slice whose score
+  is above `end_score` (the number of slices if there is none). `start_score` and `end_score`
+  can also be arrays, in which case the indices are computed for every pair at once.
+
+  Arguments:
+    slice_scores : required - (cleaned) slice scores.
+    start_score  : required - score (or array of scores) of the start of the region.
+    end_score    : required - score (or array of scores) of the end of the region.
+
+  Returns:
+    min_index : index (or array of indices) of the start of the region.
+    max_index : index (or array of indices) of the end of the region.
+  """
+
+  slice_scores = np.asarray(slice_scores, dtype = np.float64)
+  num_slices = len(slice_scores)
+
+  start_score = np.asarray(start_score, dtype = np.float64)
+  end_score = np.asarray(end_score, dtype = np.float64)
+
+  # (..., num_slices) masks - comparisons with NaN scores are False, as in `bpreg`
+  below_start = slice_scores < start_score[..., np.newaxis]
+  above_end = slice_scores > end_score[..., np.newaxis]
+
+  # last True along the slices (argmax on the reversed mask), first True along the slices
+  min_index = np.where(below_start.any(axis = -1),
+                       num_slices - 1 - np.argmax(below_start[..., ::-1], axis = -1), 0)
+  max_index = np.where(above_end.any(axis = -1), np.argmax(above_end, axis = -1), num_slices)
+
+  return min_index, max_index
+
+# ----------------------------------
+# ----------------------------------
+
+def get_indices(bpr_output, tag_start, tag_end):
+
+  """
+  Get the slice indices of the anatomy between two landmarks - the equivalent of the
+  notebooks' `get_indices_from_json`, without re-parsing the JSON file.
+
+  Arguments:
+    bpr_output : required - dictionary returned by `load_bpr_output`.
+    tag_start  : required - the landmark at the start of the anatomical region.
+    tag_end    : required - the landmark at the end of the anatomical region.
+
+  Returns:
+    min_index : the minimum index in the patient coordinate system.
+    max_index : the maximum index in the patient coordinate system.
+  """
+
+  start_score = bpr_output["lookup_table"][tag_start]["mean"]
+  end_score = bpr_output["lookup_table"][tag_end]["mean"]
+
+  min_index, max_index = crop_scores(bpr_output["slice_scores"], start_score, end_score)
+
+  return int(min_index), int(max_index)
+
+# ----------------------------------
+# ----------------------------------
+
+def _compute_landmark_indices(bpr_output):
+
+  num_slices = len(bpr_output["slice_scores"])
+
+  # all the landmarks at once
+  min_index, _ = crop_scores(bpr_output["slice_scores"], bpr_output["landmark_scores"],
+                             bpr_output["landmark_scores"])
+
+  # if the expected z-spacing is negative, the slices are in reverse order
+  if bpr_output["valid_z_spacing"] <= 0:
+    min_index = num_slices - min_index
+
+  # landmarks assigned to the most inferior or most superior slice are discarded
+  keep = (min_index != 0) & (min_index != num_slices - 1)
+
+  return {landmark : int(index) for landmark, index, keep_landmark
+          in zip(bpr_output["landmark_list"], min_index, keep) if keep_landmark}
+
+# ----------------------------------
+# ----------------------------------
+
+def get_landmark_indices(bpr_output):
+
+  """
+  Get the slice index of every landmark - the equivalent of the notebooks'
+  `get_landmark_indices_from_json`, without re-parsing the JSON file.
+
+  Arguments:
+    bpr_output : required - dictionary returned by `load_bpr_output`.
+
+  Returns:
+    landmark_indices : dictionary storing the slice index of each landmark (sorted by
+                       increasing look-up table mean). Landmarks at the extreme ends - most
+                       inferior and most superior axial slices - are removed.
+  """
+
+  return dict(bpr_output["landmark_indices"])
+
+# ----------------------------------
+# ----------------------------------
+
+def regions_per_slice(bpr_output):
+
+  """
+  Get the list of the regions assigned to each slice (same order as the regions in the
+  BPR output) - the equivalent of calling `convert_slice_to_region` for every slice.
+
+  Arguments:
+    bpr_output : required - dictionary returned by `load_bpr_output`.
+
+  Returns:
+    slice_region_list : list (one entry per slice) of lists of region names.
+  """
+
+  region_list = bpr_output["region_list"]
+  slice_ind, region_ind = np.nonzero(bpr_output["region_mask"])
+
+  slice_region_list = [list() for _ in range(len(bpr_output["slice_scores"]))]
+
+  # `np.nonzero` returns the indices in row-major order, i.e., sorted by slice then region
+  for slice_idx, region_idx in zip(slice_ind.tolist(), region_ind.tolist()):
+    slice_region_list[slice_idx].append(region_list[region_idx])
+
+  return slice_region_list
+
+# ----------------------------------
+# ----------------------------------
+
+def landmarks_per_slice(bpr_output):
+
+  """
+  Get the list of the landmarks assigned to each slice (sorted by increasing look-up table
+  mean) - the equivalent of calling `get_landmark_indices_list_in_slice` for every slice.
+
+  Arguments:
+    bpr_output : required - dictionary returned by `load_bpr_output`.
+
+  Returns:
+    slice_landmark_list : list (one entry per slice) of lists of landmark names.
+  """
+
+  num_slices = len(bpr_output["slice_scores"])
+  slice_landmark_list = [list() for _ in range(num_slices)]
+
+  # landmarks indexed past the last slice (reversed series) are never matched
+  for landmark, slice_idx in bpr_output["landmark_indices"].items():
+    if 0 <= slice_idx < num_slices:
+      slice_landmark_list[slice_idx].append(landmark)
+
+  return slice_landmark_list
+
+# ----------------------------------
+# ----------------------------------
+
+def iter_slice_annotations(bpr_output):
+
+  """
+  Single pass over the ordered slices, yielding everything needed to build the per-slice
+  measurement groups of the BPR regions and landmarks structured reports.
+
+  Arguments:
+    bpr_output : required - dictionary returned by `load_bpr_output`.
+
+  Yields:
+    slice_idx     : index of the slice (in the order of the sorted CT files).
+    region_list   : list of the regions assigned to the slice.
+    landmark_list : list of the landmarks assigned to the slice (possibly empty).
+  """
+
+  for slice_idx, (region_list, landmark_list) in enumerate(zip(regions_per_slice(bpr_output),
+                                                               landmarks_per_slice(bpr_output))):
+    yield slice_idx, region_list, landmark_list
+
+# ----------------------------------
+# ----------------------------------
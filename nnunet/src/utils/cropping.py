@@ -0,0 +1,186 @@
+"""
+    ----------------------------------------
+    IDC-MedImA-misc - cropping utils
+    ----------------------------------------
+
+    ----------------------------------------
+    Author: Dennis Bontempi
+    Email:  dennis_bontempi@dfci.harvard.edu
+    ----------------------------------------
+
+"""
+
+import os
+import json
+import time
+
+import numpy as np
+import SimpleITK as sitk
+
+from . import bpr
+from . import volume_writer
+
+
+def bpr_crop_range(bpr_output, num_slices, z_spacing, margin_mm = 20.0, region = "chest",
+                   tag_start = None, tag_end = None):
+
+  """
+  Range of slices to crop a CT volume to, from the body part regression output: the slices
+  assigned to `region` (or, if `tag_start` and `tag_end` are specified, the slices between the
+  two landmarks - see `bpr.get_indices`), plus a margin on both sides. The slice indices of BPR
+  follow the slices of the volume it was run on (i.e., the NIfTI CT volume, ordered by z).
+
+  Arguments:
+    bpr_output : required - dictionary returned by `bpr.load_bpr_output`.
+    num_slices : required - number of slices of the CT volume.
+    z_spacing  : required - distance between the slices of the CT volume (mm).
+    margin_mm  : optional - margin added on both sides of the region (mm). Defaults to 20.
+    region     : optional - name of the BPR region to keep. Defaults to "chest".
+    tag_start  : optional - landmark at the start of the region (overrides `region`). Defaults to None.
+    tag_end    : optional - landmark at the end of the region (overrides `region`). Defaults to None.
+
+  Returns:
+    crop_range : (start, end) slice indices (end excluded), or None if the region was not found
+                 (or the BPR output does not match the volume).
+  """
+
+  if len(bpr_output["slice_scores"]) != num_slices:
+    print("BPR output has %g slices, the volume %g - not cropping."%(len(bpr_output["slice_scores"]), num_slices))
+    return None
+
+  if tag_start is not None and tag_end is not None:
+    start, end = bpr.get_indices(bpr_output, tag_start, tag_end)
+
+  elif region in bpr_output["region_list"]:
+    slice_idx_arr = np.flatnonzero(bpr_output["region_mask"][:, bpr_output["region_list"].index(region)])
+
+    if len(slice_idx_arr) == 0:
+      print("No slice assigned to the `%s` region - not cropping."%(region))
+      return None
+
+    start, end = int(slice_idx_arr.min()), int(slice_idx_arr.max()) + 1
+
+  else:
+    print("Region `%s` not found in the BPR output - not cropping."%(region))
+    return None
+
+  margin = int(np.ceil(margin_mm/abs(z_spacing)))
+
+  start = max(0, start - margin)
+  end = min(num_slices, end + margin)
+
+  if end <= start:
+    return None
+
+  return start, end
+
+# ----------------------------------
+# ----------------------------------
+
+def crop_ct_to_region(processed_nifti_path, pat_id, bpr_output, margin_mm = 20.0, region = "chest",
+                      tag_start = None, tag_end = None):
+
+  """
+  Crop the NIfTI CT volume to the range of slices of an anatomical region (see `bpr_crop_range`),
+  so that the inference only runs on the slices the model segments - e.g., the thorax of an NLST
+  series extending to the abdomen and pelvis for SegTHOR. The cropped volume (same geometry,
+  fewer slices) is saved next to the CT volume as `<pat_id>_CT_crop.nii.gz`, and the crop range
+  as `<pat_id>_crop.json` (see `uncrop_label`).
+
+  Arguments:
+    processed_nifti_path : required - path to the folder where the preprocessed NIfTI data are stored.
+    pat_id               : required - patient ID (used for naming purposes).
+    bpr_output           : required - dictionary returned by `bpr.load_bpr_output`, for the same volume.
+    margin_mm            : optional - margin added on both sides of the region (mm). Defaults to 20.
+    region               : optional - name of the BPR region to keep. Defaults to "chest".
+    tag_start            : optional - landmark at the start of the region (overrides `region`).
+                                      Defaults to None.
+    tag_end              : optional - landmark at the end of the region (overrides `region`).
+                                      Defaults to None.
+
+  Returns:
+    crop_info : dictionary storing the "crop_range" (start and end slice, end excluded) and the
+                "full_num_slices" - or None if the volume was not cropped (region not found, or
+                covering the whole volume).
+  """
+
+  pat_dir_nifti_path = os.path.join(processed_nifti_path, pat_id)
+  ct_nifti_path = os.path.join(pat_dir_nifti_path, pat_id + "_CT.nii.gz")
+
+  start_time = time.time()
+
+  sitk_ct = sitk.ReadImage(ct_nifti_path)
+  num_slices = sitk_ct.GetSize()[2]
+
+  crop_range = bpr_crop_range(bpr_output, num_slices = num_slices, z_spacing = sitk_ct.GetSpacing()[2],
+                              margin_mm = margin_mm, region = region, tag_start = tag_start, tag_end = tag_end)
+
+  if crop_range is None or crop_range == (0, num_slices):
+    return None
+
+  start, end = crop_range
+
+  # slicing a SimpleITK image keeps the physical geometry (the origin is moved to the first slice);
+  # the cropped volume is only read by the inference, so it is written as an intermediate
+  volume_writer.write_volume(sitk_ct[:, :, start:end], os.path.join(pat_dir_nifti_path, pat_id + "_CT_crop.nii.gz"),
+                             output_type = "intermediate")
+
+  crop_info = {"crop_range" : [start, end], "full_num_slices" : num_slices}
+
+  with open(os.path.join(pat_dir_nifti_path, pat_id + "_crop.json"), "w") as fp:
+    json.dump(crop_info, fp)
+
+  elapsed = time.time() - start_time
+  print("CT volume cropped to slices %g-%g (out of %g) in %g seconds."%(start, end, num_slices, elapsed))
+
+  return crop_info
+
+# ----------------------------------
+# ----------------------------------
+
+def uncrop_label(pred_nifti_path, reference_ct_path, crop_range, output_path = None):
+
+  """
+  Paste a label map inferred on a cropped volume (see `crop_ct_to_region`) back into the
+  geometry of the full CT volume (background everywhere else) - e.g., before the SEG export.
+  Only the header of the full CT volume is read.
+
+  Arguments:
+    pred_nifti_path   : required - path to the label map inferred on the cropped volume.
+    reference_ct_path : required - path to the full CT volume (e.g., `<pat_id>_CT.nii.gz`).
+    crop_range        : required - (start, end) slice indices of the crop (see `crop_ct_to_region`).
+    output_path       : optional - path to the full label map. Defaults to None (`pred_nifti_path`
+                                   is overwritten).
+
+  Returns:
+    output_path : path to the full label map.
+  """
+
+  output_path = output_path if output_path is not None else pred_nifti_path
+
+  reader = sitk.ImageFileReader()
+  reader.SetFileName(reference_ct_path)
+  reader.ReadImageInformation()
+
+  sitk_crop_label = sitk.ReadImage(pred_nifti_path, sitk.sitkUInt8)
+  crop_label_array = sitk.GetArrayViewFromImage(sitk_crop_label)
+
+  start, end = crop_range
+  columns, rows, num_slices = reader.GetSize()
+
+  assert(crop_label_array.shape == (end - start, rows, columns))
+
+  label_array = np.zeros((num_slices, rows, columns), dtype = np.uint8)
+  label_array[start:end] = crop_label_array
+
+  sitk_label = sitk.GetImageFromArray(label_array)
+  sitk_label.SetSpacing(reader.GetSpacing())
+  sitk_label.SetOrigin(reader.GetOrigin())
+  sitk_label.SetDirection(reader.GetDirection())
+
+  volume_writer.write_volume(sitk_label, output_path, output_type = "label")
+
+  return output_path
+
+# ----------------------------------
+# ----------------------------------
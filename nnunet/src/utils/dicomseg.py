@@ -0,0 +1,657 @@
+"""
+    ----------------------------------------
+    IDC-MedImA-misc - DICOM SEG utils
+    ----------------------------------------
+
+    ----------------------------------------
+    Author: Dennis Bontempi
+    Email:  dennis_bontempi@dfci.harvard.edu
+    ----------------------------------------
+
+"""
+
+import os
+import json
+import datetime
+
+import numpy as np
+import pydicom
+import SimpleITK as sitk
+
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.sequence import Sequence
+from pydicom.uid import ExplicitVRLittleEndian, generate_uid
+from pydicom.valuerep import DSfloat
+
+from . import series_index
+from . import volume_writer
+
+SEG_STORAGE = "1.2.840.10008.5.1.4.1.1.66.4"
+
+# attributes copied from the referenced CT (Patient, Study and Clinical Trial modules)
+REFERENCED_ATTRIBUTE_LIST = ["PatientName", "PatientID", "PatientBirthDate", "PatientSex",
+                             "PatientAge", "PatientWeight", "StudyInstanceUID", "StudyDate",
+                             "StudyTime", "StudyID", "AccessionNumber", "ReferringPhysicianName",
+                             "StudyDescription", "ClinicalTrialSponsorName", "ClinicalTrialProtocolID",
+                             "ClinicalTrialProtocolName", "ClinicalTrialSiteID", "ClinicalTrialSiteName",
+                             "ClinicalTrialSubjectID", "ClinicalTrialSubjectReadingID",
+                             "FrameOfReferenceUID", "PositionReferenceIndicator"]
+
+
+def read_ct_geometry(path_to_ct_dir, ct_index = None):
+
+  """
+  Get the geometry of a (sorted) DICOM CT series from its (cached, header-only) series index.
+
+  Arguments:
+    path_to_ct_dir : required - path to the folder storing the DICOM CT slices.
+    ct_index       : optional - series index (see `series_index.build_series_index`). Defaults
+                                to None (built, or loaded from the cache, from `path_to_ct_dir`).
+
+  Returns:
+    ct_geometry : dictionary storing the SOPInstanceUIDs and ImagePositionPatient of the slices
+                  (ordered by the projection of ImagePositionPatient on the slice normal),
+                  the orientation, the pixel spacing, the slice thickness, the number of
+                  rows/columns and the header of the first slice ("reference_dcm").
+  """
+
+  if ct_index is None:
+    ct_index = series_index.build_series_index(path_to_ct_dir)
+
+  # the Patient/Study attributes are copied from the header of the first slice
+  reference_dcm = pydicom.dcmread(os.path.join(path_to_ct_dir, str(ct_index["file_name"][0])),
+                                  stop_before_pixels = True)
+
+  ct_geometry = dict()
+  ct_geometry["sop_instance_uid_list"] = ct_index["sop_instance_uid"].tolist()
+  ct_geometry["sop_class_uid"] = str(ct_index["sop_class_uid"])
+  ct_geometry["series_instance_uid"] = str(ct_index["series_instance_uid"])
+  ct_geometry["image_position_list"] = ct_index["image_position"]
+  ct_geometry["image_orientation"] = ct_index["image_orientation"]
+  ct_geometry["pixel_spacing"] = ct_index["pixel_spacing"].tolist()
+  ct_geometry["slice_thickness"] = float(ct_index["slice_thickness"])
+  ct_geometry["rows"] = int(ct_index["rows"])
+  ct_geometry["columns"] = int(ct_index["columns"])
+  ct_geometry["reference_dcm"] = reference_dcm
+
+  return ct_geometry
+
+# ----------------------------------
+# ----------------------------------
+
+def _ds(value_list):
+
+  """
+  Format a list of floats as Decimal Strings (DS values are limited to 16 characters).
+  """
+
+  return [DSfloat(float(val), auto_format = True) for val in value_list]
+
+# ----------------------------------
+# ----------------------------------
+
+def _code_sequence(code_dict):
+
+  """
+  Build a single-item code sequence from a dcmqi-style code dictionary.
+  """
+
+  code = Dataset()
+  code.CodeValue = code_dict["CodeValue"]
+  code.CodingSchemeDesignator = code_dict["CodingSchemeDesignator"]
+  code.CodeMeaning = code_dict["CodeMeaning"]
+
+  return Sequence([code])
+
+# ----------------------------------
+# ----------------------------------
+
+def _rgb_to_dicom_lab(rgb):
+
+  """
+  Convert an sRGB color (0-255) to the scaled CIELab representation used by DICOM
+  (RecommendedDisplayCIELabValue), like dcmqi does.
+  """
+
+  rgb = np.array(rgb, dtype = np.float64)/255.0
+  rgb = np.where(rgb > 0.04045, ((rgb + 0.055)/1.055)**2.4, rgb/12.92)
+
+  xyz = np.array([[0.4124564, 0.3575761, 0.1804375],
+                  [0.2126729, 0.7151522, 0.0721750],
+                  [0.0193339, 0.1191920, 0.9503041]]) @ rgb
+  xyz /= np.array([0.95047, 1.0, 1.08883])
+
+  f = np.where(xyz > 216/24389, np.cbrt(xyz), (24389/27*xyz + 16)/116)
+
+  lab = np.array([116*f[1] - 16, 500*(f[0] - f[1]), 200*(f[1] - f[2])])
+
+  return [int(round(lab[0]*65535/100)),
+          int(round((lab[1] + 128)*65535/255)),
+          int(round((lab[2] + 128)*65535/255))]
+
+# ----------------------------------
+# ----------------------------------
+
+def _segment_item(segment_number, attributes):
+
+  """
+  Build a SegmentSequence item from the dcmqi-style attributes of a segment.
+  """
+
+  segment = Dataset()
+  segment.SegmentNumber = segment_number
+  segment.SegmentLabel = attributes.get("SegmentLabel",
+                                        attributes["SegmentedPropertyTypeCodeSequence"]["CodeMeaning"])
+  segment.SegmentAlgorithmType = attributes.get("SegmentAlgorithmType", "AUTOMATIC")
+
+  if "SegmentAlgorithmName" in attributes:
+    segment.SegmentAlgorithmName = attributes["SegmentAlgorithmName"]
+
+  if "SegmentDescription" in attributes:
+    segment.SegmentDescription = attributes["SegmentDescription"]
+
+  segment.SegmentedPropertyCategoryCodeSequence = _code_sequence(attributes["SegmentedPropertyCategoryCodeSequence"])
+  segment.SegmentedPropertyTypeCodeSequence = _code_sequence(attributes["SegmentedPropertyTypeCodeSequence"])
+
+  if "SegmentedPropertyTypeModifierCodeSequence" in attributes:
+    segment.SegmentedPropertyTypeCodeSequence[0].SegmentedPropertyTypeModifierCodeSequence = \
+      _code_sequence(attributes["SegmentedPropertyTypeModifierCodeSequence"])
+
+  if "AnatomicRegionSequence" in attributes:
+    segment.AnatomicRegionSequence = _code_sequence(attributes["AnatomicRegionSequence"])
+
+  if "recommendedDisplayRGBValue" in attributes:
+    segment.RecommendedDisplayCIELabValue = _rgb_to_dicom_lab(attributes["recommendedDisplayRGBValue"])
+
+  return segment
+
+# ----------------------------------
+# ----------------------------------
+
+def _per_frame_item(segment_number, slice_idx, ct_geometry, derivation_code, purpose_code):
+
+  """
+  Build a PerFrameFunctionalGroupsSequence item for the frame of `segment_number`
+  at slice `slice_idx` (of the ordered CT series).
+  """
+
+  source_image = Dataset()
+  source_image.ReferencedSOPClassUID = ct_geometry["sop_class_uid"]
+  source_image.ReferencedSOPInstanceUID = ct_geometry["sop_instance_uid_list"][slice_idx]
+  source_image.PurposeOfReferenceCodeSequence = purpose_code
+
+  derivation_image = Dataset()
+  derivation_image.SourceImageSequence = Sequence([source_image])
+  derivation_image.DerivationCodeSequence = derivation_code
+
+  frame_content = Dataset()
+  frame_content.DimensionIndexValues = [segment_number, slice_idx + 1]
+
+  plane_position = Dataset()
+  plane_position.ImagePositionPatient = _ds(ct_geometry["image_position_list"][slice_idx])
+
+  segment_identification = Dataset()
+  segment_identification.ReferencedSegmentNumber = segment_number
+
+  frame = Dataset()
+  frame.DerivationImageSequence = Sequence([derivation_image])
+  frame.FrameContentSequence = Sequence([frame_content])
+  frame.PlanePositionSequence = Sequence([plane_position])
+  frame.SegmentIdentificationSequence = Sequence([segment_identification])
+
+  return frame
+
+# ----------------------------------
+# ----------------------------------
+
+def encode_dicomseg(label_array, ct_geometry, dicomseg_metadata, skip_empty_slices = True):
+
+  """
+  Encode a label map as a (BINARY) DICOM SEG object, in memory. Native alternative to
+  dcmqi's `itkimage2segimage` (see `postprocessing.nrrd_to_dicomseg`).
+
+  Arguments:
+    label_array       : required - integer numpy array (z, y, x) storing the label map, with the
+                                   slices ordered like `ct_geometry["sop_instance_uid_list"]`
+                                   (i.e., the array of a SimpleITK image sharing the CT geometry).
+    ct_geometry       : required - geometry of the referenced CT series (see `read_ct_geometry`).
+    dicomseg_metadata : required - dcmqi-style metadata dictionary (e.g., the content of
+                                   `dicomseg_metadata.json`). Every entry of `segmentAttributes`
+                                   is matched to the label map through its `labelID`.
+    skip_empty_slices : optional - whether to skip the empty frames (like `itkimage2segimage --skip`).
+                                   Segments that are empty altogether are dropped. Defaults to True.
+
+  Returns:
+    dcm_seg : pydicom Dataset storing the DICOM SEG object.
+  """
+
+  num_slices, rows, columns = label_array.shape
+
+  assert(num_slices == len(ct_geometry["sop_instance_uid_list"]))
+  assert(rows == ct_geometry["rows"] and columns == ct_geometry["columns"])
+
+  reference_dcm = ct_geometry["reference_dcm"]
+
+  segment_attributes_list = [attributes for attributes_list in dicomseg_metadata["segmentAttributes"]
+                             for attributes in attributes_list]
+
+  # figure out which slices should be encoded for every segment (vectorized per-slice occupancy)
+  segment_list = list()
+  label_flat = label_array.reshape(num_slices, -1)
+
+  for attributes in segment_attributes_list:
+    occupancy = (label_flat == attributes["labelID"]).any(axis = 1)
+
+    if skip_empty_slices:
+      slice_idx_list = np.flatnonzero(occupancy)
+      if slice_idx_list.size == 0:
+        continue
+    else:
+      slice_idx_list = np.arange(num_slices)
+
+    segment_list.append((attributes, slice_idx_list))
+
+  assert(len(segment_list) > 0)
+
+  now = datetime.datetime.now()
+
+  file_meta = FileMetaDataset()
+  file_meta.MediaStorageSOPClassUID = SEG_STORAGE
+  file_meta.MediaStorageSOPInstanceUID = generate_uid()
+  file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+
+  dcm_seg = Dataset()
+  dcm_seg.file_meta = file_meta
+  dcm_seg.SpecificCharacterSet = "ISO_IR 100"
+  dcm_seg.SOPClassUID = SEG_STORAGE
+  dcm_seg.SOPInstanceUID = file_meta.MediaStorageSOPInstanceUID
+
+  for attribute in REFERENCED_ATTRIBUTE_LIST:
+    if attribute in reference_dcm:
+      setattr(dcm_seg, attribute, reference_dcm.data_element(attribute).value)
+
+  for attribute in ["ClinicalTrialSeriesID", "ClinicalTrialTimePointID",
+                    "ClinicalTrialCoordinatingCenterName"]:
+    if attribute in dicomseg_metadata:
+      setattr(dcm_seg, attribute, dicomseg_metadata[attribute])
+
+  # BodyPartExamined is a code string (upper case only)
+  if "BodyPartExamined" in dicomseg_metadata:
+    dcm_seg.BodyPartExamined = dicomseg_metadata["BodyPartExamined"].upper()
+
+  # General Series, Segmentation Series and General Equipment
+  dcm_seg.Modality = "SEG"
+  dcm_seg.SeriesInstanceUID = generate_uid()
+  dcm_seg.SeriesNumber = dicomseg_metadata.get("SeriesNumber", "1")
+  dcm_seg.SeriesDescription = dicomseg_metadata.get("SeriesDescription", "Segmentation")
+  dcm_seg.SeriesDate = now.strftime("%Y%m%d")
+  dcm_seg.SeriesTime = now.strftime("%H%M%S")
+  dcm_seg.Manufacturer = "IDC"
+  dcm_seg.ManufacturerModelName = "nnU-Net-BPR-annotations"
+  dcm_seg.DeviceSerialNumber = "1"
+  dcm_seg.SoftwareVersions = "1"
+
+  # Segmentation Image
+  dcm_seg.InstanceNumber = dicomseg_metadata.get("InstanceNumber", "1")
+  dcm_seg.ContentDate = now.strftime("%Y%m%d")
+  dcm_seg.ContentTime = now.strftime("%H%M%S")
+  dcm_seg.ContentLabel = dicomseg_metadata.get("ContentLabel", "SEGMENTATION")
+  dcm_seg.ContentDescription = dicomseg_metadata.get("ContentDescription", "")
+  dcm_seg.ContentCreatorName = dicomseg_metadata.get("ContentCreatorName", "")
+  dcm_seg.ImageType = ["DERIVED", "PRIMARY"]
+  dcm_seg.SegmentationType = "BINARY"
+  dcm_seg.LossyImageCompression = "00"
+
+  dcm_seg.SamplesPerPixel = 1
+  dcm_seg.PhotometricInterpretation = "MONOCHROME2"
+  dcm_seg.Rows = rows
+  dcm_seg.Columns = columns
+  dcm_seg.BitsAllocated = 1
+  dcm_seg.BitsStored = 1
+  dcm_seg.HighBit = 0
+  dcm_seg.PixelRepresentation = 0
+
+  # Multi-frame Dimension
+  dimension_organization = Dataset()
+  dimension_organization.DimensionOrganizationUID = generate_uid()
+  dcm_seg.DimensionOrganizationSequence = Sequence([dimension_organization])
+
+  dimension_segment = Dataset()
+  dimension_segment.DimensionOrganizationUID = dimension_organization.DimensionOrganizationUID
+  dimension_segment.DimensionIndexPointer = pydicom.tag.Tag("ReferencedSegmentNumber")
+  dimension_segment.FunctionalGroupPointer = pydicom.tag.Tag("SegmentIdentificationSequence")
+  dimension_segment.DimensionDescriptionLabel = "ReferencedSegmentNumber"
+
+  dimension_position = Dataset()
+  dimension_position.DimensionOrganizationUID = dimension_organization.DimensionOrganizationUID
+  dimension_position.DimensionIndexPointer = pydicom.tag.Tag("ImagePositionPatient")
+  dimension_position.FunctionalGroupPointer = pydicom.tag.Tag("PlanePositionSequence")
+  dimension_position.DimensionDescriptionLabel = "ImagePositionPatient"
+
+  dcm_seg.DimensionIndexSequence = Sequence([dimension_segment, dimension_position])
+
+  # Common Instance Reference
+  referenced_instance_list = list()
+  for sop_instance_uid in ct_geometry["sop_instance_uid_list"]:
+    referenced_instance = Dataset()
+    referenced_instance.ReferencedSOPClassUID = ct_geometry["sop_class_uid"]
+    referenced_instance.ReferencedSOPInstanceUID = sop_instance_uid
+    referenced_instance_list.append(referenced_instance)
+
+  referenced_series = Dataset()
+  referenced_series.SeriesInstanceUID = ct_geometry["series_instance_uid"]
+  referenced_series.ReferencedInstanceSequence = Sequence(referenced_instance_list)
+  dcm_seg.ReferencedSeriesSequence = Sequence([referenced_series])
+
+  # Shared Functional Groups
+  plane_orientation = Dataset()
+  plane_orientation.ImageOrientationPatient = _ds(ct_geometry["image_orientation"])
+
+  pixel_measures = Dataset()
+  pixel_measures.PixelSpacing = _ds(ct_geometry["pixel_spacing"])
+
+  position_all = ct_geometry["image_position_list"]
+  if num_slices > 1:
+    z_vector = np.cross(ct_geometry["image_orientation"][:3], ct_geometry["image_orientation"][3:])
+    pixel_measures.SpacingBetweenSlices = _ds([np.mean(np.diff(position_all @ z_vector))])[0]
+  pixel_measures.SliceThickness = _ds([ct_geometry["slice_thickness"] or pixel_measures.get("SpacingBetweenSlices", 1.0)])[0]
+
+  shared_functional_groups = Dataset()
+  shared_functional_groups.PlaneOrientationSequence = Sequence([plane_orientation])
+  shared_functional_groups.PixelMeasuresSequence = Sequence([pixel_measures])
+  dcm_seg.SharedFunctionalGroupsSequence = Sequence([shared_functional_groups])
+
+  # Segments, Per-frame Functional Groups and Pixel Data
+  derivation_code = _code_sequence({"CodeValue" : "113076", "CodingSchemeDesignator" : "DCM",
+                                    "CodeMeaning" : "Segmentation"})
+  purpose_code = _code_sequence({"CodeValue" : "121322", "CodingSchemeDesignator" : "DCM",
+                                 "CodeMeaning" : "Source image for image processing operation"})
+
+  segment_item_list = list()
+  per_frame_item_list = list()
+  frame_array_list = list()
+
+  for segment_number, (attributes, slice_idx_list) in enumerate(segment_list, start = 1):
+    segment_item_list.append(_segment_item(segment_number, attributes))
+
+    per_frame_item_list += [_per_frame_item(segment_number, int(slice_idx), ct_geometry,
+                                            derivation_code, purpose_code)
+                            for slice_idx in slice_idx_list]
+
+    frame_array_list.append(label_array[slice_idx_list] == attributes["labelID"])
+
+  dcm_seg.SegmentSequence = Sequence(segment_item_list)
+  dcm_seg.PerFrameFunctionalGroupsSequence = Sequence(per_frame_item_list)
+  dcm_seg.NumberOfFrames = len(per_frame_item_list)
+
+  # BINARY frames are bit-packed contiguously (no per-frame padding), LSB first
+  pixel_data = np.packbits(np.concatenate(frame_array_list).ravel(), bitorder = "little").tobytes()
+  if len(pixel_data)%2:
+    pixel_data += b"\x00"
+
+  dcm_seg.PixelData = pixel_data
+  dcm_seg["PixelData"].VR = "OB"
+
+  return dcm_seg
+
+# ----------------------------------
+# ----------------------------------
+
+def label_to_dicomseg(label_array, path_to_ct_dir, dicomseg_json_path, dicom_seg_out_path,
+                      skip_empty_slices = True, ct_geometry = None):
+
+  """
+  Export a DICOM SEG object from a label map stored in memory, without writing any intermediate
+  NRRD file or launching any process (see `postprocessing.nrrd_to_dicomseg` for the dcmqi version).
+
+  Arguments:
+    label_array        : required - integer numpy array (z, y, x) storing the label map
+                                    (see `encode_dicomseg`).
+    path_to_ct_dir     : required - path to the folder storing the referenced DICOM CT slices.
+    dicomseg_json_path : required - path to the dcmqi-style metadata JSON file.
+    dicom_seg_out_path : required - path to the output DICOM SEG file.
+    skip_empty_slices  : optional - whether to skip the empty frames. Defaults to True.
+    ct_geometry        : optional - pre-parsed CT geometry (see `read_ct_geometry`). Defaults
+                                    to None (parsed from `path_to_ct_dir`).
+
+  Returns:
+    dicom_seg_out_path : path to the output DICOM SEG file.
+  """
+
+  if ct_geometry is None:
+    ct_geometry = read_ct_geometry(path_to_ct_dir)
+
+  with open(dicomseg_json_path, "r") as fp:
+    dicomseg_metadata = json.load(fp)
+
+  dcm_seg = encode_dicomseg(label_array = label_array,
+                            ct_geometry = ct_geometry,
+                            dicomseg_metadata = dicomseg_metadata,
+                            skip_empty_slices = skip_empty_slices)
+
+  dcm_seg.save_as(dicom_seg_out_path, enforce_file_format = True)
+
+  return dicom_seg_out_path
+
+# ----------------------------------
+# ----------------------------------
+
+def _frame_attribute(dcm_seg, frame_item, sequence_name, attribute_name):
+
+  """
+  Get an attribute from the per-frame functional groups of a frame, falling back
+  to the shared functional groups.
+  """
+
+  for functional_groups in [frame_item, dcm_seg.SharedFunctionalGroupsSequence[0]]:
+    if sequence_name in functional_groups:
+      return getattr(functional_groups.data_element(sequence_name).value[0], attribute_name)
+
+  return None
+
+# ----------------------------------
+# ----------------------------------
+
+def ct_geometry_to_sitk(ct_geometry):
+
+  """
+  Convert a CT geometry dictionary (see `read_ct_geometry`) to the "spacing", "origin"
+  and "direction" of the corresponding volume (SimpleITK convention, i.e., x, y, z ordering).
+  """
+
+  orientation = np.array(ct_geometry["image_orientation"], dtype = np.float64)
+  z_vector = np.cross(orientation[:3], orientation[3:])
+
+  position_all = np.array(ct_geometry["image_position_list"], dtype = np.float64)
+  z_spacing = float(np.mean(np.diff(position_all @ z_vector))) if len(position_all) > 1 \
+              else (ct_geometry["slice_thickness"] or 1.0)
+
+  geometry = dict()
+  geometry["spacing"] = (ct_geometry["pixel_spacing"][1], ct_geometry["pixel_spacing"][0], z_spacing)
+  geometry["origin"] = tuple(float(val) for val in position_all[0])
+  geometry["direction"] = tuple(np.column_stack([orientation[:3], orientation[3:], z_vector]).flatten().tolist())
+
+  return geometry
+
+# ----------------------------------
+# ----------------------------------
+
+def decode_dicomseg(dcm_seg, ct_geometry = None):
+
+  """
+  Decode a DICOM SEG object in memory. The (bit-packed) PixelData of all the frames is
+  unpacked at once with NumPy, and every frame is placed at its slice position using the
+  per-frame functional groups.
+
+  Arguments:
+    dcm_seg     : required - path to the DICOM SEG file, or pydicom Dataset storing it.
+    ct_geometry : optional - geometry of the referenced CT series (see `read_ct_geometry`).
+                             If specified, the masks are returned on the CT grid (frames are
+                             matched to the CT slices through the referenced SOPInstanceUID, or
+                             their position); otherwise, on the grid spanned by the SEG frames.
+                             Defaults to None.
+
+  Returns:
+    segmask_dict : dictionary of boolean numpy arrays (z, y, x), indexed by SegmentLabel.
+    geometry     : dictionary storing the "spacing", "origin" and "direction" of the
+                   volumes (SimpleITK convention, i.e., x, y, z ordering).
+  """
+
+  if not isinstance(dcm_seg, Dataset):
+    dcm_seg = pydicom.dcmread(dcm_seg)
+
+  num_frames = int(dcm_seg.NumberOfFrames)
+  rows, columns = int(dcm_seg.Rows), int(dcm_seg.Columns)
+
+  if dcm_seg.file_meta.TransferSyntaxUID.is_compressed:
+    frame_array = dcm_seg.pixel_array.reshape(num_frames, rows, columns).astype(bool)
+  elif dcm_seg.BitsAllocated == 1:
+    # BINARY frames are bit-packed contiguously (no per-frame padding), LSB first
+    frame_array = np.unpackbits(np.frombuffer(dcm_seg.PixelData, dtype = np.uint8),
+                                count = num_frames*rows*columns, bitorder = "little")
+    frame_array = frame_array.reshape(num_frames, rows, columns).astype(bool)
+  else:
+    # FRACTIONAL frames (8 bits) - anything above zero is considered part of the segment
+    frame_array = np.frombuffer(dcm_seg.PixelData, dtype = np.uint8,
+                                count = num_frames*rows*columns).reshape(num_frames, rows, columns) > 0
+
+  orientation = np.array(_frame_attribute(dcm_seg, dcm_seg.PerFrameFunctionalGroupsSequence[0],
+                                          "PlaneOrientationSequence", "ImageOrientationPatient"),
+                         dtype = np.float64)
+  z_vector = np.cross(orientation[:3], orientation[3:])
+
+  segment_number_all = np.empty(num_frames, dtype = int)
+  position_all = np.empty((num_frames, 3), dtype = np.float64)
+  sop_instance_uid_all = list()
+
+  for idx, frame_item in enumerate(dcm_seg.PerFrameFunctionalGroupsSequence):
+    segment_number_all[idx] = _frame_attribute(dcm_seg, frame_item, "SegmentIdentificationSequence",
+                                               "ReferencedSegmentNumber")
+    position_all[idx] = _frame_attribute(dcm_seg, frame_item, "PlanePositionSequence",
+                                         "ImagePositionPatient")
+
+    try:
+      sop_instance_uid_all.append(frame_item.DerivationImageSequence[0].SourceImageSequence[0].ReferencedSOPInstanceUID)
+    except (AttributeError, IndexError):
+      sop_instance_uid_all.append(None)
+
+  frame_z_all = position_all @ z_vector
+
+  if ct_geometry is not None:
+    geometry = ct_geometry_to_sitk(ct_geometry)
+    num_slices = len(ct_geometry["sop_instance_uid_list"])
+
+    sop_to_slice = {sop_instance_uid : idx for idx, sop_instance_uid in enumerate(ct_geometry["sop_instance_uid_list"])}
+    ct_z_all = np.array(ct_geometry["image_position_list"], dtype = np.float64) @ z_vector
+
+    # match by SOPInstanceUID where possible, by (closest) position otherwise
+    nearest_slice_all = np.abs(frame_z_all[:, None] - ct_z_all[None, :]).argmin(axis = 1)
+    slice_idx_all = np.array([sop_to_slice.get(sop_instance_uid, nearest)
+                              for sop_instance_uid, nearest in zip(sop_instance_uid_all, nearest_slice_all)])
+  else:
+    pixel_spacing = [float(val) for val in _frame_attribute(dcm_seg, dcm_seg.PerFrameFunctionalGroupsSequence[0],
+                                                              "PixelMeasuresSequence", "PixelSpacing")]
+    unique_z_all = np.unique(frame_z_all)
+
+    # the empty frames may have been skipped - rely on the declared spacing to rebuild the grid
+    pixel_measures = dcm_seg.SharedFunctionalGroupsSequence[0].PixelMeasuresSequence[0] \
+                     if "PixelMeasuresSequence" in dcm_seg.SharedFunctionalGroupsSequence[0] else Dataset()
+
+    if "SpacingBetweenSlices" in pixel_measures:
+      z_spacing = float(pixel_measures.SpacingBetweenSlices)
+    elif len(unique_z_all) > 1:
+      z_spacing = float(np.diff(unique_z_all).min())
+    else:
+      z_spacing = float(getattr(pixel_measures, "SliceThickness", 1.0))
+
+    slice_idx_all = np.rint((frame_z_all - unique_z_all[0])/z_spacing).astype(int)
+    num_slices = int(slice_idx_all.max()) + 1
+
+    origin = position_all[frame_z_all.argmin()]
+
+    geometry = dict()
+    geometry["spacing"] = (pixel_spacing[1], pixel_spacing[0], z_spacing)
+    geometry["origin"] = tuple(float(val) for val in origin)
+    geometry["direction"] = tuple(np.column_stack([orientation[:3], orientation[3:], z_vector]).flatten().tolist())
+
+  segmask_dict = dict()
+
+  for segment in dcm_seg.SegmentSequence:
+    frame_mask = segment_number_all == segment.SegmentNumber
+
+    segmask = np.zeros((num_slices, rows, columns), dtype = bool)
+    segmask[slice_idx_all[frame_mask]] = frame_array[frame_mask]
+
+    segmask_dict[segment.SegmentLabel] = segmask
+
+  return segmask_dict, geometry
+
+# ----------------------------------
+# ----------------------------------
+
+def segmasks_to_label(segmask_dict, label_dict = None):
+
+  """
+  Combine the per-segment masks returned by `decode_dicomseg` into a single label map.
+  Overlapping segments are resolved in favour of the last one.
+
+  Arguments:
+    segmask_dict : required - dictionary of boolean numpy arrays (z, y, x), indexed by SegmentLabel.
+    label_dict   : optional - dictionary mapping every SegmentLabel to a label value. Defaults
+                              to None (labels assigned in order, starting from 1).
+
+  Returns:
+    label_array : uint8 numpy array (z, y, x) storing the label map.
+  """
+
+  if label_dict is None:
+    label_dict = {segment_label : idx + 1 for idx, segment_label in enumerate(segmask_dict)}
+
+  label_array = None
+
+  for segment_label, segmask in segmask_dict.items():
+    if label_array is None:
+      label_array = np.zeros(segmask.shape, dtype = np.uint8)
+
+    label_array[segmask] = label_dict[segment_label]
+
+  return label_array
+
+# ----------------------------------
+# ----------------------------------
+
+def export_segmasks_nrrd(segmask_dict, geometry, path_to_output_dir):
+
+  """
+  Optional NRRD sink for `decode_dicomseg`: write one `<SegmentLabel>.nrrd` file per segment
+  (same naming as `postprocessing.dicomseg_to_nrrd` with `rename_nrrd = True`).
+
+  Arguments:
+    segmask_dict       : required - dictionary of boolean numpy arrays (z, y, x), indexed by SegmentLabel.
+    geometry           : required - dictionary storing the "spacing", "origin" and "direction" of the volumes.
+    path_to_output_dir : required - path to the folder where the NRRD files will be written.
+
+  Returns:
+    nrrd_path_list : list of the paths to the NRRD files.
+  """
+
+  if not os.path.exists(path_to_output_dir):
+    os.mkdir(path_to_output_dir)
+
+  nrrd_path_list = list()
+
+  for segment_label, segmask in segmask_dict.items():
+    sitk_mask = sitk.GetImageFromArray(segmask.astype(np.uint8))
+    sitk_mask.SetSpacing(geometry["spacing"])
+    sitk_mask.SetOrigin(geometry["origin"])
+    sitk_mask.SetDirection(geometry["direction"])
+
+    nrrd_path = os.path.join(path_to_output_dir, "%s.nrrd"%(segment_label))
+    volume_writer.write_volume(sitk_mask, nrrd_path, output_type = "label")
+
+    nrrd_path_list.append(nrrd_path)
+
+  return nrrd_path_list
+
+# ----------------------------------
+# ----------------------------------
@@ -0,0 +1,241 @@
+"""
+    ----------------------------------------
+    IDC-MedImA-misc - model ensembling utils
+    ----------------------------------------
+
+    ----------------------------------------
+    Author: Dennis Bontempi
+    Email:  dennis_bontempi@dfci.harvard.edu
+    ----------------------------------------
+
+"""
+
+import os
+import time
+import shutil
+import struct
+import zipfile
+import tempfile
+
+import numpy as np
+import SimpleITK as sitk
+
+from . import postprocessing
+from . import instrumentation
+from . import volume_writer
+
+
+def _read_npy_header(fp):
+
+  """
+  Parse the header of a `.npy` stream, leaving `fp` at the start of the array data.
+  """
+
+  version = np.lib.format.read_magic(fp)
+
+  if version == (1, 0):
+    return np.lib.format.read_array_header_1_0(fp)
+  else:
+    return np.lib.format.read_array_header_2_0(fp)
+
+# ----------------------------------
+# ----------------------------------
+
+def open_npz_memmap(npz_path, spill_dir, key = "softmax"):
+
+  """
+  Memory-map a (C, z, y, x) array stored in a `.npz` file, so that it can be read slab by slab.
+  If the archive member is stored uncompressed (`np.savez`), the array is mapped in place;
+  otherwise (e.g., `nnUNet_predict --save_npz`, which uses `np.savez_compressed`) it is
+  decompressed once - one channel at a time - to an uncompressed `.npy` file under `spill_dir`.
+
+  Arguments:
+    npz_path  : required - path to the `.npz` file.
+    spill_dir : required - path to the folder where the decompressed copy is written (if needed).
+    key       : optional - name of the array in the `.npz` file. Defaults to "softmax".
+
+  Returns:
+    array : read-only `np.memmap` storing the array.
+  """
+
+  with zipfile.ZipFile(npz_path) as npz_file:
+    member_info = npz_file.getinfo(key + ".npy")
+
+    with npz_file.open(member_info) as fp:
+      shape, fortran_order, dtype = _read_npy_header(fp)
+
+  assert(not fortran_order and not dtype.hasobject)
+
+  if member_info.compress_type == zipfile.ZIP_STORED:
+    with open(npz_path, "rb") as fp:
+      # skip the local file header (its extra field can differ from the central directory one)
+      fp.seek(member_info.header_offset)
+      local_header = fp.read(30)
+      name_length, extra_length = struct.unpack("<HH", local_header[26:30])
+      fp.seek(member_info.header_offset + 30 + name_length + extra_length)
+
+      _read_npy_header(fp)
+      data_offset = fp.tell()
+
+    return np.memmap(npz_path, dtype = dtype, mode = "r", offset = data_offset, shape = shape)
+
+  spill_fd, spill_path = tempfile.mkstemp(suffix = ".npy", dir = spill_dir)
+  os.close(spill_fd)
+
+  array = np.lib.format.open_memmap(spill_path, mode = "w+", dtype = dtype, shape = shape)
+
+  for channel, channel_array in enumerate(postprocessing.iter_npz_channels(npz_path, key = key)):
+    array[channel] = channel_array
+
+  array.flush()
+  del array
+
+  return np.load(spill_path, mmap_mode = "r")
+
+# ----------------------------------
+# ----------------------------------
+
+def ensemble_softmax(npz_path_list, output_label_path, reference_image_path, output_softmax_path = None,
+                     weights = None, slab_size = 16, spill_dir = None):
+
+  """
+  Ensemble the softmax probability maps inferred by different models (e.g., the nnU-Net `2d`,
+  `3d_lowres`, `3d_fullres` and `3d_cascade_fullres` configurations) for the same volume, by
+  (weighted) averaging. The inputs are memory-mapped (see `open_npz_memmap`) and merged one
+  slab of `slab_size` slices at a time, so that at most one slab per model (and the running
+  sum) is held in memory, instead of a full float softmax per model.
+
+  Arguments:
+    npz_path_list        : required - list of the paths to the `.npz` files storing the softmax
+                                      probabilities (`<pat_id>.npz`, exported with `--save_npz`).
+    output_label_path    : required - path to the output label map (e.g., `<pat_id>.nii.gz`).
+    reference_image_path : required - path to a volume sharing the geometry of the softmax maps
+                                      (e.g., the input `<pat_id>_0000.nii.gz`, or the label map
+                                      inferred by one of the models). Only the header is read.
+    output_softmax_path  : optional - path to the averaged softmax `.npz` file (float16, like
+                                      nnU-Net's). Defaults to None (not exported).
+    weights              : optional - list of the weights of the models. Defaults to None (plain average).
+    slab_size            : optional - number of slices merged at once. Defaults to 16.
+    spill_dir            : optional - path to the folder where the decompressed softmax maps are
+                                      written (and deleted afterwards). Defaults to the folder of
+                                      `output_label_path`.
+
+  Returns:
+    output_label_path : path to the output label map.
+  """
+
+  weights = weights if weights is not None else [1.0]*len(npz_path_list)
+  assert(len(weights) == len(npz_path_list) and len(npz_path_list) > 0)
+
+  reader = sitk.ImageFileReader()
+  reader.SetFileName(reference_image_path)
+  reader.ReadImageInformation()
+
+  spill_dir = tempfile.mkdtemp(prefix = "ensemble_", dir = spill_dir if spill_dir is not None
+                                                     else os.path.dirname(os.path.abspath(output_label_path)))
+
+  softmax_list = list()
+
+  try:
+    softmax_list = [open_npz_memmap(npz_path, spill_dir) for npz_path in npz_path_list]
+
+    softmax_shape = softmax_list[0].shape
+    num_channels, num_slices = softmax_shape[:2]
+
+    for npz_path, softmax in zip(npz_path_list, softmax_list):
+      assert(softmax.shape == softmax_shape), "%s: shape %s, expected %s"%(npz_path, softmax.shape, softmax_shape)
+
+    # SimpleITK size (x, y, z) - the softmax maps are (C, z, y, x)
+    assert(softmax_shape[1:] == tuple(reversed(reader.GetSize())))
+
+    label_array = np.zeros(softmax_shape[1:], dtype = np.uint8)
+
+    if output_softmax_path is not None:
+      mean_softmax = np.lib.format.open_memmap(os.path.join(spill_dir, "softmax.npy"), mode = "w+",
+                                               dtype = np.float16, shape = softmax_shape)
+
+    for slab_start in range(0, num_slices, slab_size):
+      slab_end = min(slab_start + slab_size, num_slices)
+
+      softmax_sum = np.zeros((num_channels, slab_end - slab_start) + softmax_shape[2:], dtype = np.float32)
+
+      for softmax, weight in zip(softmax_list, weights):
+        slab = softmax[:, slab_start:slab_end].astype(np.float32)
+        slab *= weight
+        softmax_sum += slab
+        del slab
+
+      label_array[slab_start:slab_end] = softmax_sum.argmax(axis = 0)
+
+      if output_softmax_path is not None:
+        softmax_sum /= sum(weights)
+        mean_softmax[:, slab_start:slab_end] = softmax_sum
+
+    sitk_label = sitk.GetImageFromArray(label_array)
+    sitk_label.SetSpacing(reader.GetSpacing())
+    sitk_label.SetOrigin(reader.GetOrigin())
+    sitk_label.SetDirection(reader.GetDirection())
+
+    volume_writer.write_volume(sitk_label, output_label_path, output_type = "label")
+
+    if output_softmax_path is not None:
+      # `np.savez_compressed` streams the memory-mapped array to the archive in chunks
+      mean_softmax.flush()
+      np.savez_compressed(output_softmax_path, softmax = mean_softmax)
+      del mean_softmax
+
+  finally:
+    del softmax_list
+    shutil.rmtree(spill_dir)
+
+  return output_label_path
+
+# ----------------------------------
+# ----------------------------------
+
+@instrumentation.instrumented("ensemble", series_arg = "pat_id")
+def ensemble_patient(model_output_folder_list, ensemble_output_folder, pat_id, weights = None,
+                     export_prob_maps = False, slab_size = 16):
+
+  """
+  Ensemble the predictions of several nnU-Net configurations for a patient - e.g., the ones of
+  `processing.process_patient_nnunet` run with `export_prob_maps = True` and a different
+  `model_output_folder` per configuration (see `ensemble_softmax`).
+
+  Arguments:
+    model_output_folder_list : required - list of the paths to the folders storing the outputs of
+                                          each model (`<pat_id>.nii.gz` and `<pat_id>.npz`).
+    ensemble_output_folder   : required - path to the folder where the ensembled segmentation mask
+                                          (`<pat_id>.nii.gz`) will be stored.
+    pat_id                   : required - patient ID (used for naming purposes).
+    weights                  : optional - list of the weights of the models. Defaults to None (plain average).
+    export_prob_maps         : optional - whether to export or not the averaged softmax probabilities
+                                          (`<pat_id>.npz`). Defaults to False.
+    slab_size                : optional - number of slices merged at once. Defaults to 16.
+
+  Returns:
+    pred_nifti_path : path to the ensembled segmentation mask.
+  """
+
+  if not os.path.exists(ensemble_output_folder):
+    os.makedirs(ensemble_output_folder)
+
+  pred_nifti_path = os.path.join(ensemble_output_folder, pat_id + ".nii.gz")
+
+  start_time = time.time()
+  print("Ensembling the predictions of %g models..."%(len(model_output_folder_list)))
+
+  ensemble_softmax(npz_path_list = [os.path.join(model_output_folder, pat_id + ".npz")
+                                    for model_output_folder in model_output_folder_list],
+                   output_label_path = pred_nifti_path,
+                   reference_image_path = os.path.join(model_output_folder_list[0], pat_id + ".nii.gz"),
+                   output_softmax_path = os.path.join(ensemble_output_folder, pat_id + ".npz") if export_prob_maps else None,
+                   weights = weights, slab_size = slab_size)
+
+  elapsed = time.time() - start_time
+  print("Done in %g seconds."%elapsed)
+
+  return pred_nifti_path
+
+# ----------------------------------
+# ----------------------------------
@@ -12,9 +12,17 @@
 
 import os
 import json
+import time
 import numpy as np
 import pandas as pd
 
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from . import metrics
+from . import dicomseg
+from . import rtstruct
+
 def dc_dict_to_df(dc_dict, structure_name):
     
   """
@@ -110,4 +118,251 @@ def hd_dict_to_df(hd_dict, structure_name):
   
 
 # ----------------------------------
-# ----------------------------------
\ No newline at end of file
+# ----------------------------------
+
+def eval_patient_from_nrrd_dirs(pat_id, processed_nrrd_path,
+                                manual_seg_folder_name = "manual_seg",
+                                pred_seg_folder_name = "pred_seg"):
+
+  """
+  Compute the evaluation metrics for a single patient whose reference and predicted
+  segmentation masks were already exported to NRRD (see `postprocessing.dicomseg_to_nrrd`).
+
+  Arguments:
+    pat_id                 : required - patient ID.
+    processed_nrrd_path    : required - path to the folder where the preprocessed NRRD data are stored.
+    manual_seg_folder_name : optional - name of the subfolder (under the patient directory) storing
+                                        the reference NRRD masks. Defaults to "manual_seg".
+    pred_seg_folder_name   : optional - name of the subfolder (under the patient directory) storing
+                                        the predicted NRRD masks. Defaults to "pred_seg".
+
+  Returns:
+    pat_dc_dict : dictionary storing the Dice Coefficient results for each structure.
+    pat_hd_dict : dictionary storing the Hausdorff Distance results for each structure.
+  """
+
+  pat_dir_nrrd_path = os.path.join(processed_nrrd_path, pat_id)
+
+  return metrics.eval_patient_nrrd(manual_seg_folder_path = os.path.join(pat_dir_nrrd_path, manual_seg_folder_name),
+                                   pred_seg_folder_path = os.path.join(pat_dir_nrrd_path, pred_seg_folder_name))
+
+# ----------------------------------
+# ----------------------------------
+
+def eval_patient_from_dicomseg(manual_dicomseg_path, pred_dicomseg_path, path_to_ct_dir,
+                               ct_geometry = None):
+
+  """
+  Compute the evaluation metrics for a single patient straight from the reference and the
+  predicted DICOM SEG objects - decoded in memory on the CT grid, with no NRRD round trip.
+
+  Arguments:
+    manual_dicomseg_path : required - path to the reference DICOM SEG file.
+    pred_dicomseg_path   : required - path to the predicted DICOM SEG file.
+    path_to_ct_dir       : required - path to the folder storing the referenced DICOM CT slices.
+    ct_geometry          : optional - pre-parsed CT geometry (see `dicomseg.read_ct_geometry`).
+                                      Defaults to None (parsed from `path_to_ct_dir`).
+
+  Returns:
+    pat_dc_dict : dictionary storing the Dice Coefficient results for each structure.
+    pat_hd_dict : dictionary storing the Hausdorff Distance results for each structure.
+  """
+
+  if ct_geometry is None:
+    ct_geometry = dicomseg.read_ct_geometry(path_to_ct_dir)
+
+  ref_segmask_dict, geometry = dicomseg.decode_dicomseg(manual_dicomseg_path, ct_geometry = ct_geometry)
+  cmp_segmask_dict, _ = dicomseg.decode_dicomseg(pred_dicomseg_path, ct_geometry = ct_geometry)
+
+  return metrics.compute_patient_metrics(ref_segmask_dict = ref_segmask_dict,
+                                         cmp_segmask_dict = cmp_segmask_dict,
+                                         geometry = geometry)
+
+# ----------------------------------
+# ----------------------------------
+
+def eval_patient_from_rtstruct(path_to_rtstruct_file, pred_dicomseg_path, path_to_ct_dir,
+                               roi_name_dict, ct_geometry = None):
+
+  """
+  Compute the evaluation metrics for a single patient straight from the reference DICOM RTSTRUCT
+  (rasterized in memory, only for the evaluated ROIs - see `rtstruct.rasterize_rtstruct`) and the
+  predicted DICOM SEG object.
+
+  Arguments:
+    path_to_rtstruct_file : required - path to the reference DICOM RTSTRUCT file.
+    pred_dicomseg_path    : required - path to the predicted DICOM SEG file.
+    path_to_ct_dir        : required - path to the folder storing the referenced DICOM CT slices.
+    roi_name_dict         : required - dictionary mapping the names of the ROIs to evaluate to the
+                                       corresponding SegmentLabel (e.g., {"Esophagus" : "Esophagus",
+                                       "Heart" : "Heart"}). ROI names are case-insensitive.
+    ct_geometry           : optional - pre-parsed CT geometry (see `dicomseg.read_ct_geometry`).
+                                       Defaults to None (parsed from `path_to_ct_dir`).
+
+  Returns:
+    pat_dc_dict : dictionary storing the Dice Coefficient results for each structure.
+    pat_hd_dict : dictionary storing the Hausdorff Distance results for each structure.
+  """
+
+  if ct_geometry is None:
+    ct_geometry = dicomseg.read_ct_geometry(path_to_ct_dir)
+
+  roi_segmask_dict, geometry = rtstruct.rasterize_rtstruct(path_to_rtstruct_file,
+                                                           roi_name_list = list(roi_name_dict.keys()),
+                                                           ct_geometry = ct_geometry)
+  cmp_segmask_dict, _ = dicomseg.decode_dicomseg(pred_dicomseg_path, ct_geometry = ct_geometry)
+
+  segment_label_dict = {roi_name.strip().lower() : segment_label for roi_name, segment_label in roi_name_dict.items()}
+  ref_segmask_dict = {segment_label_dict[roi_name.strip().lower()] : segmask for roi_name, segmask in roi_segmask_dict.items()}
+
+  return metrics.compute_patient_metrics(ref_segmask_dict = ref_segmask_dict,
+                                         cmp_segmask_dict = cmp_segmask_dict,
+                                         geometry = geometry)
+
+# ----------------------------------
+# ----------------------------------
+
+def load_eval_manifest(manifest_path):
+
+  """
+  Parse the (append-only, JSONL) evaluation manifest written by `eval_cohort`.
+
+  Arguments:
+    manifest_path : required - path to the JSONL manifest file.
+
+  Returns:
+    dc_dict : dictionary storing the Dice Coefficient results of all the patients evaluated
+              successfully (see `dc_dict_to_df` for the format).
+    hd_dict : dictionary storing the Hausdorff Distance results of all the patients evaluated
+              successfully (see `hd_dict_to_df` for the format).
+    failed  : list of the patients for which the evaluation failed (and that will be
+              processed again at the next `eval_cohort` call).
+  """
+
+  dc_dict = dict()
+  hd_dict = dict()
+  failed = list()
+
+  if not os.path.exists(manifest_path):
+    return dc_dict, hd_dict, failed
+
+  with open(manifest_path, "r") as fp:
+    for line in fp:
+      # a truncated last line (e.g., the VM was preempted mid-write) is simply ignored
+      try:
+        record = json.loads(line)
+      except ValueError:
+        continue
+
+      pat_id = record["PatientID"]
+
+      if record["status"] == "done":
+        dc_dict[pat_id] = record["dc"]
+        hd_dict[pat_id] = record["hd"]
+
+        if pat_id in failed:
+          failed.remove(pat_id)
+      elif pat_id not in dc_dict and pat_id not in failed:
+        failed.append(pat_id)
+
+  return dc_dict, hd_dict, failed
+
+# ----------------------------------
+# ----------------------------------
+
+def _eval_patient_worker(eval_patient_fn, pat_id):
+
+  """
+  Run `eval_patient_fn` for a single patient, and format the result as a manifest record.
+  """
+
+  start_time = time.time()
+
+  try:
+    pat_dc_dict, pat_hd_dict = eval_patient_fn(pat_id)
+    record = {"PatientID" : pat_id, "status" : "done",
+              "dc" : pat_dc_dict, "hd" : pat_hd_dict}
+  except Exception as e:
+    record = {"PatientID" : pat_id, "status" : "failed", "error" : repr(e)}
+
+  record["elapsed"] = time.time() - start_time
+
+  return record
+
+# ----------------------------------
+# ----------------------------------
+
+def eval_cohort(pat_id_list, manifest_path, eval_patient_fn = None,
+                processed_nrrd_path = None, num_workers = None):
+
+  """
+  Run the evaluation for a whole cohort, distributing the patients across a pool of processes.
+  Each result is appended to a local JSONL manifest as soon as it is available, so that an
+  interrupted run can be resumed without listing or downloading anything from the bucket.
+
+  Arguments:
+    pat_id_list         : required - list of the IDs of the patients to evaluate.
+    manifest_path       : required - path to the JSONL manifest file (created if it does not exist).
+    eval_patient_fn     : optional - picklable function (e.g., a module-level function or a
+                                     `functools.partial`) that takes a patient ID and returns
+                                     a `(pat_dc_dict, pat_hd_dict)` tuple. Defaults to
+                                     `eval_patient_from_nrrd_dirs` over `processed_nrrd_path`.
+    processed_nrrd_path : optional - path to the folder where the preprocessed NRRD data are stored.
+                                     Required if `eval_patient_fn` is not specified.
+    num_workers         : optional - number of worker processes. Defaults to the number of CPUs.
+
+  Returns:
+    dc_dict : dictionary storing the Dice Coefficient results of all the patients in the
+              manifest, ready to be parsed by `dc_dict_to_df`.
+    hd_dict : dictionary storing the Hausdorff Distance results of all the patients in the
+              manifest, ready to be parsed by `hd_dict_to_df`.
+  """
+
+  if eval_patient_fn is None:
+    assert(processed_nrrd_path is not None)
+    eval_patient_fn = partial(eval_patient_from_nrrd_dirs,
+                              processed_nrrd_path = processed_nrrd_path)
+
+  dc_dict, hd_dict, _ = load_eval_manifest(manifest_path)
+
+  pat_to_eval_id_list = [pat_id for pat_id in pat_id_list if pat_id not in dc_dict]
+
+  print("Found %g patients already evaluated in %s."%(len(pat_id_list) - len(pat_to_eval_id_list),
+                                                      manifest_path))
+  print("Computing evaluation metrics for %g patients..."%(len(pat_to_eval_id_list)))
+
+  if len(pat_to_eval_id_list) == 0:
+    return dc_dict, hd_dict
+
+  start_time = time.time()
+
+  with ProcessPoolExecutor(max_workers = num_workers) as executor, \
+       open(manifest_path, "a") as fp:
+
+    future_list = [executor.submit(_eval_patient_worker, eval_patient_fn, pat_id)
+                   for pat_id in pat_to_eval_id_list]
+
+    for idx, future in enumerate(as_completed(future_list)):
+      record = future.result()
+
+      # the manifest is written by the parent process only - no locking needed
+      fp.write(json.dumps(record) + "\n")
+      fp.flush()
+      os.fsync(fp.fileno())
+
+      if record["status"] == "done":
+        dc_dict[record["PatientID"]] = record["dc"]
+        hd_dict[record["PatientID"]] = record["hd"]
+      else:
+        print("Evaluation failed for patient %s: %s"%(record["PatientID"], record["error"]))
+
+      print("(%g/%g) Patient %s evaluated in %g seconds."%(idx + 1, len(future_list),
+                                                           record["PatientID"], record["elapsed"]))
+
+  elapsed = time.time() - start_time
+  print("Done in %g seconds."%elapsed)
+
+  return dc_dict, hd_dict
+
+# ----------------------------------
+# ----------------------------------
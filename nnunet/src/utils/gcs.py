@@ -12,17 +12,259 @@
 
 import os
 import time
+import random
 import shutil
-import subprocess
+import tempfile
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
 
 from google.cloud import storage
 
+from . import sorting
+from . import instrumentation
+
+
+def _split_gs_uri(gs_uri):
+
+  """
+  Split a GS URI (gs://bucket/path/to/blob) into bucket name and blob name.
+  """
+
+  assert(gs_uri.startswith("gs://"))
+
+  bucket_name, _, blob_name = gs_uri[len("gs://"):].partition("/")
+
+  return bucket_name, blob_name
+
+# ----------------------------------
+# ----------------------------------
+
+class GCSBackend:
+
+  """
+  Download objects from Google Cloud Storage, sharing a single `storage.Client`
+  (created lazily, on first use) across all the download workers.
+  """
+
+  def __init__(self, project_name = None):
+    self.project_name = project_name
+    self._client = None
+    self._lock = threading.Lock()
+
+  def client(self):
+    with self._lock:
+      if self._client is None:
+        self._client = storage.Client(project = self.project_name)
+    return self._client
+
+  def download(self, gs_uri, local_path):
+    bucket_name, blob_name = _split_gs_uri(gs_uri)
+    client = self.client()
+    client.bucket(bucket_name).blob(blob_name).download_to_filename(local_path, client = client)
+
+  def list_blobs(self, bucket_name, prefix):
+    return [blob.name for blob in self.client().list_blobs(bucket_name, prefix = prefix)]
+
+  def blob_exists(self, gs_uri):
+    bucket_name, blob_name = _split_gs_uri(gs_uri)
+    client = self.client()
+    return client.bucket(bucket_name).blob(blob_name).exists(client = client)
+
+# ----------------------------------
+# ----------------------------------
+
+class LocalBackend:
+
+  """
+  Stand-in for `GCSBackend` (e.g., for testing purposes): the object at gs://bucket/path
+  is read from `root_path`/bucket/path on the local filesystem.
+  """
+
+  def __init__(self, root_path):
+    self.root_path = root_path
+
+  def download(self, gs_uri, local_path):
+    bucket_name, blob_name = _split_gs_uri(gs_uri)
+    shutil.copyfile(os.path.join(self.root_path, bucket_name, blob_name), local_path)
+
+  def list_blobs(self, bucket_name, prefix):
+
+    bucket_path = os.path.join(self.root_path, bucket_name)
+
+    # only walk the deepest folder the prefix is guaranteed to be in
+    blob_list = list()
+    for root, _, fn_list in os.walk(os.path.join(bucket_path, os.path.dirname(prefix))):
+      for fn in fn_list:
+        blob_name = os.path.relpath(os.path.join(root, fn), bucket_path).replace(os.sep, "/")
+        if blob_name.startswith(prefix):
+          blob_list.append(blob_name)
+
+    return sorted(blob_list)
+
+  def blob_exists(self, gs_uri):
+    bucket_name, blob_name = _split_gs_uri(gs_uri)
+    return os.path.isfile(os.path.join(self.root_path, bucket_name, blob_name))
+
+# ----------------------------------
+# ----------------------------------
+
+def _download_object(backend, gs_uri, download_path, max_retries = 5, backoff = 1.0,
+                     sorted_base_path = None, move = True):
+
+  """
+  Download a single object to `download_path`, retrying with exponential backoff (and jitter).
+  The object is first written to a temporary file, so that partial downloads are never
+  mistaken for complete ones. If `sorted_base_path` is specified, the file is sorted
+  (see `sorting.sort_dicom_file`) by the same worker as soon as it lands.
+  """
+
+  local_path = os.path.join(download_path, os.path.basename(gs_uri))
+  part_path = local_path + ".part"
+
+  for attempt in range(max_retries + 1):
+    try:
+      backend.download(gs_uri, part_path)
+      os.replace(part_path, local_path)
+      break
+
+    except Exception as e:
+      if os.path.exists(part_path): os.remove(part_path)
+
+      if attempt == max_retries:
+        raise
+
+      wait_time = backoff*(2**attempt)*random.uniform(0.5, 1.5)
+      print("Download of %s failed (%s), retrying in %.1f seconds..."%(gs_uri, e, wait_time))
+      time.sleep(wait_time)
+
+  if sorted_base_path is not None:
+    return sorting.sort_dicom_file(local_path, sorted_base_path, move = move)
+
+  return local_path
+
+# ----------------------------------
+# ----------------------------------
+
+def _submit_series_download(executor, backend, series_df, raw_base_path, series_id,
+                            max_retries, backoff, sorted_base_path, move):
+
+  """
+  Create the temporary folder for a series and submit the download of all its objects.
+  """
+
+  download_path = tempfile.mkdtemp(prefix = "%s_"%(series_id), dir = raw_base_path)
+
+  future_list = [executor.submit(_download_object, backend, gs_uri, download_path,
+                                 max_retries, backoff, sorted_base_path, move)
+                 for gs_uri in series_df["gcs_url"].values]
+
+  return download_path, future_list
+
+# ----------------------------------
+# ----------------------------------
+
+def download_cohort(cohort_df, raw_base_path, backend = None, group_by = "SeriesInstanceUID",
+                    num_workers = 16, prefetch = 1, max_retries = 5, backoff = 1.0,
+                    remove_raw = True, sorted_base_path = None):
+
+  """
+  Download the raw DICOM data for a whole cohort, one series (or patient) at a time.
+  All the objects are fetched by a bounded pool of concurrent workers sharing the same
+  client, and the following `prefetch` series are downloaded in the background while
+  the current one is being processed (e.g., inferred) by the caller.
+
+  Arguments:
+    cohort_df        : required - Pandas dataframe (returned from BQ) storing the `gcs_url` of every
+                                  object to download (and the `group_by` column).
+    raw_base_path    : required - path to the folder where the per-series temporary folders will be created.
+    backend          : optional - object exposing a `download(gs_uri, local_path)` method
+                                  (`GCSBackend` or `LocalBackend`). Defaults to `GCSBackend()`.
+    group_by         : optional - column used to group the objects. Defaults to "SeriesInstanceUID".
+    num_workers      : optional - maximum number of concurrent downloads. Defaults to 16.
+    prefetch         : optional - number of series to download ahead of the one being processed.
+                                  Defaults to 1.
+    max_retries      : optional - number of retries for every object before giving up. Defaults to 5.
+    backoff          : optional - base backoff time (in seconds) between retries. Defaults to 1.
+    remove_raw       : optional - whether to remove the temporary folder of a series once the caller
+                                  asks for the next one. Defaults to True.
+    sorted_base_path : optional - if specified, every file is sorted into `sorted_base_path`/
+                                  %PatientID/%Modality/%SOPInstanceUID.dcm as soon as it is
+                                  downloaded - moved if `remove_raw` is True, hard-linked otherwise.
+                                  Defaults to None (no sorting).
+
+  Yields:
+    series_id     : value of the `group_by` column for the series.
+    series_df     : subset of `cohort_df` describing the series.
+    download_path : path to the temporary folder storing the series raw DICOM data.
+  """
+
+  if backend is None:
+    backend = GCSBackend()
+
+  if not os.path.exists(raw_base_path):
+    os.makedirs(raw_base_path)
+
+  series_list = [(series_id, series_df) for series_id, series_df in cohort_df.groupby(group_by, sort = False)]
+
+  with ThreadPoolExecutor(max_workers = num_workers) as executor:
+
+    # the pool is FIFO, so the objects of a series are always fetched before
+    # the objects of the series submitted after it
+    pending = list()
+    next_idx = 0
+
+    try:
+      for idx, (series_id, series_df) in enumerate(series_list):
+
+        while next_idx < len(series_list) and next_idx <= idx + prefetch:
+          pending.append(_submit_series_download(executor, backend, series_list[next_idx][1],
+                                                 raw_base_path, series_list[next_idx][0],
+                                                 max_retries, backoff, sorted_base_path,
+                                                 remove_raw))
+          next_idx += 1
+
+        download_path, future_list = pending[0]
+
+        start_time = time.time()
+        print("Waiting for %g files to be copied to %s..."%(len(future_list), download_path))
 
+        for future in future_list:
+          future.result()
+
+        elapsed = time.time() - start_time
+        print("Done in %g seconds."%elapsed)
+
+        yield series_id, series_df, download_path
+
+        pending.pop(0)
+
+        if remove_raw:
+          shutil.rmtree(download_path)
+
+    finally:
+      # the caller stopped early (or a download failed) - drop the prefetched series too
+      for download_path, future_list in pending:
+        for future in future_list:
+          future.cancel()
+
+      executor.shutdown(wait = True)
+
+      if remove_raw:
+        for download_path, _ in pending:
+          shutil.rmtree(download_path, ignore_errors = True)
+
+# ----------------------------------
+# ----------------------------------
+
+@instrumentation.instrumented("download")
 def download_patient_data(raw_base_path, sorted_base_path,
-                          patient_df, remove_raw = True):
+                          patient_df, remove_raw = True, backend = None,
+                          num_workers = 16):
 
   """
-  Download raw DICOM data and run dicomsort to standardise the input format.
+  Download raw DICOM data and sort it to standardise the input format
+  (`sorted_base_path`/%PatientID/%Modality/%SOPInstanceUID.dcm).
 
   Arguments:
     raw_base_path    : required - path to the folder where the raw data will be stored.
@@ -30,64 +272,228 @@ def download_patient_data(raw_base_path, sorted_base_path,
     patient_df       : required - Pandas dataframe (returned from BQ) storing all the
                                   patient information required to pull data from the IDC buckets.
     remove_raw       : optional - whether to remove or not the raw non-sorted data
-                                  (after sorting with dicomsort). Defaults to True.
+                                  (after sorting). Defaults to True.
+    backend          : optional - download backend (see `download_cohort`). Defaults to `GCSBackend()`.
+    num_workers      : optional - maximum number of concurrent downloads. Defaults to 16.
   
   Outputs:
     This function [...]
   """
 
-  # FIXME: this gets overwritten every single time; use `tempfile` library?
-  gs_file_path = "gcs_paths.txt"
-  patient_df["gcs_url"].to_csv(gs_file_path, header = False, index = False)
-
   pat_id = patient_df["PatientID"].values[0]
-  download_path = os.path.join(raw_base_path, pat_id)
 
-  if not os.path.exists(download_path):
-    os.mkdir(download_path)
+  # every file is sorted by the download workers as soon as it lands - with `remove_raw`
+  # the files are moved (not copied), so the raw data never takes up disk space twice
+  for _ in download_cohort(cohort_df = patient_df,
+                           raw_base_path = raw_base_path,
+                           backend = backend,
+                           group_by = "PatientID",
+                           num_workers = num_workers,
+                           prefetch = 0,
+                           remove_raw = remove_raw,
+                           sorted_base_path = sorted_base_path):
+    pass
+
+  print("Sorted DICOM data saved at: %s"%(os.path.join(sorted_base_path, pat_id)))
+
+# ----------------------------------
+# ----------------------------------
 
-  start_time = time.time()
-  print("Copying files from IDC buckets to %s..."%(download_path))
 
-  bash_command = list()
-  bash_command += ["cat", "%s"%gs_file_path]
+class BucketIndex:
 
-  ps = subprocess.Popen(bash_command, stdout = subprocess.PIPE)
+  """
+  Cached view of the content of the buckets: the listings of the prefixes queried are kept
+  for `ttl` seconds, so that existence checks (e.g., "was this series already processed?")
+  issued in per-patient loops are answered locally instead of with one request each. The
+  cache can be invalidated explicitly (e.g., after uploading new objects).
+  """
 
-  bash_command = list()
-  bash_command = ["gsutil", "-q", "-m", "cp", "-Ir", "%s"%download_path]
+  def __init__(self, backend = None, ttl = 300):
 
-  bash_return = subprocess.check_output(bash_command, stdin = ps.stdout)
-  ps.wait()
+    """
+    Arguments:
+      backend : optional - object exposing the `list_blobs(bucket_name, prefix)` and
+                           `blob_exists(gs_uri)` methods (`GCSBackend` or `LocalBackend`).
+                           Defaults to `GCSBackend()`.
+      ttl     : optional - time (in seconds) a listing is kept in the cache. Defaults to 300.
+    """
 
-  elapsed = time.time() - start_time
-  print("Done in %g seconds."%elapsed)
+    self.backend = backend if backend is not None else GCSBackend()
+    self.ttl = ttl
 
-  start_time = time.time()
-  print("\nSorting DICOM files..." )
+    # (bucket_name, prefix) -> (timestamp, set of blob names)
+    self._cache = dict()
+    self._lock = threading.Lock()
 
-  # 
-  bash_command = list()
-  bash_command += ["python", "src/dicomsort/dicomsort.py", "-k", "-u",
-                   "%s"%download_path, "%s/%%PatientID/%%Modality/%%SOPInstanceUID.dcm"%sorted_base_path]
+  # ----------------------------------
 
-  bash_return = subprocess.run(bash_command, check = True, text = True)
+  def _cached_listing(self, bucket_name, blob_name):
 
-  elapsed = time.time() - start_time
-  print("Done in %g seconds."%elapsed)
+    # any fresh listing of a prefix of `blob_name` is complete for it
+    now = time.time()
 
-  print("Sorted DICOM data saved at: %s"%(os.path.join(sorted_base_path, pat_id)))
+    with self._lock:
+      for (cached_bucket_name, prefix), (timestamp, blob_set) in self._cache.items():
+        if cached_bucket_name == bucket_name and blob_name.startswith(prefix) and now - timestamp < self.ttl:
+          return blob_set
+
+    return None
+
+  # ----------------------------------
+
+  def _listing(self, bucket_name, prefix, use_cache = True):
+
+    """
+    Set of the names of the objects under a prefix - possibly a superset (a cached listing of
+    a shallower prefix), so it is only meant for membership tests.
+    """
+
+    blob_set = self._cached_listing(bucket_name, prefix) if use_cache else None
+
+    if blob_set is None:
+      blob_set = frozenset(self.backend.list_blobs(bucket_name, prefix))
+
+      with self._lock:
+        self._cache[(bucket_name, prefix)] = (time.time(), blob_set)
+
+    return blob_set
+
+  # ----------------------------------
+
+  def list(self, prefix_gs_uri, use_cache = True):
+
+    """
+    List the objects under a prefix (e.g., gs://bucket/path/to/dir/).
+
+    Arguments:
+      prefix_gs_uri : required - GS URI of the prefix.
+      use_cache     : optional - whether to answer from a cached listing, if there is a fresh one.
+                                 Defaults to True.
+
+    Returns:
+      blob_list : sorted list of the names (relative to the bucket) of the objects under the prefix.
+    """
+
+    bucket_name, prefix = _split_gs_uri(prefix_gs_uri)
+
+    blob_set = self._listing(bucket_name, prefix, use_cache = use_cache)
+
+    return sorted(blob_name for blob_name in blob_set if blob_name.startswith(prefix))
+
+  # ----------------------------------
+
+  def exists(self, gs_uri, use_cache = True):
+
+    """
+    Check whether an object exists. The parent "folder" of the object is listed (and cached),
+    so that the checks of the objects next to it are answered from the cache - except for the
+    objects at the root of the bucket, checked one by one (listing the whole bucket would be
+    far more expensive).
 
-  # get rid of the temporary folder, storing the unsorted DICOM data 
-  if remove_raw:
-    print("Removing un-sorted data at %s..."%(download_path))
-    shutil.rmtree(download_path) 
-    print("... Done.")
+    Arguments:
+      gs_uri    : required - GS URI of the object.
+      use_cache : optional - whether to answer from a cached listing. Defaults to True.
+
+    Returns:
+      file_exists : True if the object exists, False if it doesn't.
+    """
+
+    return self.exists_many([gs_uri], use_cache = use_cache)[0]
+
+  # ----------------------------------
+
+  def exists_many(self, gs_uri_list, prefix_gs_uri = None, use_cache = True):
+
+    """
+    Check whether each object in a list exists (e.g., the DICOM SEG objects of a whole
+    cohort), listing the common prefix of the objects only once.
+
+    Arguments:
+      gs_uri_list   : required - list of GS URIs of the objects (all in the same bucket).
+      prefix_gs_uri : optional - GS URI of the prefix to list. Defaults to None (the deepest
+                                 "folder" containing all the objects - if that is the root of
+                                 the bucket, the objects are checked one by one instead, unless
+                                 a fresh listing is cached already).
+      use_cache     : optional - whether to answer from a cached listing. Defaults to True.
+
+    Returns:
+      exists_list : list of booleans, one for each object.
+    """
+
+    if not len(gs_uri_list):
+      return list()
+
+    split_list = [_split_gs_uri(gs_uri) for gs_uri in gs_uri_list]
+
+    bucket_name = split_list[0][0]
+    assert(all(split[0] == bucket_name for split in split_list))
+
+    if prefix_gs_uri is not None:
+      prefix = _split_gs_uri(prefix_gs_uri)[1]
+    else:
+      common_prefix = os.path.commonprefix([blob_name for _, blob_name in split_list])
+      prefix = common_prefix[:common_prefix.rfind("/") + 1]
+
+    if prefix_gs_uri is None and prefix == "":
+      exists_list = list()
+
+      for gs_uri, (_, blob_name) in zip(gs_uri_list, split_list):
+        blob_set = self._cached_listing(bucket_name, blob_name) if use_cache else None
+        exists_list.append(blob_name in blob_set if blob_set is not None else self.backend.blob_exists(gs_uri))
+
+      return exists_list
+
+    blob_set = self._listing(bucket_name, prefix, use_cache = use_cache)
+
+    return [blob_name in blob_set for _, blob_name in split_list]
+
+  # ----------------------------------
+
+  def invalidate(self, gs_uri = None):
+
+    """
+    Drop the cached listings that might include `gs_uri` (an object or a prefix), e.g.,
+    after uploading new objects. Drops the whole cache if `gs_uri` is None.
+    """
+
+    with self._lock:
+      if gs_uri is None:
+        self._cache.clear()
+        return
+
+      bucket_name, blob_name = _split_gs_uri(gs_uri)
+
+      for key in [key for key in self._cache if key[0] == bucket_name
+                  and (blob_name.startswith(key[1]) or key[1].startswith(blob_name))]:
+        del self._cache[key]
 
 # ----------------------------------
 # ----------------------------------
 
-def file_exists_in_bucket(project_name, bucket_name, file_gs_uri):
+# one (cached) bucket index, and therefore one client, per GCP project
+_bucket_index_dict = dict()
+_bucket_index_lock = threading.Lock()
+
+def get_bucket_index(project_name = None, backend = None, ttl = 300):
+
+  """
+  Shared `BucketIndex` for a GCP project (created on first use), used by `file_exists_in_bucket`
+  and `listdir_bucket`. If `backend` is specified (e.g., a `LocalBackend`, for offline runs),
+  it replaces the index of the project.
+  """
+
+  with _bucket_index_lock:
+    if backend is not None or project_name not in _bucket_index_dict:
+      _bucket_index_dict[project_name] = BucketIndex(backend if backend is not None
+                                                     else GCSBackend(project_name), ttl = ttl)
+
+    return _bucket_index_dict[project_name]
+
+# ----------------------------------
+# ----------------------------------
+
+def file_exists_in_bucket(project_name, bucket_name, file_gs_uri, use_cache = False):
   
   """
   Check whether a file exists in the specified Google Cloud Storage Bucket.
@@ -96,6 +502,12 @@ def file_exists_in_bucket(project_name, bucket_name, file_gs_uri):
     project_name : required - name of the GCP project.
     bucket_name  : required - name of the bucket (without gs://)
     file_gs_uri  : required - file GS URI
+    use_cache    : optional - whether to answer from the cached listing of the folder
+                              storing the file (see `BucketIndex`). The listing is not refreshed
+                              when objects are written, so a file uploaded after it was cached is
+                              reported missing for up to `ttl` seconds (unless `invalidate` is
+                              called). Defaults to False (one request per call). For many checks,
+                              use `get_bucket_index(...).exists_many` instead.
   
   Returns:
     file_exists : boolean variable, True if the file exists in the specified,
@@ -105,30 +517,32 @@ def file_exists_in_bucket(project_name, bucket_name, file_gs_uri):
     This function [...]
   """
 
-  storage_client = storage.Client(project = project_name)
-  bucket = storage_client.get_bucket(bucket_name)
-  
   bucket_gs_url = "gs://%s/"%(bucket_name)
   path_to_file_relative = file_gs_uri.split(bucket_gs_url)[-1]
 
   print("Searching `%s` for: \n%s\n"%(bucket_gs_url, path_to_file_relative))
 
-  file_exists = bucket.blob(path_to_file_relative).exists(storage_client)
+  file_exists = get_bucket_index(project_name).exists(bucket_gs_url + path_to_file_relative,
+                                                      use_cache = use_cache)
 
   return file_exists
 
 # ----------------------------------
 # ----------------------------------
 
-def listdir_bucket(project_name, bucket_name, dir_gs_uri):
+def listdir_bucket(project_name, bucket_name, dir_gs_uri, use_cache = False):
   
   """
-  Export DICOM SEG object from segmentation masks stored in NRRD files.
+  List the files stored under a given directory of a Google Cloud Storage bucket.
 
   Arguments:
     project_name : required - name of the GCP project.
     bucket_name  : required - name of the bucket (without gs://)
-    file_gs_uri  : required - directory GS URI
+    dir_gs_uri   : required - directory GS URI
+    use_cache    : optional - whether to answer from a cached listing (see `BucketIndex`).
+                              The listing is not refreshed when objects are written, so files
+                              uploaded after it was cached are missing for up to `ttl` seconds
+                              (unless `invalidate` is called). Defaults to False (listed anew).
   
   Returns:
     file_list : list of files in the specified GCS bucket.
@@ -137,19 +551,17 @@ def listdir_bucket(project_name, bucket_name, dir_gs_uri):
     This function [...]
   """
 
-  storage_client = storage.Client(project = project_name)
-  bucket = storage_client.get_bucket(bucket_name)
-  
   bucket_gs_url = "gs://%s/"%(bucket_name)
   path_to_dir_relative = dir_gs_uri.split(bucket_gs_url)[-1]
 
-
   print("Getting the list of files at `%s`..."%(dir_gs_uri))
 
-  file_list = list()
+  blob_list = get_bucket_index(project_name).list(bucket_gs_url + path_to_dir_relative,
+                                                  use_cache = use_cache)
+
+  file_list = [os.path.basename(blob_name) for blob_name in blob_list]
 
-  for blob in storage_client.list_blobs(bucket_name,  prefix = path_to_dir_relative):
-    fn = os.path.basename(blob.name)
-    file_list.append(fn)
+  return file_list
 
-  return file_list
\ No newline at end of file
+# ----------------------------------
+# ----------------------------------
@@ -0,0 +1,421 @@
+"""
+    ----------------------------------------
+    IDC-MedImA-misc - instrumentation utils
+    ----------------------------------------
+
+    ----------------------------------------
+    Author: Dennis Bontempi
+    Email:  dennis_bontempi@dfci.harvard.edu
+    ----------------------------------------
+
+"""
+
+import os
+import sys
+import json
+import time
+import inspect
+import resource
+import threading
+import functools
+
+from contextlib import contextmanager
+
+import pandas as pd
+
+# recorder the instrumented functions report to (nothing is measured while it is None)
+_recorder = None
+
+# per-thread state: current series and stack of the open stages
+_local = threading.local()
+
+# `ru_maxrss` is in kilobytes on Linux, in bytes on macOS
+_MAXRSS_UNIT = 1 if sys.platform == "darwin" else 1024
+
+
+def _read_io_bytes():
+
+  """
+  Bytes read from and written to the storage layer by the process - including its children
+  that already exited (Linux only, None elsewhere).
+  """
+
+  try:
+    with open("/proc/self/io", "r") as fp:
+      io_dict = dict(line.split(": ") for line in fp.read().splitlines())
+    return int(io_dict["read_bytes"]), int(io_dict["write_bytes"])
+  except (OSError, ValueError, KeyError):
+    return None
+
+# ----------------------------------
+# ----------------------------------
+
+def _read_rss_bytes():
+
+  """
+  Current resident set size of the process (Linux only, None elsewhere).
+  """
+
+  try:
+    with open("/proc/self/statm", "r") as fp:
+      return int(fp.read().split()[1])*os.sysconf("SC_PAGE_SIZE")
+  except (OSError, ValueError, IndexError):
+    return None
+
+# ----------------------------------
+# ----------------------------------
+
+class _RSSSampler:
+
+  """
+  Sample the resident set size of the process in a background thread, to get the peak of a
+  single stage (`ru_maxrss` only stores the peak since the process started).
+  """
+
+  def __init__(self, sample_interval):
+    self.sample_interval = sample_interval
+    self.peak_rss = _read_rss_bytes() or 0
+    self._stop = threading.Event()
+    self._thread = None
+
+  def start(self):
+
+    if self.sample_interval is None or _read_rss_bytes() is None:
+      return self
+
+    self._thread = threading.Thread(target = self._run, daemon = True)
+    self._thread.start()
+
+    return self
+
+  def _run(self):
+    while not self._stop.wait(self.sample_interval):
+      self.peak_rss = max(self.peak_rss, _read_rss_bytes() or 0)
+
+  def stop(self):
+
+    if self._thread is not None:
+      self._stop.set()
+      self._thread.join()
+
+    self.peak_rss = max(self.peak_rss, _read_rss_bytes() or 0)
+
+    return self.peak_rss
+
+# ----------------------------------
+# ----------------------------------
+
+class Recorder:
+
+  """
+  Collect the per-stage (and per-series) measurements of the instrumented functions, and export
+  them as JSONL (one record per stage run, appended as soon as the stage ends - so that nothing
+  is lost if a long run is interrupted) or in the Prometheus text format (aggregated by stage).
+
+  Every record stores:
+    stage, series_id, parent   : name of the stage, ID of the series, name of the enclosing stage (if any).
+    status, start_time         : "done" or "failed", UNIX timestamp of the start of the stage.
+    wall_time                  : elapsed time (s).
+    cpu_time                   : CPU time of the thread running the stage (s).
+    cpu_time_children          : CPU time of the subprocesses that exited during the stage (s),
+                                 e.g., `nnUNet_predict` or `plastimatch`.
+    peak_rss_mb                : peak resident set size of the process during the stage (MB).
+    peak_rss_children_mb       : peak resident set size of the subprocesses, if larger than the one
+                                 of all the subprocesses that exited before the stage (MB, else None).
+    read_bytes, write_bytes    : bytes read/written by the process and its (exited) subprocesses.
+
+  Note: the CPU time of the stage is per-thread, while the memory and I/O figures are process-wide
+  - when stages run concurrently (e.g., in `pipeline.run_pipeline`), the latter overlap.
+  """
+
+  def __init__(self, jsonl_path = None, sample_interval = 0.1):
+
+    """
+    Arguments:
+      jsonl_path      : optional - path to the JSONL file the records are appended to. Defaults to None.
+      sample_interval : optional - interval (in seconds) between two samples of the resident set size.
+                                   If None, the peak is only measured at the start and end of the
+                                   stages. Defaults to 0.1.
+    """
+
+    self.jsonl_path = jsonl_path
+    self.sample_interval = sample_interval
+
+    self.record_list = list()
+    self._lock = threading.Lock()
+
+    if jsonl_path is not None and os.path.dirname(jsonl_path):
+      os.makedirs(os.path.dirname(jsonl_path), exist_ok = True)
+
+  # ----------------------------------
+
+  def add(self, record):
+
+    with self._lock:
+      self.record_list.append(record)
+
+      if self.jsonl_path is not None:
+        with open(self.jsonl_path, "a") as fp:
+          fp.write(json.dumps(record) + "\n")
+
+  # ----------------------------------
+
+  def to_dataframe(self):
+
+    with self._lock:
+      return pd.DataFrame(list(self.record_list))
+
+  # ----------------------------------
+
+  def summary(self):
+
+    """
+    Aggregate the records by stage - the stages with the largest total wall time first.
+
+    Returns:
+      summary_df : pandas DataFrame storing, for every stage, the number of runs (and of failures),
+                   the total and mean wall and CPU times, the maximum peak RSS and the total I/O.
+    """
+
+    records_df = self.to_dataframe()
+
+    if records_df.empty:
+      return records_df
+
+    records_df["failed"] = records_df["status"] == "failed"
+
+    summary_df = records_df.groupby("stage").agg(count = ("wall_time", "size"),
+                                                 failed = ("failed", "sum"),
+                                                 wall_time_total = ("wall_time", "sum"),
+                                                 wall_time_mean = ("wall_time", "mean"),
+                                                 cpu_time_total = ("cpu_time", "sum"),
+                                                 cpu_time_children_total = ("cpu_time_children", "sum"),
+                                                 peak_rss_mb_max = ("peak_rss_mb", "max"),
+                                                 peak_rss_children_mb_max = ("peak_rss_children_mb", "max"),
+                                                 read_bytes_total = ("read_bytes", "sum"),
+                                                 write_bytes_total = ("write_bytes", "sum"))
+
+    return summary_df.sort_values("wall_time_total", ascending = False)
+
+  # ----------------------------------
+
+  def to_prometheus(self, prefix = "idc_pipeline"):
+
+    """
+    Aggregate the records by stage in the Prometheus text exposition format (e.g., for the
+    node exporter textfile collector).
+
+    Returns:
+      text : string storing the metrics.
+    """
+
+    with self._lock:
+      record_list = list(self.record_list)
+
+    metric_list = [("stage_runs_total", "counter", "Number of runs of the stage.",
+                    lambda rec_list: len(rec_list)),
+                   ("stage_failures_total", "counter", "Number of failed runs of the stage.",
+                    lambda rec_list: sum(rec["status"] == "failed" for rec in rec_list)),
+                   ("stage_wall_seconds_total", "counter", "Wall time spent in the stage.",
+                    lambda rec_list: sum(rec["wall_time"] for rec in rec_list)),
+                   ("stage_cpu_seconds_total", "counter", "CPU time spent in the stage (thread).",
+                    lambda rec_list: sum(rec["cpu_time"] for rec in rec_list)),
+                   ("stage_children_cpu_seconds_total", "counter", "CPU time spent in the subprocesses of the stage.",
+                    lambda rec_list: sum(rec["cpu_time_children"] for rec in rec_list)),
+                   ("stage_peak_rss_bytes", "gauge", "Peak resident set size during the stage.",
+                    lambda rec_list: max(rec["peak_rss_mb"] for rec in rec_list)*2**20),
+                   ("stage_read_bytes_total", "counter", "Bytes read during the stage.",
+                    lambda rec_list: sum(rec["read_bytes"] or 0 for rec in rec_list)),
+                   ("stage_written_bytes_total", "counter", "Bytes written during the stage.",
+                    lambda rec_list: sum(rec["write_bytes"] or 0 for rec in rec_list))]
+
+    stage_dict = dict()
+
+    for record in record_list:
+      stage_dict.setdefault(record["stage"], list()).append(record)
+
+    line_list = list()
+
+    for metric_name, metric_type, metric_help, metric_fn in metric_list:
+      line_list.append("# HELP %s_%s %s"%(prefix, metric_name, metric_help))
+      line_list.append("# TYPE %s_%s %s"%(prefix, metric_name, metric_type))
+
+      for stage_name in sorted(stage_dict):
+        line_list.append('%s_%s{stage="%s"} %r'%(prefix, metric_name, stage_name,
+                                                 float(metric_fn(stage_dict[stage_name]))))
+
+    return "\n".join(line_list) + "\n"
+
+  # ----------------------------------
+
+  def write_prometheus(self, output_path, prefix = "idc_pipeline"):
+
+    # write to a temporary file first, so that the collector never reads a partial file
+    with open(output_path + ".tmp", "w") as fp:
+      fp.write(self.to_prometheus(prefix = prefix))
+
+    os.replace(output_path + ".tmp", output_path)
+
+# ----------------------------------
+# ----------------------------------
+
+def set_recorder(recorder):
+
+  """
+  Set the recorder all the instrumented functions report to (None to disable the instrumentation).
+
+  Returns:
+    previous_recorder : the recorder set before (or None).
+  """
+
+  global _recorder
+
+  previous_recorder = _recorder
+  _recorder = recorder
+
+  return previous_recorder
+
+# ----------------------------------
+# ----------------------------------
+
+def get_recorder():
+  return _recorder
+
+# ----------------------------------
+# ----------------------------------
+
+@contextmanager
+def series(series_id):
+
+  """
+  Attribute all the stages run by the current thread within the block to `series_id` (e.g.,
+  the notebooks' loop over the cohort), unless the stage is given its own series ID.
+  """
+
+  previous_series_id = getattr(_local, "series_id", None)
+  _local.series_id = series_id
+
+  try:
+    yield
+  finally:
+    _local.series_id = previous_series_id
+
+# ----------------------------------
+# ----------------------------------
+
+@contextmanager
+def stage(stage_name, series_id = None, recorder = None):
+
+  """
+  Measure the block as a stage (see `Recorder` for the measurements). The record is yielded,
+  so that other fields can be added to it within the block. Nothing is measured if no recorder
+  is given or set (see `set_recorder`). The stages run within the block inherit `series_id`.
+
+    with instrumentation.stage("download", series_id = series_id):
+      ...
+  """
+
+  recorder = recorder if recorder is not None else _recorder
+
+  if recorder is None:
+    yield dict()
+    return
+
+  stage_stack = getattr(_local, "stage_stack", None)
+
+  if stage_stack is None:
+    stage_stack = _local.stage_stack = list()
+
+  # the nested stages inherit the series ID
+  previous_series_id = getattr(_local, "series_id", None)
+
+  if series_id is not None:
+    _local.series_id = series_id
+
+  record = {"stage" : stage_name,
+            "series_id" : getattr(_local, "series_id", None),
+            "parent" : stage_stack[-1] if stage_stack else None,
+            "status" : "done",
+            "start_time" : time.time()}
+
+  sampler = _RSSSampler(recorder.sample_interval).start()
+
+  start_maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  children_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+  start_io = _read_io_bytes()
+  start_cpu_time = time.thread_time()
+  start_time = time.perf_counter()
+
+  stage_stack.append(stage_name)
+
+  try:
+    yield record
+
+  except BaseException:
+    record["status"] = "failed"
+    raise
+
+  finally:
+    stage_stack.pop()
+    _local.series_id = previous_series_id
+
+    wall_time = time.perf_counter() - start_time
+    cpu_time = time.thread_time() - start_cpu_time
+    end_io = _read_io_bytes()
+    end_children_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    peak_rss = sampler.stop()
+
+    end_maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    record.update({"wall_time" : wall_time,
+                   "cpu_time" : cpu_time,
+                   "cpu_time_children" : ((end_children_usage.ru_utime + end_children_usage.ru_stime)
+                                          - (children_usage.ru_utime + children_usage.ru_stime)),
+                   # if the peak of the process was reached during the stage, `ru_maxrss` is exact
+                   "peak_rss_mb" : (end_maxrss*_MAXRSS_UNIT if end_maxrss > start_maxrss else peak_rss)/2**20,
+                   "peak_rss_children_mb" : (end_children_usage.ru_maxrss*_MAXRSS_UNIT/2**20
+                                             if end_children_usage.ru_maxrss > children_usage.ru_maxrss else None),
+                   "read_bytes" : end_io[0] - start_io[0] if start_io and end_io else None,
+                   "write_bytes" : end_io[1] - start_io[1] if start_io and end_io else None})
+
+    recorder.add(record)
+
+# ----------------------------------
+# ----------------------------------
+
+def instrumented(stage_name, series_arg = None):
+
+  """
+  Decorator measuring every call of a function as a stage (see `stage`) - at no cost if no
+  recorder is set.
+
+  Arguments:
+    stage_name : required - name of the stage.
+    series_arg : optional - name of the argument of the function storing the series (or patient)
+                            ID. If None, the ID set with `series` is used. Defaults to None.
+  """
+
+  def _decorator(fn):
+
+    arg_idx = list(inspect.signature(fn).parameters).index(series_arg) if series_arg is not None else None
+
+    @functools.wraps(fn)
+    def _wrapper(*args, **kwargs):
+
+      if _recorder is None:
+        return fn(*args, **kwargs)
+
+      series_id = None
+
+      if series_arg is not None:
+        series_id = kwargs.get(series_arg, args[arg_idx] if arg_idx < len(args) else None)
+
+      with stage(stage_name, series_id = series_id):
+        return fn(*args, **kwargs)
+
+    return _wrapper
+
+  return _decorator
+
+# ----------------------------------
+# ----------------------------------
@@ -0,0 +1,285 @@
+"""
+    ----------------------------------------
+    IDC-MedImA-misc - metrics utils
+    ----------------------------------------
+
+    ----------------------------------------
+    Author: Dennis Bontempi
+    Email:  dennis_bontempi@dfci.harvard.edu
+    ----------------------------------------
+
+"""
+
+import os
+
+import numpy as np
+import SimpleITK as sitk
+
+from scipy import ndimage
+
+
+def load_segmask_dir(segmask_folder_path):
+
+  """
+  Load every NRRD segmentation mask stored in a folder (e.g., the output of
+  `postprocessing.dicomseg_to_nrrd`) as a dictionary of boolean arrays.
+
+  Arguments:
+    segmask_folder_path : required - path to the folder storing one NRRD file per structure
+                                     (e.g., "Heart.nrrd", "Esophagus.nrrd").
+
+  Returns:
+    segmask_dict : dictionary of boolean numpy arrays (z, y, x), indexed by structure name.
+    geometry     : dictionary storing the "spacing", "origin" and "direction" of the
+                   volumes (SimpleITK convention, i.e., x, y, z ordering).
+  """
+
+  segmask_dict = dict()
+  geometry = None
+
+  for fn in sorted(os.listdir(segmask_folder_path)):
+    if not fn.endswith(".nrrd"):
+      continue
+
+    sitk_mask = sitk.ReadImage(os.path.join(segmask_folder_path, fn))
+    structure_name = os.path.splitext(fn)[0]
+
+    segmask_dict[structure_name] = sitk.GetArrayViewFromImage(sitk_mask) > 0
+
+    if geometry is None:
+      geometry = {"spacing" : sitk_mask.GetSpacing(),
+                  "origin" : sitk_mask.GetOrigin(),
+                  "direction" : sitk_mask.GetDirection()}
+
+  return segmask_dict, geometry
+
+# ----------------------------------
+# ----------------------------------
+
+def _bounding_box(mask_a, mask_b, pad = 1):
+
+  """
+  Compute the (padded) bounding box of the union of two boolean masks.
+  Returns a tuple of slices, or None if both masks are empty.
+  """
+
+  union = mask_a | mask_b
+  bbox = list()
+
+  for axis in range(union.ndim):
+    other_axes = tuple(ax for ax in range(union.ndim) if ax != axis)
+    nonzero = np.flatnonzero(union.any(axis = other_axes))
+
+    if nonzero.size == 0:
+      return None
+
+    bbox.append(slice(max(nonzero[0] - pad, 0),
+                      min(nonzero[-1] + pad + 1, union.shape[axis])))
+
+  return tuple(bbox)
+
+# ----------------------------------
+# ----------------------------------
+
+def _center_of_mass_mm(mask, offset, geometry):
+
+  """
+  Compute the center of mass of a boolean mask in physical coordinates (mm).
+  `offset` is the (z, y, x) index of the first voxel of the cropped mask.
+  """
+
+  com_zyx = np.array(ndimage.center_of_mass(mask)) + np.array(offset)
+  com_xyz = com_zyx[::-1]
+
+  spacing = np.array(geometry["spacing"])
+  origin = np.array(geometry["origin"])
+  direction = np.array(geometry["direction"]).reshape(3, 3)
+
+  return (origin + direction @ (com_xyz*spacing)).tolist()
+
+# ----------------------------------
+# ----------------------------------
+
+def _directed_distances(mask_from, mask_to, sampling):
+
+  """
+  Distance (mm) from every voxel in `mask_from` to the closest voxel in `mask_to`.
+  """
+
+  dist_map = ndimage.distance_transform_edt(~mask_to, sampling = sampling)
+
+  return dist_map[mask_from]
+
+# ----------------------------------
+# ----------------------------------
+
+def _boundary(mask):
+
+  """
+  Extract the (one voxel thick) boundary of a boolean mask.
+  """
+
+  return mask & ~ndimage.binary_erosion(mask)
+
+# ----------------------------------
+# ----------------------------------
+
+def compute_structure_metrics(ref_mask, cmp_mask, geometry, percentile = 95):
+
+  """
+  Compute Dice Coefficient, center of mass and Hausdorff distances for a single structure.
+  All the distance transforms are computed on the bounding box of the union of the two
+  masks only, which yields the same results as processing the whole volume.
+
+  Arguments:
+    ref_mask   : required - boolean numpy array (z, y, x) storing the reference segmentation.
+    cmp_mask   : required - boolean numpy array (z, y, x) storing the segmentation to evaluate.
+    geometry   : required - dictionary storing the "spacing", "origin" and "direction" of the
+                            volumes (SimpleITK convention, i.e., x, y, z ordering).
+    percentile : optional - percentile used to compute the robust Hausdorff distance. Defaults to 95.
+
+  Returns:
+    dc_summary_dict : dictionary formatted like `pypla.dice` output, e.g.,
+                      {'com': {'ref': [...], 'cmp': [...]}, 'dc': 0.939273}
+    hd_summary_dict : dictionary formatted like `pypla.hd` output, e.g.,
+                      {'hd': 8.99, 'hd95': 1.5, 'hd_boundaries': 8.99, 'hd95_boundaries': 7.37}
+
+    If either of the masks is empty, two empty dictionaries are returned (parsed as NaN
+    by `eval.dc_dict_to_df` and `eval.hd_dict_to_df`).
+  """
+
+  assert(ref_mask.shape == cmp_mask.shape)
+
+  ref_mask = np.asarray(ref_mask, dtype = bool)
+  cmp_mask = np.asarray(cmp_mask, dtype = bool)
+
+  bbox = _bounding_box(ref_mask, cmp_mask)
+
+  if bbox is None:
+    return dict(), dict()
+
+  ref_crop = ref_mask[bbox]
+  cmp_crop = cmp_mask[bbox]
+
+  ref_count = np.count_nonzero(ref_crop)
+  cmp_count = np.count_nonzero(cmp_crop)
+
+  if ref_count == 0 or cmp_count == 0:
+    return dict(), dict()
+
+  offset = [s.start for s in bbox]
+  sampling = tuple(geometry["spacing"])[::-1]
+
+  # Dice Coefficient and center of mass
+  dc_summary_dict = dict()
+  dc_summary_dict["com"] = {"ref" : _center_of_mass_mm(ref_crop, offset, geometry),
+                            "cmp" : _center_of_mass_mm(cmp_crop, offset, geometry)}
+  dc_summary_dict["dc"] = 2*np.count_nonzero(ref_crop & cmp_crop)/(ref_count + cmp_count)
+
+  # Hausdorff distances - full volume
+  dist_cmp_to_ref = _directed_distances(cmp_crop, ref_crop, sampling)
+  dist_ref_to_cmp = _directed_distances(ref_crop, cmp_crop, sampling)
+
+  # Hausdorff distances - boundaries only
+  ref_boundary = _boundary(ref_crop)
+  cmp_boundary = _boundary(cmp_crop)
+
+  dist_cmp_to_ref_b = _directed_distances(cmp_boundary, ref_boundary, sampling)
+  dist_ref_to_cmp_b = _directed_distances(ref_boundary, cmp_boundary, sampling)
+
+  hd_summary_dict = dict()
+  hd_summary_dict["hd"] = max(dist_cmp_to_ref.max(), dist_ref_to_cmp.max())
+  hd_summary_dict["hd%g"%(percentile)] = max(np.percentile(dist_cmp_to_ref, percentile),
+                                              np.percentile(dist_ref_to_cmp, percentile))
+  hd_summary_dict["hd_boundaries"] = max(dist_cmp_to_ref_b.max(), dist_ref_to_cmp_b.max())
+  hd_summary_dict["hd%g_boundaries"%(percentile)] = max(np.percentile(dist_cmp_to_ref_b, percentile),
+                                                         np.percentile(dist_ref_to_cmp_b, percentile))
+
+  # cast to built-in floats, so that the dictionaries can be serialised
+  dc_summary_dict["dc"] = float(dc_summary_dict["dc"])
+  hd_summary_dict = {key : float(val) for key, val in hd_summary_dict.items()}
+
+  return dc_summary_dict, hd_summary_dict
+
+# ----------------------------------
+# ----------------------------------
+
+def compute_patient_metrics(ref_segmask_dict, cmp_segmask_dict, geometry,
+                            eval_dice = True, eval_hausdorff = True):
+
+  """
+  Compute the evaluation metrics for all the structures of a single patient in one pass.
+  Only the structures found in both the reference and the predicted segmentation are evaluated.
+
+  Arguments:
+    ref_segmask_dict : required - dictionary of boolean numpy arrays (z, y, x) storing
+                                  the reference segmentation masks, indexed by structure name.
+    cmp_segmask_dict : required - dictionary of boolean numpy arrays (z, y, x) storing
+                                  the segmentation masks to evaluate, indexed by structure name.
+    geometry         : required - dictionary storing the "spacing", "origin" and "direction"
+                                  of the volumes (see `load_segmask_dir`).
+    eval_dice        : optional - whether to return the Dice Coefficient results. Defaults to True.
+    eval_hausdorff   : optional - whether to return the Hausdorff Distance results. Defaults to True.
+
+  Returns:
+    pat_dc_dict : dictionary storing the Dice Coefficient results for each structure,
+                  i.e., what `eval.dc_dict_to_df` expects as `dc_dict[pat_id]`.
+    pat_hd_dict : dictionary storing the Hausdorff Distance results for each structure,
+                  i.e., what `eval.hd_dict_to_df` expects as `hd_dict[pat_id]`.
+  """
+
+  pat_dc_dict = dict()
+  pat_hd_dict = dict()
+
+  eval_structure_list = sorted(set(ref_segmask_dict.keys()).intersection(set(cmp_segmask_dict.keys())))
+
+  for structure_name in eval_structure_list:
+    try:
+      dc_summary_dict, hd_summary_dict = compute_structure_metrics(ref_mask = ref_segmask_dict[structure_name],
+                                                                   cmp_mask = cmp_segmask_dict[structure_name],
+                                                                   geometry = geometry)
+    except Exception as e:
+      dc_summary_dict, hd_summary_dict = dict(), dict()
+      print(e)
+
+    if eval_dice == True:
+      pat_dc_dict[structure_name] = dc_summary_dict
+
+    if eval_hausdorff == True:
+      pat_hd_dict[structure_name] = hd_summary_dict
+
+  return pat_dc_dict, pat_hd_dict
+
+# ----------------------------------
+# ----------------------------------
+
+def eval_patient_nrrd(manual_seg_folder_path, pred_seg_folder_path,
+                      eval_dice = True, eval_hausdorff = True):
+
+  """
+  Compute the evaluation metrics for a single patient, starting from the folders storing
+  the reference and the predicted NRRD segmentation masks (one file per structure).
+  Drop-in replacement for the per-structure `pypla.dice` and `pypla.hd` calls.
+
+  Arguments:
+    manual_seg_folder_path : required - path to the folder storing the reference NRRD masks.
+    pred_seg_folder_path   : required - path to the folder storing the predicted NRRD masks.
+    eval_dice              : optional - whether to return the Dice Coefficient results. Defaults to True.
+    eval_hausdorff         : optional - whether to return the Hausdorff Distance results. Defaults to True.
+
+  Returns:
+    pat_dc_dict : see `compute_patient_metrics`.
+    pat_hd_dict : see `compute_patient_metrics`.
+  """
+
+  ref_segmask_dict, geometry = load_segmask_dir(manual_seg_folder_path)
+  cmp_segmask_dict, _ = load_segmask_dir(pred_seg_folder_path)
+
+  return compute_patient_metrics(ref_segmask_dict = ref_segmask_dict,
+                                 cmp_segmask_dict = cmp_segmask_dict,
+                                 geometry = geometry,
+                                 eval_dice = eval_dice,
+                                 eval_hausdorff = eval_hausdorff)
+
+# ----------------------------------
+# ----------------------------------
@@ -0,0 +1,500 @@
+"""
+    ----------------------------------------
+    IDC-MedImA-misc - pipeline utils
+    ----------------------------------------
+
+    ----------------------------------------
+    Author: Dennis Bontempi
+    Email:  dennis_bontempi@dfci.harvard.edu
+    ----------------------------------------
+
+"""
+
+import os
+import time
+import queue
+import shutil
+import tempfile
+import threading
+
+from functools import partial
+
+import SimpleITK as sitk
+
+from . import gcs
+from . import bpr
+from . import staging
+from . import artifacts
+from . import dicomseg
+from . import cropping
+from . import processing
+from . import preprocessing
+from . import instrumentation
+
+# marks the end of the stream of items in the stage queues
+_END = object()
+
+
+def _wait_for_disk(disk_path, min_free_bytes, poll_interval):
+
+  """
+  Block until at least `min_free_bytes` are available on the filesystem storing `disk_path`.
+  """
+
+  waiting = False
+
+  while shutil.disk_usage(disk_path).free < min_free_bytes:
+    if not waiting:
+      print("Less than %.1f GB available at %s - waiting..."%(min_free_bytes/2**30, disk_path))
+      waiting = True
+
+    time.sleep(poll_interval)
+
+# ----------------------------------
+# ----------------------------------
+
+def run_pipeline(item_list, stage_list, queue_size = 1, max_in_flight = None,
+                 disk_path = None, min_free_disk_gb = 0, poll_interval = 5.0, cleanup_fn = None):
+
+  """
+  Process a list of items (e.g., series) through a sequence of stages connected by bounded
+  queues, so that the stages work on different items at the same time (e.g., the next series
+  are downloaded and converted while the current one is being inferred). Every stage runs
+  in its own pool of threads; when a queue is full, the stages upstream of it stop (and so
+  does the admission of new items), so the throughput is bounded by the slowest stage rather
+  than by the sum of all the stages.
+
+  Arguments:
+    item_list        : required - list of dictionaries (one per item), each storing at least an "id".
+                                  The dictionary is passed to (and can be updated by) every stage.
+    stage_list       : required - list of (stage_name, stage_fn, num_workers) tuples. `stage_fn`
+                                  is called with the item dictionary, and `num_workers` bounds the
+                                  number of items the stage processes at the same time.
+    queue_size       : optional - maximum number of items waiting in front of each stage. Defaults to 1.
+    max_in_flight    : optional - maximum number of items in the pipeline at the same time (e.g.,
+                                  to bound the number of series on disk). Defaults to None (bounded
+                                  by the queues only).
+    disk_path        : optional - path on the filesystem to monitor. New items are not admitted
+                                  while less than `min_free_disk_gb` GB are available. Defaults to None.
+    min_free_disk_gb : optional - see `disk_path`. Defaults to 0.
+    poll_interval    : optional - time (in seconds) between two checks of the free disk space. Defaults to 5.
+    cleanup_fn       : optional - function called with the item dictionary once the item leaves the
+                                  pipeline (done or failed), e.g., to remove its intermediate files.
+                                  Defaults to None.
+
+  Returns:
+    record_list : list of dictionaries (in completion order) storing, for every item, the "id",
+                  the "status" ("done" or "failed"), the "failed_stage" and the "error" (if any),
+                  the time spent in each stage ("timings") and the total "elapsed" time.
+  """
+
+  num_stages = len(stage_list)
+
+  queue_list = [queue.Queue(maxsize = queue_size) for _ in range(num_stages)]
+  done_queue = queue.Queue()
+
+  in_flight = threading.BoundedSemaphore(max_in_flight) if max_in_flight is not None else None
+  min_free_bytes = min_free_disk_gb*2**30
+
+  # number of workers still running for every stage (the last one forwards the end marker)
+  active_list = [num_workers for _, _, num_workers in stage_list]
+  active_lock = threading.Lock()
+
+  busy_time_list = [0.0]*num_stages
+
+  def _leave(context, record):
+
+    if cleanup_fn is not None:
+      try:
+        cleanup_fn(context)
+      except Exception as e:
+        print("Cleanup of %s failed (%s)."%(context["id"], repr(e)))
+
+    if in_flight is not None:
+      in_flight.release()
+
+    done_queue.put(record)
+
+  def _worker(stage_idx):
+
+    stage_name, stage_fn, _ = stage_list[stage_idx]
+
+    while True:
+      item = queue_list[stage_idx].get()
+
+      if item is _END:
+        with active_lock:
+          active_list[stage_idx] -= 1
+          last_worker = active_list[stage_idx] == 0
+
+        if last_worker and stage_idx + 1 < num_stages:
+          for _ in range(stage_list[stage_idx + 1][2]):
+            queue_list[stage_idx + 1].put(_END)
+        return
+
+      context, record = item
+
+      start_time = time.time()
+
+      try:
+        with instrumentation.stage(stage_name, series_id = context["id"]):
+          stage_fn(context)
+        failed = False
+
+      except Exception as e:
+        print("Stage `%s` failed for %s (%s)."%(stage_name, context["id"], repr(e)))
+        record.update({"status" : "failed", "failed_stage" : stage_name, "error" : repr(e)})
+        failed = True
+
+      elapsed = time.time() - start_time
+      record["timings"][stage_name] = elapsed
+
+      with active_lock:
+        busy_time_list[stage_idx] += elapsed
+
+      if failed or stage_idx + 1 == num_stages:
+        record["elapsed"] = time.time() - record.pop("_start_time")
+        _leave(context, record)
+      else:
+        queue_list[stage_idx + 1].put((context, record))
+
+  def _feeder():
+
+    for context in item_list:
+      if in_flight is not None:
+        in_flight.acquire()
+
+      if disk_path is not None and min_free_bytes > 0:
+        _wait_for_disk(disk_path, min_free_bytes, poll_interval)
+
+      record = {"id" : context["id"], "status" : "done", "failed_stage" : None, "error" : None,
+                "timings" : dict(), "_start_time" : time.time()}
+
+      # blocks while the first stage is busy - nothing is admitted faster than it can be processed
+      queue_list[0].put((context, record))
+
+    for _ in range(stage_list[0][2]):
+      queue_list[0].put(_END)
+
+  thread_list = [threading.Thread(target = _feeder, daemon = True)]
+
+  for stage_idx, (_, _, num_workers) in enumerate(stage_list):
+    thread_list += [threading.Thread(target = _worker, args = (stage_idx,), daemon = True)
+                    for _ in range(num_workers)]
+
+  start_time = time.time()
+
+  for thread in thread_list:
+    thread.start()
+
+  record_list = list()
+
+  for idx in range(len(item_list)):
+    record = done_queue.get()
+    record_list.append(record)
+
+    print("(%g/%g) %s: %s in %g seconds."%(idx + 1, len(item_list), record["id"],
+                                           record["status"], record["elapsed"]))
+
+  for thread in thread_list:
+    thread.join()
+
+  elapsed = time.time() - start_time
+  print("Pipeline done in %g seconds."%elapsed)
+
+  # the busiest stage (per worker) is the one bounding the throughput
+  for (stage_name, _, num_workers), busy_time in zip(stage_list, busy_time_list):
+    print("  %-12s busy %5.1f%% of the time (%g workers)."%(stage_name,
+                                                           100*busy_time/max(elapsed*num_workers, 1e-9),
+                                                           num_workers))
+
+  return record_list
+
+# ----------------------------------
+# ----------------------------------
+
+def _download_stage(context, raw_base_path, sorted_base_path, backend, num_workers):
+
+  """
+  Download and sort a series, to `sorted_base_path`/%SeriesInstanceUID/%Modality. A series sorted
+  already (e.g., kept with `remove_intermediate = False`) is not downloaded again, while a partial
+  one (e.g., left by a crash) is replaced.
+  """
+
+  series_id = context["id"]
+  sorted_series_path = os.path.join(sorted_base_path, series_id)
+
+  if os.path.exists(sorted_series_path):
+    num_sorted = sum(len(file_list) for _, _, file_list in os.walk(sorted_series_path))
+
+    if num_sorted == len(context["series_df"]):
+      print("Series %s found at %s - skipping the download."%(series_id, sorted_series_path))
+      return
+
+    shutil.rmtree(sorted_series_path)
+
+  os.makedirs(raw_base_path, exist_ok = True)
+
+  # files are sorted by PatientID first - sort them in a temporary folder, then rename
+  tmp_sorted_path = tempfile.mkdtemp(prefix = "%s_sorted_"%(series_id), dir = raw_base_path)
+
+  try:
+    for _ in gcs.download_cohort(cohort_df = context["series_df"],
+                                 raw_base_path = raw_base_path,
+                                 backend = backend,
+                                 group_by = "SeriesInstanceUID",
+                                 num_workers = num_workers,
+                                 prefetch = 0,
+                                 remove_raw = True,
+                                 sorted_base_path = tmp_sorted_path):
+      pass
+
+    pat_dir_list = os.listdir(tmp_sorted_path)
+    assert(len(pat_dir_list) == 1)
+
+    os.replace(os.path.join(tmp_sorted_path, pat_dir_list[0]), sorted_series_path)
+
+  finally:
+    shutil.rmtree(tmp_sorted_path, ignore_errors = True)
+
+# ----------------------------------
+# ----------------------------------
+
+def _convert_stage(context, sorted_base_path, processed_nrrd_path, processed_nifti_path, model_input_folder,
+                   cache, bpr_output_folder, crop_margin_mm):
+
+  """
+  Convert the CT series to NRRD/NIfTI and stage the NIfTI volume in a per-series model input folder
+  - cropped to the chest, if the body part regression output of the series is available.
+  """
+
+  series_id = context["id"]
+
+  preprocessing.dicom_ct_to_volumes(sorted_base_path = sorted_base_path,
+                                    pat_id = series_id,
+                                    processed_nrrd_path = processed_nrrd_path,
+                                    processed_nifti_path = processed_nifti_path,
+                                    cache = cache)
+
+  context["ct_nifti_path"] = os.path.join(processed_nifti_path, series_id, series_id + "_CT.nii.gz")
+  context["crop_info"] = None
+
+  bpr_json_path = os.path.join(bpr_output_folder, series_id + ".json") if bpr_output_folder is not None else None
+
+  if bpr_json_path is not None and os.path.exists(bpr_json_path):
+    context["crop_info"] = cropping.crop_ct_to_region(processed_nifti_path = processed_nifti_path,
+                                                      pat_id = series_id,
+                                                      bpr_output = bpr.load_bpr_output(bpr_json_path),
+                                                      margin_mm = crop_margin_mm)
+
+  # one input folder per series, so that every inference only sees its own volume
+  model_input_path = os.path.join(model_input_folder, series_id)
+  os.makedirs(model_input_path, exist_ok = True)
+
+  context["model_input_path"] = model_input_path
+  context["staged_path"] = preprocessing.prep_input_data(processed_nifti_path = processed_nifti_path,
+                                                         model_input_folder = model_input_path,
+                                                         pat_id = series_id,
+                                                         cropped = context["crop_info"] is not None)
+
+# ----------------------------------
+# ----------------------------------
+
+def _inference_stage(context, sorted_base_path, model_output_folder, nnunet_model, use_tta, predictor, cache):
+
+  """
+  Run the nnU-Net inference for a series - with a warm `predictor.NNUNetPredictor`, if provided.
+  If the input was cropped, the label map is pasted back into the geometry of the full volume.
+  """
+
+  pred_nifti_path = os.path.join(model_output_folder, context["id"] + ".nii.gz")
+  crop_info = context.get("crop_info")
+
+  def _predict():
+    if predictor is not None:
+      predictor.predict([context["staged_path"]], pred_nifti_path)
+    else:
+      processing.process_patient_nnunet(model_input_folder = context["model_input_path"],
+                                        model_output_folder = model_output_folder,
+                                        nnunet_model = nnunet_model,
+                                        use_tta = use_tta)
+
+    if crop_info is not None:
+      cropping.uncrop_label(pred_nifti_path = pred_nifti_path,
+                            reference_ct_path = context["ct_nifti_path"],
+                            crop_range = crop_info["crop_range"])
+
+  if cache is not None:
+    path_to_ct_dir = os.path.join(sorted_base_path, context["id"], "CT")
+
+    # everything that selects the weights goes in the key - a model trained for another
+    # task (or another checkpoint of the same model) must not get the cached label map
+    if predictor is not None:
+      model_dict = {"nnunet_model" : predictor.nnunet_model,
+                    "task_name" : predictor.task_name,
+                    "model_folder" : predictor.model_folder,
+                    "folds" : predictor.folds,
+                    "checkpoint_name" : predictor.checkpoint_name,
+                    "use_tta" : predictor.use_tta}
+    else:
+      model_dict = {"nnunet_model" : nnunet_model,
+                    "task_name" : processing.NNUNET_TASK_NAME,
+                    "use_tta" : use_tta}
+
+    model_dict["crop_range"] = crop_info["crop_range"] if crop_info is not None else None
+
+    cache_key = artifacts.compute_key(artifacts.ct_series_uids(path_to_ct_dir), "nnunet", model_dict)
+    cache.cached_call(cache_key, pred_nifti_path, _predict, {"converter" : "nnunet", "pat_id" : context["id"]})
+  else:
+    _predict()
+
+  context["pred_nifti_path"] = pred_nifti_path
+
+# ----------------------------------
+# ----------------------------------
+
+def _postprocess_stage(context, sorted_base_path, dicomseg_json_path, processed_dicomseg_path):
+
+  """
+  Encode the predicted label map as a DICOM SEG object referencing the CT series.
+  """
+
+  series_id = context["id"]
+
+  label_array = sitk.GetArrayFromImage(sitk.ReadImage(context["pred_nifti_path"], sitk.sitkUInt8))
+
+  os.makedirs(processed_dicomseg_path, exist_ok = True)
+
+  context["dicomseg_path"] = dicomseg.label_to_dicomseg(label_array = label_array,
+                                                        path_to_ct_dir = os.path.join(sorted_base_path, series_id, "CT"),
+                                                        dicomseg_json_path = dicomseg_json_path,
+                                                        dicom_seg_out_path = os.path.join(processed_dicomseg_path,
+                                                                                          series_id + "_SEG.dcm"))
+
+# ----------------------------------
+# ----------------------------------
+
+def _cleanup_series(context, sorted_base_path, model_input_folder):
+
+  """
+  Remove the intermediate files of a series (sorted DICOM data and staged model input).
+  """
+
+  series_id = context["id"]
+
+  shutil.rmtree(os.path.join(sorted_base_path, series_id), ignore_errors = True)
+
+  model_input_path = os.path.join(model_input_folder, series_id)
+  manifest_path = staging.default_manifest_path(model_input_path)
+
+  if os.path.exists(manifest_path):
+    staging.cleanup_staged(manifest_path, pat_id = series_id)
+    os.remove(manifest_path)
+
+  shutil.rmtree(model_input_path, ignore_errors = True)
+
+# ----------------------------------
+# ----------------------------------
+
+def run_series_pipeline(cohort_df, raw_base_path, sorted_base_path, processed_nrrd_path,
+                        processed_nifti_path, model_input_folder, model_output_folder,
+                        nnunet_model = "3d_fullres", use_tta = False, predictor = None,
+                        dicomseg_json_path = None, processed_dicomseg_path = None,
+                        upload_fn = None, backend = None, num_download_workers = 2,
+                        num_convert_workers = 2, num_postprocess_workers = 2, num_upload_workers = 2,
+                        queue_size = 1, min_free_disk_gb = 10, remove_intermediate = True, cache = None,
+                        bpr_output_folder = None, crop_margin_mm = 20.0, num_download_threads = 8):
+
+  """
+  Run the per-series inference pipeline (download and sorting, DICOM to NRRD/NIfTI conversion,
+  nnU-Net inference, DICOM SEG encoding, upload, cleanup) with the stages overlapping across
+  series - see `run_pipeline`. The inference runs one series at a time, while the other stages
+  prepare the next series and finish the previous ones.
+
+  Arguments:
+    cohort_df               : required - Pandas dataframe (returned from BQ) storing the `gcs_url` and
+                                         `SeriesInstanceUID` of every object to process.
+    raw_base_path           : required - path to the folder where the raw data will be stored (temporarily).
+    sorted_base_path        : required - path to the folder where the sorted data will be stored.
+    processed_nrrd_path     : required - path to the folder where the preprocessed NRRD data are stored.
+    processed_nifti_path    : required - path to the folder where the preprocessed NIfTI data are stored.
+    model_input_folder      : required - path to the folder where the per-series model inputs are staged.
+    model_output_folder     : required - path to the folder where the inferred segmentation masks will be stored.
+    nnunet_model            : optional - pre-trained nnU-Net model to use. Defaults to "3d_fullres".
+    use_tta                 : optional - whether to use or not test time augmentation (TTA). Defaults to False.
+    predictor               : optional - warm `predictor.NNUNetPredictor` to use instead of `nnUNet_predict`.
+                                         Defaults to None.
+    dicomseg_json_path      : optional - path to the dcmqi-style metadata JSON file. If None, no DICOM SEG
+                                         object is created. Defaults to None.
+    processed_dicomseg_path : optional - path to the folder where the DICOM SEG objects are stored.
+                                         Required if `dicomseg_json_path` is specified.
+    upload_fn               : optional - function called with the series dictionary (storing, e.g.,
+                                         "pred_nifti_path" and "dicomseg_path") to upload the results.
+                                         Defaults to None (no upload stage).
+    backend                 : optional - download backend (see `gcs.download_cohort`). Defaults to `GCSBackend()`.
+    num_*_workers           : optional - number of series processed at the same time by each stage.
+                                         Defaults to 2 (the inference stage always runs one series at a time).
+    queue_size              : optional - maximum number of series waiting in front of each stage. Defaults to 1.
+    min_free_disk_gb        : optional - new series are not downloaded while less than this amount of disk
+                                         space (GB) is available at `sorted_base_path`. Defaults to 10.
+    remove_intermediate     : optional - whether to remove the sorted DICOM data and the staged model input
+                                         of every series once it leaves the pipeline. Defaults to True.
+    cache                   : optional - `artifacts.ArtifactCache` storing the CT volumes and the model
+                                         outputs, keyed by the series content (so that, e.g., re-running
+                                         a cohort with a different model skips the conversion). Defaults to None.
+    bpr_output_folder       : optional - path to the folder storing the body part regression output of the
+                                         series (`<SeriesInstanceUID>.json`). If specified, the CT volumes
+                                         are cropped to the chest before the inference (see
+                                         `cropping.crop_ct_to_region`), and the label maps pasted back
+                                         into the full volume. Defaults to None (no cropping).
+    crop_margin_mm          : optional - margin added on both sides of the chest (mm). Defaults to 20.
+    num_download_threads    : optional - number of threads downloading (and sorting) the files of every
+                                         series. Defaults to 8.
+
+  Returns:
+    record_list : list of dictionaries storing the status and the per-stage timings of every series
+                  (see `run_pipeline`).
+  """
+
+  for path in [sorted_base_path, processed_nrrd_path, processed_nifti_path, model_input_folder, model_output_folder]:
+    os.makedirs(path, exist_ok = True)
+
+  item_list = [{"id" : series_id, "series_df" : series_df}
+               for series_id, series_df in cohort_df.groupby("SeriesInstanceUID", sort = False)]
+
+  stage_list = [("download", partial(_download_stage, raw_base_path = raw_base_path,
+                                     sorted_base_path = sorted_base_path, backend = backend,
+                                     num_workers = num_download_threads), num_download_workers),
+                ("convert", partial(_convert_stage, sorted_base_path = sorted_base_path,
+                                    processed_nrrd_path = processed_nrrd_path,
+                                    processed_nifti_path = processed_nifti_path,
+                                    model_input_folder = model_input_folder, cache = cache,
+                                    bpr_output_folder = bpr_output_folder,
+                                    crop_margin_mm = crop_margin_mm), num_convert_workers),
+                ("inference", partial(_inference_stage, sorted_base_path = sorted_base_path,
+                                      model_output_folder = model_output_folder,
+                                      nnunet_model = nnunet_model, use_tta = use_tta,
+                                      predictor = predictor, cache = cache), 1)]
+
+  if dicomseg_json_path is not None:
+    assert(processed_dicomseg_path is not None)
+    stage_list.append(("postprocess", partial(_postprocess_stage, sorted_base_path = sorted_base_path,
+                                              dicomseg_json_path = dicomseg_json_path,
+                                              processed_dicomseg_path = processed_dicomseg_path),
+                       num_postprocess_workers))
+
+  if upload_fn is not None:
+    stage_list.append(("upload", upload_fn, num_upload_workers))
+
+  cleanup_fn = partial(_cleanup_series, sorted_base_path = sorted_base_path,
+                       model_input_folder = model_input_folder) if remove_intermediate else None
+
+  return run_pipeline(item_list = item_list,
+                      stage_list = stage_list,
+                      queue_size = queue_size,
+                      disk_path = sorted_base_path,
+                      min_free_disk_gb = min_free_disk_gb,
+                      cleanup_fn = cleanup_fn)
+
+# ----------------------------------
+# ----------------------------------
@@ -13,6 +13,8 @@
 
 import os
 import shutil
+import zipfile
+import threading
 import subprocess
 
 import json
@@ -21,7 +23,13 @@ import numpy as np
 import SimpleITK as sitk
 import pyplastimatch as pypla
 
+from concurrent.futures import ThreadPoolExecutor
 
+from . import instrumentation
+from . import volume_writer
+
+
+@instrumentation.instrumented("nifti_to_nrrd", series_arg = "pat_id")
 def pypla_nifti_to_nrrd(pred_nifti_path, processed_nrrd_path,
                         pat_id, verbose = True):
   
@@ -56,6 +64,7 @@ def pypla_nifti_to_nrrd(pred_nifti_path, processed_nrrd_path,
 # ----------------------------------
 # ----------------------------------
 
+@instrumentation.instrumented("postprocess", series_arg = "pat_id")
 def pypla_postprocess(processed_nrrd_path, model_output_folder, pat_id):
 
   """
@@ -80,15 +89,107 @@ def pypla_postprocess(processed_nrrd_path, model_output_folder, pat_id):
 # ----------------------------------
 # ----------------------------------
 
+def quantize_softmax(softmax, output_dtype):
+
+  """
+  Quantize a probability map (values between 0 and 1) to `output_dtype`, in one vectorized
+  step. The values are clipped, so that a probability of 1.0 maps to the dtype maximum
+  (255 for uint8, 65535 for uint16) instead of overflowing.
+
+  Arguments:
+    softmax      : required - numpy array storing the probabilities (e.g., one channel of the
+                              nnU-Net softmax output).
+    output_dtype : required - output data type, between "uint8", "uint16" or "float32" (no
+                              rescaling).
+
+  Returns:
+    softmax_quantized : numpy array of type `output_dtype`, with the same shape as `softmax`.
+  """
+
+  assert(output_dtype in ["uint8", "uint16", "float32"])
+
+  if output_dtype == "float32":
+    # no rescale needed - the values will be between 0 and 1
+    return softmax.astype(np.float32, copy = False)
+
+  max_value = np.iinfo(output_dtype).max
+
+  # rescale between 0 and `max_value`, quantize (truncating, like `astype` did before)
+  softmax_rescaled = np.multiply(softmax, max_value, dtype = np.float32)
+  np.clip(softmax_rescaled, 0, max_value, out = softmax_rescaled)
+
+  return softmax_rescaled.astype(output_dtype)
+
+# ----------------------------------
+# ----------------------------------
+
+def iter_npz_channels(npz_path, key = "softmax"):
+
+  """
+  Lazily read a (C, ...) array stored in a `.npz` file, one channel at a time. The array is
+  streamed from the (possibly compressed) archive member, so only one channel is held in
+  memory at any given time.
+
+  Arguments:
+    npz_path : required - path to the `.npz` file (e.g., `<pat_id>.npz`, exported by nnU-Net
+                          when `export_prob_maps` is set to True).
+    key      : optional - name of the array in the `.npz` file. Defaults to "softmax".
+
+  Returns:
+    channel_iterator : generator yielding the C channels (numpy arrays of shape `...`) in order.
+  """
+
+  with zipfile.ZipFile(npz_path) as npz_file, npz_file.open(key + ".npy") as fp:
+    version = np.lib.format.read_magic(fp)
+
+    if version == (1, 0):
+      shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(fp)
+    else:
+      shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(fp)
+
+    if fortran_order or dtype.hasobject:
+      # cannot be streamed channel by channel - fall back to loading the whole array
+      fp.close()
+      array = np.load(npz_path)[key]
+
+      for channel in range(array.shape[0]):
+        yield array[channel]
+
+      return
+
+    channel_shape = shape[1:]
+    channel_nbytes = int(np.prod(channel_shape))*dtype.itemsize
+
+    for _ in range(shape[0]):
+      buffer = bytearray(channel_nbytes)
+      view = memoryview(buffer)
+      offset = 0
+
+      while offset < channel_nbytes:
+        num_read = fp.readinto(view[offset:])
+        assert(num_read > 0)
+        offset += num_read
+
+      yield np.frombuffer(buffer, dtype = dtype).reshape(channel_shape)
+
+# ----------------------------------
+# ----------------------------------
+
+@instrumentation.instrumented("softmax_to_nrrd", series_arg = "pat_id")
 def numpy_to_nrrd(model_output_folder, processed_nrrd_path, pat_id,
                   output_folder_name = "pred_softmax", output_dtype = "uint8",
                   structure_list = ["Background", "Esophagus",
-                                    "Heart", "Trachea", "Aorta"]):
+                                    "Heart", "Trachea", "Aorta"],
+                  num_workers = 2):
 
   """
   Convert softmax probability maps to NRRD. For simplicity, the probability maps
   are converted by default to UInt8
 
+  The `.npz` file is streamed one channel at a time, and every channel is quantized
+  directly into `output_dtype` and written by a pool of `num_workers` threads, so the
+  peak memory is bounded to roughly `num_workers` channels (plus their output buffers).
+
   Arguments:
     model_output_folder : required - path to the folder where the inferred segmentation masks should be stored.
     processed_nrrd_path : required - path to the folder where the preprocessed NRRD data are stored.
@@ -103,65 +204,66 @@ def numpy_to_nrrd(model_output_folder, processed_nrrd_path, pat_id,
                                      first channel of the `.npz` file (output from the nnU-Net pipeline
                                      when `export_prob_maps` is set to True). Defaults to the structure
                                      list for the SegTHOR challenge (background = 0 included).
+    num_workers         : optional - number of threads writing the NRRD files concurrently. Defaults to 2.
 
   Outputs:
     This function [...]
   """
 
+  assert(output_dtype in ["uint8", "uint16", "float32"])
+
   pred_softmax_fn = pat_id + ".npz"
   pred_softmax_path = os.path.join(model_output_folder, pred_softmax_fn)
 
-  # parse NRRD file - we will make use of if to populate the header of the
-  # NRRD mask we are going to get from the inferred segmentation mask
+  # parse the NRRD header only - we will make use of it to populate the header
+  # of the NRRD files we are going to get from the softmax probability maps
   ct_nrrd_path = os.path.join(processed_nrrd_path, pat_id, pat_id + "_CT.nrrd")
-  sitk_ct = sitk.ReadImage(ct_nrrd_path)
+  
+  ct_reader = sitk.ImageFileReader()
+  ct_reader.SetFileName(ct_nrrd_path)
+  ct_reader.ReadImageInformation()
 
   output_folder_path = os.path.join(processed_nrrd_path, pat_id, output_folder_name)
   
   if not os.path.exists(output_folder_path):
     os.mkdir(output_folder_path)
 
-  pred_softmax_all = np.load(pred_softmax_path)["softmax"]
+  def _write_channel(pred_softmax_segmask, structure):
+    pred_softmax_segmask_sitk = sitk.GetImageFromArray(pred_softmax_segmask)
+    pred_softmax_segmask_sitk.SetSpacing(ct_reader.GetSpacing())
+    pred_softmax_segmask_sitk.SetOrigin(ct_reader.GetOrigin())
+    pred_softmax_segmask_sitk.SetDirection(ct_reader.GetDirection())
 
-  for channel, structure in enumerate(structure_list):
+    output_fn = "%s.nrrd"%(structure)
+    output_path = os.path.join(output_folder_path, output_fn)
 
-    pred_softmax_segmask = pred_softmax_all[channel].astype(dtype = np.float32)
+    volume_writer.write_volume(pred_softmax_segmask_sitk, output_path, output_type = "softmax")
 
-    assert(output_dtype in ["uint8", "uint16", "float32"])      
+  # bound the number of channels in flight (read, quantized, or being written)
+  in_flight = threading.BoundedSemaphore(num_workers)
 
-    if output_dtype == "float32":
-      # no rescale needed - the values will be between 0 and 1
-      # set SITK image dtype to Float32
-      sitk_dtype = sitk.sitkFloat32
+  with ThreadPoolExecutor(max_workers = num_workers) as executor:
+    future_list = list()
 
-    elif output_dtype == "uint8":
-      # rescale between 0 and 255, quantize
-      pred_softmax_segmask = (255*pred_softmax_segmask).astype(np.int)
-      # set SITK image dtype to UInt8
-      sitk_dtype = sitk.sitkUInt8
+    for channel_softmax, structure in zip(iter_npz_channels(pred_softmax_path), structure_list):
+      in_flight.acquire()
 
-    elif output_dtype == "uint16":
-      # rescale between 0 and 65536
-      pred_softmax_segmask = (65536*pred_softmax_segmask).astype(int)
-      # set SITK image dtype to UInt16
-      sitk_dtype = sitk.sitkUInt16
-    
-    pred_softmax_segmask_sitk = sitk.GetImageFromArray(pred_softmax_segmask)
-    pred_softmax_segmask_sitk.CopyInformation(sitk_ct)
-    pred_softmax_segmask_sitk = sitk.Cast(pred_softmax_segmask_sitk, sitk_dtype)
+      pred_softmax_segmask = quantize_softmax(channel_softmax, output_dtype)
+      del channel_softmax
 
-    output_fn = "%s.nrrd"%(structure)
-    output_path = os.path.join(output_folder_path, output_fn)
+      future = executor.submit(_write_channel, pred_softmax_segmask, structure)
+      future.add_done_callback(lambda _: in_flight.release())
+      future_list.append(future)
 
-    writer = sitk.ImageFileWriter()
+      del pred_softmax_segmask
 
-    writer.UseCompressionOn()
-    writer.SetFileName(output_path)
-    writer.Execute(pred_softmax_segmask_sitk)
+    for future in future_list:
+      future.result()
 
 # ----------------------------------
 # ----------------------------------
 
+@instrumentation.instrumented("nrrd_to_dicomseg", series_arg = "pat_id")
 def nrrd_to_dicomseg(sorted_base_path, processed_base_path,
                      dicomseg_json_path, pat_id, skip_empty_slices = True):
 
@@ -207,6 +309,7 @@ def nrrd_to_dicomseg(sorted_base_path, processed_base_path,
 # ----------------------------------
 # ----------------------------------
 
+@instrumentation.instrumented("dicomseg_to_nrrd")
 def dicomseg_to_nrrd(path_to_dicomseg_file, path_to_output_dir, rename_nrrd = True):
 
   """
@@ -257,3 +360,55 @@ def dicomseg_to_nrrd(path_to_dicomseg_file, path_to_output_dir, rename_nrrd = Tr
 
 # ----------------------------------
 # ----------------------------------
+
+def split_label_nifti(input_file, output_directory, label_names):
+
+  """
+  Split a multi-label NIfTI file into one binary `<label_name>.nii.gz` file per label (e.g.,
+  for the pyradiomics feature extraction) - like the notebooks' `split_nii`, but with the label
+  maps stored as UInt8 and written by `volume_writer.write_volume`. The names are mapped to the
+  label values (not to the values found in the file), so a structure missing from the label
+  map (no file written) does not shift the names of the others.
+
+  Arguments:
+    input_file       : required - path to the multi-label NIfTI file.
+    output_directory : required - path to the folder where the single-label files will be saved.
+    label_names      : required - names of the labels, either as a list (the name of label value
+                                  `n` at index `n - 1`, e.g., ["Esophagus", "Heart", "Trachea",
+                                  "Aorta"] for SegTHOR) or as a {value : name} dictionary.
+
+  Returns:
+    output_path_list : list of the paths to the single-label NIfTI files.
+  """
+
+  if not os.path.isdir(output_directory):
+    os.mkdir(output_directory)
+
+  sitk_label = sitk.ReadImage(input_file)
+  label_array = sitk.GetArrayViewFromImage(sitk_label)
+
+  if not isinstance(label_names, dict):
+    label_names = {idx + 1 : label_name for idx, label_name in enumerate(label_names)}
+
+  output_path_list = list()
+
+  # remove the background
+  for label in [int(label) for label in np.unique(label_array) if label != 0]:
+    if label not in label_names:
+      print("WARNING: no name for label %g in %s - skipping."%(label, input_file))
+      continue
+
+    label_name = label_names[label]
+
+    sitk_mask = sitk.GetImageFromArray((label_array == label).astype(np.uint8))
+    sitk_mask.CopyInformation(sitk_label)
+
+    output_path = os.path.join(output_directory, label_name + ".nii.gz")
+    volume_writer.write_volume(sitk_mask, output_path, output_type = "label")
+
+    output_path_list.append(output_path)
+
+  return output_path_list
+
+# ----------------------------------
+# ----------------------------------
@@ -0,0 +1,357 @@
+"""
+    ----------------------------------------
+    IDC-MedImA-misc - nnU-Net predictor utils
+    ----------------------------------------
+
+    ----------------------------------------
+    Author: Dennis Bontempi
+    Email:  dennis_bontempi@dfci.harvard.edu
+    ----------------------------------------
+
+"""
+
+import os
+import json
+import time
+import queue
+import shutil
+import tempfile
+import threading
+
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from nnunet.paths import network_training_output_dir, default_plans_identifier
+from nnunet.training.model_restore import load_model_and_checkpoint_files
+from nnunet.inference.segmentation_export import save_segmentation_nifti_from_softmax
+
+from . import ensemble
+
+
+class NNUNetPredictor:
+
+  """
+  Long-lived nnU-Net predictor: the model configuration (plans and the weights of all the
+  folds) is loaded once, and the volumes submitted afterwards are processed one at a time
+  by a background thread - with the same `use_tta`/`export_prob_maps` semantics as
+  `processing.process_patient_nnunet`, but without reloading the model for every patient.
+  """
+
+  def __init__(self, nnunet_model, task_name = "Task055_SegTHOR", folds = None,
+               trainer_class_name = "nnUNetTrainerV2", plans_identifier = default_plans_identifier,
+               checkpoint_name = "model_final_checkpoint", use_tta = False, export_prob_maps = False):
+
+    """
+    Arguments:
+      nnunet_model       : required - pre-trained nnU-Net model to use ("2d", "3d_lowres" or "3d_fullres").
+      task_name          : optional - name of the nnU-Net task. Defaults to "Task055_SegTHOR".
+      folds              : optional - list of folds to ensemble. Defaults to None (all the folds found).
+      trainer_class_name : optional - name of the nnU-Net trainer. Defaults to "nnUNetTrainerV2".
+      plans_identifier   : optional - nnU-Net plans identifier. Defaults to nnU-Net's default.
+      checkpoint_name    : optional - name of the checkpoint to load. Defaults to "model_final_checkpoint".
+      use_tta            : optional - whether to use or not test time augmentation (TTA). Defaults to False.
+      export_prob_maps   : optional - whether to export or not softmax probabilities. Defaults to False.
+    """
+
+    # the cascade requires the predictions of the low resolution model as input,
+    # so it cannot be served by a single warm model
+    assert(nnunet_model in ["2d", "3d_lowres", "3d_fullres"])
+
+    self.nnunet_model = nnunet_model
+    self.task_name = task_name
+    self.folds = folds
+    self.checkpoint_name = checkpoint_name
+    self.use_tta = use_tta
+    self.export_prob_maps = export_prob_maps
+
+    self.timings = {"load" : 0.0, "preprocess" : list(), "predict" : list(), "export" : list()}
+
+    self.model_folder = os.path.join(network_training_output_dir, nnunet_model, task_name,
+                                     trainer_class_name + "__" + plans_identifier)
+
+    start_time = time.time()
+    print("Loading `%s` model from %s..."%(nnunet_model, self.model_folder))
+
+    self.trainer, self.params = load_model_and_checkpoint_files(self.model_folder, folds,
+                                                                mixed_precision = False,
+                                                                checkpoint_name = checkpoint_name)
+
+    self.timings["load"] = time.time() - start_time
+    print("Done in %g seconds."%self.timings["load"])
+
+    self._predict_lock = threading.Lock()
+    self._queue = queue.Queue()
+    self._worker = threading.Thread(target = self._run, daemon = True)
+    self._worker.start()
+
+  # ----------------------------------
+
+  def preprocessing_key(self):
+
+    """
+    Signature of the preprocessing (cropping, resampling, normalization) of the model
+    configuration: predictors sharing the same key (e.g., configurations with the same plan
+    and stage) get the same preprocessed volume from the same input files.
+
+    Returns:
+      key : JSON string storing the preprocessing parameters.
+    """
+
+    trainer = self.trainer
+
+    key_dict = {"preprocessor_name" : trainer.plans.get("preprocessor_name", "GenericPreprocessor"),
+                "target_spacing" : trainer.plans["plans_per_stage"][trainer.stage]["current_spacing"],
+                "transpose_forward" : trainer.plans.get("transpose_forward"),
+                "normalization_schemes" : trainer.normalization_schemes,
+                "use_mask_for_norm" : trainer.use_mask_for_norm,
+                "intensity_properties" : trainer.intensity_properties}
+
+    return json.dumps(key_dict, sort_keys = True,
+                      default = lambda value: value.tolist() if hasattr(value, "tolist") else str(value))
+
+  # ----------------------------------
+
+  def preprocess(self, input_file_list):
+
+    """
+    Crop, resample and normalize a volume like the model configuration expects it.
+
+    Arguments:
+      input_file_list : required - list of the paths to the input NIfTI files (see `predict`).
+
+    Returns:
+      preprocessed : (data, properties) tuple, to be passed to `predict` (of this predictor,
+                     or of any predictor with the same `preprocessing_key`).
+    """
+
+    data, _, properties = self.trainer.preprocess_patient(input_file_list)
+
+    return data, properties
+
+  # ----------------------------------
+
+  def predict(self, input_file_list, output_file, preprocessed = None, npz_file = None):
+
+    """
+    Infer the segmentation mask of a single volume (blocking). Safe to call from several threads
+    (e.g., next to `submit`): the inference of concurrent calls is serialized.
+
+    Arguments:
+      input_file_list : required - list of the paths to the input NIfTI files (one per modality,
+                                   e.g., [`<pat_id>_0000.nii.gz`] for SegTHOR).
+      output_file     : required - path to the output NIfTI file (e.g., `<pat_id>.nii.gz`). If
+                                   `export_prob_maps` is True, the softmax probabilities are
+                                   saved next to it (`<pat_id>.npz`), like `nnUNet_predict --save_npz`.
+      preprocessed    : optional - output of `preprocess` for the same input files. Defaults to
+                                   None (the volume is preprocessed here).
+      npz_file        : optional - path to the softmax probabilities `.npz` file (exported even
+                                   if `export_prob_maps` is False). Defaults to None.
+
+    Returns:
+      timing_dict : dictionary storing the time spent in each stage (seconds).
+    """
+
+    trainer = self.trainer
+    timing_dict = dict()
+
+    start_time = time.time()
+    data, properties = preprocessed if preprocessed is not None else self.preprocess(input_file_list)
+    timing_dict["preprocess"] = time.time() - start_time
+
+    # the folds are loaded in turn into the shared trainer, so only one volume at a time can be
+    # inferred (e.g., from the background thread and from a direct call)
+    with self._predict_lock:
+      start_time = time.time()
+      softmax = None
+
+      # ensemble the folds by averaging their softmax outputs
+      for params in self.params:
+        trainer.load_checkpoint_ram(params, False)
+        fold_softmax = trainer.predict_preprocessed_data_return_seg_and_softmax(data,
+                                                                                do_mirroring = self.use_tta,
+                                                                                mirror_axes = trainer.data_aug_params["mirror_axes"],
+                                                                                use_sliding_window = True,
+                                                                                step_size = 0.5,
+                                                                                use_gaussian = True,
+                                                                                all_in_gpu = False,
+                                                                                mixed_precision = False)[1]
+        softmax = fold_softmax if softmax is None else softmax + fold_softmax
+
+      softmax /= len(self.params)
+
+      transpose_forward = trainer.plans.get("transpose_forward")
+      if transpose_forward is not None:
+        transpose_backward = trainer.plans.get("transpose_backward")
+        softmax = softmax.transpose([0] + [axis + 1 for axis in transpose_backward])
+
+      timing_dict["predict"] = time.time() - start_time
+
+      start_time = time.time()
+
+      if npz_file is None and self.export_prob_maps:
+        npz_file = output_file[:-len(".nii.gz")] + ".npz"
+
+      region_class_order = trainer.regions_class_order if hasattr(trainer, "regions_class_order") else None
+      force_separate_z = trainer.plans.get("segmentation_export_params", dict()).get("force_separate_z")
+      interpolation_order = trainer.plans.get("segmentation_export_params", dict()).get("interpolation_order", 1)
+      interpolation_order_z = trainer.plans.get("segmentation_export_params", dict()).get("interpolation_order_z", 0)
+
+      save_segmentation_nifti_from_softmax(softmax, output_file, properties, interpolation_order,
+                                           region_class_order, None, None, npz_file, None,
+                                           force_separate_z, interpolation_order_z)
+
+      timing_dict["export"] = time.time() - start_time
+
+      for stage in ["preprocess", "predict", "export"]:
+        self.timings[stage].append(timing_dict[stage])
+
+    return timing_dict
+
+  # ----------------------------------
+
+  def submit(self, input_file_list, output_file):
+
+    """
+    Queue a volume for inference (non-blocking). See `predict` for the arguments.
+
+    Returns:
+      future : `concurrent.futures.Future` resolving to the `predict` timing dictionary.
+    """
+
+    future = Future()
+    self._queue.put((input_file_list, output_file, future))
+
+    return future
+
+  # ----------------------------------
+
+  def _run(self):
+
+    while True:
+      input_file_list, output_file, future = self._queue.get()
+
+      if not future.set_running_or_notify_cancel():
+        continue
+
+      try:
+        future.set_result(self.predict(input_file_list, output_file))
+      except Exception as e:
+        future.set_exception(e)
+
+# ----------------------------------
+# ----------------------------------
+
+def predict_ensemble(predictor_list, input_file_list, output_file, weights = None,
+                     export_prob_maps = False, slab_size = 16):
+
+  """
+  Infer the segmentation mask of a single volume with an ensemble of warm predictors (e.g., the
+  `2d`, `3d_lowres` and `3d_fullres` configurations, or different trainers). The volume is
+  preprocessed once per distinct `preprocessing_key` - and not once per model - and the
+  softmax probabilities of the models are merged slab by slab (see `ensemble.ensemble_softmax`).
+
+  Arguments:
+    predictor_list   : required - list of `NNUNetPredictor` objects.
+    input_file_list  : required - list of the paths to the input NIfTI files (see `NNUNetPredictor.predict`).
+    output_file      : required - path to the ensembled output NIfTI file (e.g., `<pat_id>.nii.gz`).
+    weights          : optional - list of the weights of the models. Defaults to None (plain average).
+    export_prob_maps : optional - whether to export or not the averaged softmax probabilities
+                                  (next to `output_file`, as `<pat_id>.npz`). Defaults to False.
+    slab_size        : optional - number of slices merged at once. Defaults to 16.
+
+  Returns:
+    timing_dict : dictionary storing the time spent in each stage (seconds).
+  """
+
+  timing_dict = {"preprocess" : 0.0, "predict" : 0.0, "export" : 0.0}
+
+  # the outputs of the single models are only needed until they are merged
+  model_output_dir = tempfile.mkdtemp(prefix = "ensemble_", dir = os.path.dirname(os.path.abspath(output_file)))
+
+  try:
+    # group the predictors by preprocessing, so that every preprocessed volume is dropped
+    # as soon as all the models using it are done
+    key_list = [predictor.preprocessing_key() for predictor in predictor_list]
+    npz_path_list = [os.path.join(model_output_dir, "model_%d.npz"%(idx)) for idx in range(len(predictor_list))]
+
+    for key in sorted(set(key_list), key = key_list.index):
+      start_time = time.time()
+      preprocessed = predictor_list[key_list.index(key)].preprocess(input_file_list)
+      timing_dict["preprocess"] += time.time() - start_time
+
+      for idx, predictor in enumerate(predictor_list):
+        if key_list[idx] != key:
+          continue
+
+        model_timing_dict = predictor.predict(input_file_list,
+                                              os.path.join(model_output_dir, "model_%d.nii.gz"%(idx)),
+                                              preprocessed = preprocessed, npz_file = npz_path_list[idx])
+
+        timing_dict["predict"] += model_timing_dict["predict"]
+        timing_dict["export"] += model_timing_dict["export"]
+
+      del preprocessed
+
+    start_time = time.time()
+
+    ensemble.ensemble_softmax(npz_path_list = npz_path_list,
+                              output_label_path = output_file,
+                              reference_image_path = input_file_list[0],
+                              output_softmax_path = output_file[:-len(".nii.gz")] + ".npz" if export_prob_maps else None,
+                              weights = weights, slab_size = slab_size, spill_dir = model_output_dir)
+
+    timing_dict["ensemble"] = time.time() - start_time
+
+  finally:
+    shutil.rmtree(model_output_dir)
+
+  return timing_dict
+
+# ----------------------------------
+# ----------------------------------
+
+def serve_predictor(predictor, host = "127.0.0.1", port = 8555):
+
+  """
+  Expose a warm `NNUNetPredictor` through a (local) HTTP endpoint, so that the model can be
+  kept loaded across notebooks or processes. The requests are served by the predictor queue.
+
+  POST / with a JSON body {"input_files" : [...], "output_file" : "..."} returns the timing
+  dictionary as JSON (or {"error" : "..."} with status 500). GET / returns the cumulative
+  timings of the predictor.
+
+  Arguments:
+    predictor : required - `NNUNetPredictor` object.
+    host      : optional - address to bind to. Defaults to "127.0.0.1".
+    port      : optional - port to bind to. Defaults to 8555.
+
+  Returns:
+    server : `ThreadingHTTPServer` object (call `serve_forever()` to start serving,
+             e.g., in a separate thread; `shutdown()` to stop).
+  """
+
+  class PredictorRequestHandler(BaseHTTPRequestHandler):
+
+    def _reply(self, status, reply_dict):
+      body = json.dumps(reply_dict).encode("utf-8")
+      self.send_response(status)
+      self.send_header("Content-Type", "application/json")
+      self.send_header("Content-Length", str(len(body)))
+      self.end_headers()
+      self.wfile.write(body)
+
+    def do_GET(self):
+      self._reply(200, predictor.timings)
+
+    def do_POST(self):
+      try:
+        request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        timing_dict = predictor.submit(request["input_files"], request["output_file"]).result()
+        self._reply(200, timing_dict)
+      except Exception as e:
+        self._reply(500, {"error" : repr(e)})
+
+  return ThreadingHTTPServer((host, port), PredictorRequestHandler)
+
+# ----------------------------------
+# ----------------------------------
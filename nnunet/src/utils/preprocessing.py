@@ -11,12 +11,25 @@
 """
 
 import os
-import shutil
+
+import numpy as np
+import pydicom
+import SimpleITK as sitk
 import pyplastimatch as pypla
 
+from concurrent.futures import ThreadPoolExecutor
+
+from . import staging
+from . import rtstruct
+from . import artifacts
+from . import series_index
+from . import instrumentation
+from . import volume_writer
 
+
+@instrumentation.instrumented("ct_to_nrrd", series_arg = "pat_id")
 def pypla_dicom_ct_to_nrrd(sorted_base_path, processed_nrrd_path,
-                           pat_id, verbose = True):
+                           pat_id, verbose = True, cache = None):
   
   """
   Sorted DICOM patient data to NRRD file (CT volume).
@@ -26,6 +39,8 @@ def pypla_dicom_ct_to_nrrd(sorted_base_path, processed_nrrd_path,
     processed_nrrd_path : required - path to the folder where the preprocessed NRRD data are stored
     remove_raw          : required - patient ID (used for naming purposes).
     verbose             : optional - whether to run pyplastimatch in verbose mode. Defaults to true.
+    cache               : optional - `artifacts.ArtifactCache` the volume is fetched from (if the same
+                                     series was converted already) and published to. Defaults to None.
   
   Outputs:
     This function [...]
@@ -47,8 +62,17 @@ def pypla_dicom_ct_to_nrrd(sorted_base_path, processed_nrrd_path,
   # logfile for the plastimatch conversion
   log_file_path = os.path.join(pat_dir_nrrd_path, pat_id + '_pypla.log')
 
+  cache_key = None
+
+  # with a cache, only reuse a volume converted from the very same series
+  if cache is not None:
+    cache_key = artifacts.compute_key(artifacts.ct_series_uids(path_to_dicom_ct_folder),
+                                      "plastimatch_convert", {"output-img" : ".nrrd"})
+    if cache.fetch(cache_key, ct_nrrd_path):
+      return
+
   # DICOM CT to NRRD conversion (if the file doesn't exist yet)
-  if not os.path.exists(ct_nrrd_path):
+  if cache_key is not None or not os.path.exists(ct_nrrd_path):
     convert_args_ct = {"input" : path_to_dicom_ct_folder,
                        "output-img" : ct_nrrd_path}
 
@@ -59,11 +83,15 @@ def pypla_dicom_ct_to_nrrd(sorted_base_path, processed_nrrd_path,
                   path_to_log_file = log_file_path,
                   **convert_args_ct)
 
+    if cache_key is not None:
+      cache.publish(cache_key, ct_nrrd_path, {"converter" : "plastimatch_convert", "pat_id" : pat_id})
+
 # ----------------------------------
 # ----------------------------------
 
+@instrumentation.instrumented("ct_to_nifti", series_arg = "pat_id")
 def pypla_dicom_ct_to_nifti(sorted_base_path, processed_nifti_path,
-                            pat_id, verbose = True):
+                            pat_id, verbose = True, cache = None):
   
   """
   Sorted DICOM patient data to NIfTI file (CT volume).
@@ -73,6 +101,8 @@ def pypla_dicom_ct_to_nifti(sorted_base_path, processed_nifti_path,
     processed_nifti_path : required - path to the folder where the preprocessed NIfTI data are stored
     remove_raw           : required - patient ID (used for naming purposes).
     verbose              : optional - whether to run pyplastimatch in verbose mode. Defaults to true.
+    cache                : optional - `artifacts.ArtifactCache` the volume is fetched from (if the same
+                                      series was converted already) and published to. Defaults to None.
   
   Outputs:
     This function [...]
@@ -94,8 +124,17 @@ def pypla_dicom_ct_to_nifti(sorted_base_path, processed_nifti_path,
   # logfile for the plastimatch conversion
   log_file_path = os.path.join(pat_dir_nifti_path, pat_id + '_pypla.log')
 
+  cache_key = None
+
+  # with a cache, only reuse a volume converted from the very same series
+  if cache is not None:
+    cache_key = artifacts.compute_key(artifacts.ct_series_uids(path_to_dicom_ct_folder),
+                                      "plastimatch_convert", {"output-img" : ".nii.gz"})
+    if cache.fetch(cache_key, ct_nifti_path):
+      return
+
   # DICOM CT to NRRD conversion (if the file doesn't exist yet)
-  if not os.path.exists(ct_nifti_path):
+  if cache_key is not None or not os.path.exists(ct_nifti_path):
     convert_args_ct = {"input" : path_to_dicom_ct_folder,
                        "output-img" : ct_nifti_path}
 
@@ -106,11 +145,155 @@ def pypla_dicom_ct_to_nifti(sorted_base_path, processed_nifti_path,
                   path_to_log_file = log_file_path,
                   **convert_args_ct)
 
+    if cache_key is not None:
+      cache.publish(cache_key, ct_nifti_path, {"converter" : "plastimatch_convert", "pat_id" : pat_id})
+
 # ----------------------------------
 # ----------------------------------
 
+@instrumentation.instrumented("read_ct_volume")
+def read_dicom_ct_volume(path_to_dicom_ct_folder, num_workers = 8):
+
+  """
+  Read a (sorted) DICOM CT series into a single SimpleITK image. The slices are decoded
+  once, in a pool of threads, and ordered by the projection of ImagePositionPatient on
+  the slice normal (like the notebooks' `order_dicom_files_image_position`).
+
+  Arguments:
+    path_to_dicom_ct_folder : required - path to the folder storing the DICOM CT slices.
+    num_workers             : optional - number of threads used to read the slices. Defaults to 8.
+
+  Returns:
+    sitk_ct : SimpleITK image storing the CT volume (in HU), with the spacing, origin
+              and direction computed from the DICOM headers.
+  """
+
+  # the slices are ordered (and the geometry computed) from the cached, header-only series index
+  ct_index = series_index.build_series_index(path_to_dicom_ct_folder, num_workers = num_workers)
+
+  path_to_file_list = [os.path.join(path_to_dicom_ct_folder, fn) for fn in ct_index["file_name"]]
+
+  with ThreadPoolExecutor(max_workers = num_workers) as executor:
+    dcm_list = list(executor.map(pydicom.dcmread, path_to_file_list))
+
+  orientation = ct_index["image_orientation"]
+  x_vector, y_vector = orientation[:3], orientation[3:]
+  z_vector = np.cross(x_vector, y_vector)
+
+  pos_all = ct_index["z_position"]
+
+  slope_list = [float(getattr(dcm, "RescaleSlope", 1.0)) for dcm in dcm_list]
+  intercept_list = [float(getattr(dcm, "RescaleIntercept", 0.0)) for dcm in dcm_list]
+
+  # store HU as int16 (like plastimatch does) unless the rescale requires floats
+  is_integer = all(float(val).is_integer() for val in slope_list + intercept_list)
+  volume_dtype = np.int16 if is_integer else np.float32
+
+  first_dcm = dcm_list[0]
+  volume = np.empty((len(dcm_list), first_dcm.Rows, first_dcm.Columns), dtype = volume_dtype)
+
+  for z, dcm in enumerate(dcm_list):
+    volume[z] = dcm.pixel_array*slope_list[z] + intercept_list[z]
+
+  if len(pos_all) > 1:
+    z_spacing_all = np.diff(pos_all)
+    z_spacing = float(np.mean(z_spacing_all))
+
+    if not np.allclose(z_spacing_all, z_spacing, atol = 1e-2):
+      print("WARNING: non-uniform slice spacing found in %s (%g to %g mm)."%(path_to_dicom_ct_folder,
+                                                                           z_spacing_all.min(),
+                                                                           z_spacing_all.max()))
+  else:
+    z_spacing = float(getattr(first_dcm, "SliceThickness", 1.0))
+
+  # PixelSpacing is (row spacing, column spacing), i.e., (y, x)
+  pixel_spacing = [float(val) for val in first_dcm.PixelSpacing]
+
+  sitk_ct = sitk.GetImageFromArray(volume)
+  sitk_ct.SetSpacing((pixel_spacing[1], pixel_spacing[0], z_spacing))
+  sitk_ct.SetOrigin([float(val) for val in first_dcm.ImagePositionPatient])
+  sitk_ct.SetDirection(np.column_stack([x_vector, y_vector, z_vector]).flatten().tolist())
+
+  return sitk_ct
+
+# ----------------------------------
+# ----------------------------------
+
+@instrumentation.instrumented("ct_to_volumes", series_arg = "pat_id")
+def dicom_ct_to_volumes(sorted_base_path, pat_id, processed_nrrd_path = None,
+                        processed_nifti_path = None, num_workers = 8, cache = None):
+  
+  """
+  Sorted DICOM patient data to NRRD and/or NIfTI files (CT volume), decoding the
+  DICOM series only once. Native alternative to running both `pypla_dicom_ct_to_nrrd`
+  and `pypla_dicom_ct_to_nifti`, which invoke plastimatch on the same CT folder twice.
+
+  Arguments:
+    sorted_base_path     : required - path to the folder where the sorted data should be stored.
+    pat_id               : required - patient ID (used for naming purposes).
+    processed_nrrd_path  : optional - path to the folder where the preprocessed NRRD data are stored.
+                                      If None, no NRRD file is written. Defaults to None.
+    processed_nifti_path : optional - path to the folder where the preprocessed NIfTI data are stored.
+                                      If None, no NIfTI file is written. Defaults to None.
+    num_workers          : optional - number of threads used to read the slices. Defaults to 8.
+    cache                : optional - `artifacts.ArtifactCache` the volumes are fetched from (if they
+                                      were converted from the same series already) and published to.
+                                      If None, the files that exist already are kept as they are.
+                                      Defaults to None.
+
+  Returns:
+    output_path_list : list of the paths to the CT volumes (written now or found already).
+  """
+
+  # given that everything is standardised already, compute the paths
+  path_to_dicom_ct_folder = os.path.join(sorted_base_path, pat_id, "CT")
+  
+  # sanity check
+  assert(os.path.exists(path_to_dicom_ct_folder))
+
+  output_path_list = list()
+
+  if processed_nrrd_path is not None:
+    output_path_list.append(os.path.join(processed_nrrd_path, pat_id, pat_id + "_CT.nrrd"))
+
+  if processed_nifti_path is not None:
+    output_path_list.append(os.path.join(processed_nifti_path, pat_id, pat_id + "_CT.nii.gz"))
+
+  if cache is not None:
+    # the key depends on the series content (not on the paths), so it is shared across cohorts
+    ct_uid_list = artifacts.ct_series_uids(path_to_dicom_ct_folder)
+    key_dict = {path : artifacts.compute_key(ct_uid_list, "dicom_ct_to_volumes",
+                                             {"extension" : path.split("_CT")[-1]})
+                for path in output_path_list}
+
+    to_write_path_list = [path for path in output_path_list if not cache.fetch(key_dict[path], path)]
+
+  else:
+    # DICOM CT conversion (only for the files that don't exist yet)
+    to_write_path_list = [path for path in output_path_list if not os.path.exists(path)]
+
+  if len(to_write_path_list) == 0:
+    return output_path_list
+
+  sitk_ct = read_dicom_ct_volume(path_to_dicom_ct_folder, num_workers = num_workers)
+
+  for output_path in to_write_path_list:
+    if not os.path.exists(os.path.dirname(output_path)):
+      os.mkdir(os.path.dirname(output_path))
+
+    volume_writer.write_volume(sitk_ct, output_path, output_type = "ct")
+
+    if cache is not None:
+      cache.publish(key_dict[output_path], output_path, {"converter" : "dicom_ct_to_volumes", "pat_id" : pat_id})
+
+  return output_path_list
+
+# ----------------------------------
+# ----------------------------------
+
+@instrumentation.instrumented("rtstruct_to_nrrd", series_arg = "pat_id")
 def pypla_dicom_rtstruct_to_nrrd(sorted_base_path, processed_nrrd_path,
-                                 pat_id, verbose = True):
+                                 pat_id, verbose = True, cache = None):
   
   """
   Sorted DICOM patient data to NRRD file (RTSTRUCT).
@@ -120,6 +303,9 @@ def pypla_dicom_rtstruct_to_nrrd(sorted_base_path, processed_nrrd_path,
     processed_nrrd_path : required - path to the folder where the preprocessed NRRD data are stored
     remove_raw          : required - patient ID (used for naming purposes).
     verbose             : optional - whether to run pyplastimatch in verbose mode. Defaults to true.
+    cache               : optional - `artifacts.ArtifactCache` the masks are fetched from (if the same
+                                     RTSTRUCT was converted on the same CT series already) and published
+                                     to. Defaults to None.
   
   Outputs:
     This function [...]
@@ -143,8 +329,22 @@ def pypla_dicom_rtstruct_to_nrrd(sorted_base_path, processed_nrrd_path,
   # (from the DICOM RTSTRUCT)
   log_file_path = os.path.join(pat_dir_nrrd_path, pat_id + '_pypla.log')
 
+  cache_key = None
+
+  # with a cache, only reuse masks converted from the very same RTSTRUCT and CT series
+  if cache is not None:
+    rt_uid_list = [str(pydicom.dcmread(os.path.join(path_to_dicom_rt_folder, fn), stop_before_pixels = True,
+                                       specific_tags = ["SOPInstanceUID"]).SOPInstanceUID)
+                   for fn in sorted(os.listdir(path_to_dicom_rt_folder))]
+
+    # the name of the structure list depends on `pat_id`
+    cache_key = artifacts.compute_key(rt_uid_list + artifacts.ct_series_uids(path_to_dicom_ct_folder),
+                                      "plastimatch_convert", {"prefix-format" : "nrrd", "pat_id" : pat_id})
+    if cache.fetch(cache_key, rt_folder_path):
+      return
+
   # DICOM CT to NRRD conversion (if the file doesn't exist yet)
-  if not os.path.exists(rt_folder_path):
+  if cache_key is not None or not os.path.exists(rt_folder_path):
     convert_args_rt = {"input" : path_to_dicom_rt_folder, 
                        "referenced-ct" : path_to_dicom_ct_folder,
                        "output-prefix" : rt_folder_path,
@@ -155,33 +355,112 @@ def pypla_dicom_rtstruct_to_nrrd(sorted_base_path, processed_nrrd_path,
                   path_to_log_file = log_file_path,
                   **convert_args_rt)
 
+    if cache_key is not None:
+      cache.publish(cache_key, rt_folder_path, {"converter" : "plastimatch_convert", "pat_id" : pat_id})
+
 # ----------------------------------
 # ----------------------------------
 
-def prep_input_data(processed_nifti_path, model_input_folder, pat_id):
-  
+@instrumentation.instrumented("rasterize_rtstruct", series_arg = "pat_id")
+def dicom_rtstruct_to_nrrd(sorted_base_path, processed_nrrd_path, pat_id,
+                           roi_name_list = None, export_nrrd = True):
+
   """
-  Sorted DICOM patient data to NRRD file (RTSTRUCT).
+  Sorted DICOM patient data to segmentation masks (RTSTRUCT), rasterized in-process on the CT
+  grid (see `rtstruct.rasterize_rtstruct`) - the in-memory alternative to
+  `pypla_dicom_rtstruct_to_nrrd`, which only decodes the requested ROIs.
 
   Arguments:
-    src_folder : required - path to the folder where the sorted data should be stored.
-    dst_folder : required - path to the folder where the preprocessed NRRD data are stored
-    pat_id     : required - patient ID (used for naming purposes).
+    sorted_base_path    : required - path to the folder where the sorted data should be stored.
+    processed_nrrd_path : required - path to the folder where the preprocessed NRRD data are stored.
+    pat_id              : required - patient ID (used for naming purposes).
+    roi_name_list       : optional - names of the ROIs to rasterize (case-insensitive). Defaults
+                                     to None (all the ROIs).
+    export_nrrd         : optional - whether to write the masks (and the `_rt_list.txt` structure
+                                     list) under `rt_segmasks`, like `pypla_dicom_rtstruct_to_nrrd`.
+                                     Defaults to True.
+
+  Returns:
+    segmask_dict : dictionary of boolean numpy arrays (z, y, x), indexed by ROI name.
+    geometry     : dictionary storing the "spacing", "origin" and "direction" of the volumes.
+  """
+
+  path_to_dicom_ct_folder = os.path.join(sorted_base_path, pat_id, "CT")
+  path_to_dicom_rt_folder = os.path.join(sorted_base_path, pat_id, "RTSTRUCT")
+
+  # sanity check
+  assert(os.path.exists(path_to_dicom_rt_folder))
+
+  rt_fn_list = sorted(os.listdir(path_to_dicom_rt_folder))
+  assert(len(rt_fn_list) > 0)
+
+  dcm_rt = pydicom.dcmread(os.path.join(path_to_dicom_rt_folder, rt_fn_list[0]))
+
+  segmask_dict, geometry = rtstruct.rasterize_rtstruct(dcm_rt = dcm_rt,
+                                                       path_to_ct_dir = path_to_dicom_ct_folder,
+                                                       roi_name_list = roi_name_list)
+
+  if export_nrrd:
+    pat_dir_nrrd_path = os.path.join(processed_nrrd_path, pat_id)
+    rt_folder_path = os.path.join(pat_dir_nrrd_path, "rt_segmasks")
+
+    os.makedirs(pat_dir_nrrd_path, exist_ok = True)
+
+    rtstruct.export_rtstruct_nrrd(segmask_dict = segmask_dict,
+                                  geometry = geometry,
+                                  path_to_output_dir = rt_folder_path,
+                                  rt_list_path = os.path.join(rt_folder_path, pat_id + "_rt_list.txt"),
+                                  color_dict = {roi["name"] : roi["color"] for roi in rtstruct.read_rtstruct_rois(dcm_rt)})
+
+  return segmask_dict, geometry
+
+# ----------------------------------
+# ----------------------------------
+
+@instrumentation.instrumented("prep_input_data", series_arg = "pat_id")
+def prep_input_data(processed_nifti_path, model_input_folder, pat_id,
+                    input_suffix = "_0000", manifest_path = None, link_mode = "hardlink",
+                    cropped = False):
   
-  Outputs:
-    This function [...]
+  """
+  Stage the NIfTI CT volume in the model input folder. The file is linked rather than
+  copied (copied only across filesystems), and recorded in a staging manifest, so that
+  it can be removed after the inference with `staging.cleanup_staged`.
+
+  Arguments:
+    processed_nifti_path : required - path to the folder where the preprocessed NIfTI data are stored.
+    model_input_folder   : required - path to the folder where the data to be inferred should be stored.
+    pat_id               : required - patient ID (used for naming purposes).
+    input_suffix         : optional - suffix of the staged file name. Defaults to "_0000" (nnU-Net
+                                      modality suffix); use "" for body part regression.
+    manifest_path        : optional - path to the JSONL staging manifest. Defaults to the one
+                                      associated to `model_input_folder` (see `staging.default_manifest_path`).
+    link_mode            : optional - "hardlink", "symlink" or "copy". Defaults to "hardlink".
+    cropped              : optional - whether to stage the cropped CT volume (`<pat_id>_CT_crop.nii.gz`,
+                                      see `cropping.crop_ct_to_region`) instead of the full one.
+                                      Defaults to False.
+
+  Returns:
+    staged_path : path to the staged NIfTI file.
   """
 
   pat_dir_nifti_path = os.path.join(processed_nifti_path, pat_id)
-  ct_nifti_path = os.path.join(pat_dir_nifti_path, pat_id + "_CT.nii.gz")
+  ct_nifti_path = os.path.join(pat_dir_nifti_path, pat_id + ("_CT_crop.nii.gz" if cropped else "_CT.nii.gz"))
   
-  copy_to_path = os.path.join(model_input_folder, pat_id + "_0000.nii.gz")
-    
-  # copy NIfTI to the right dir for nnU-Net processing
-  if not os.path.exists(copy_to_path):
-    print("Copying %s\nto %s..."%(ct_nifti_path, copy_to_path))
-    shutil.copy(ct_nifti_path, copy_to_path)
-    print("... Done.")
+  staged_path = os.path.join(model_input_folder, pat_id + input_suffix + ".nii.gz")
+
+  if manifest_path is None:
+    manifest_path = staging.default_manifest_path(model_input_folder)
+
+  # stage NIfTI in the right dir for nnU-Net processing
+  if not os.path.exists(staged_path):
+    print("Staging %s\nto %s..."%(ct_nifti_path, staged_path))
+    staged_with = staging.stage_file(ct_nifti_path, staged_path,
+                                     manifest_path = manifest_path,
+                                     pat_id = pat_id, link_mode = link_mode)
+    print("... Done (%s)."%(staged_with))
+
+  return staged_path
 
 # ----------------------------------
 # ----------------------------------
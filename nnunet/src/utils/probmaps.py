@@ -0,0 +1,126 @@
+"""
+    ----------------------------------------
+    IDC-MedImA-misc - probability maps utils
+    ----------------------------------------
+
+    ----------------------------------------
+    Author: Dennis Bontempi
+    Email:  dennis_bontempi@dfci.harvard.edu
+    ----------------------------------------
+
+"""
+
+import os
+
+import h5py
+import numpy as np
+import SimpleITK as sitk
+
+from . import postprocessing
+
+
+def numpy_to_h5(model_output_folder, processed_nrrd_path, pat_id,
+                output_fn = "pred_softmax.h5", output_dtype = "uint8",
+                structure_list = ["Background", "Esophagus",
+                                  "Heart", "Trachea", "Aorta"],
+                chunk_shape = (16, 128, 128), compression_level = 4):
+
+  """
+  Convert softmax probability maps to a single chunked, compressed HDF5 container - an
+  alternative to `postprocessing.numpy_to_nrrd`, which writes one gzip NRRD per structure.
+  Every structure is stored as a separate chunked dataset, so that a single structure
+  (or a slab/ROI of it) can be read without decoding the others.
+
+  Arguments:
+    model_output_folder : required - path to the folder where the inferred segmentation masks should be stored.
+    processed_nrrd_path : required - path to the folder where the preprocessed NRRD data are stored.
+    pat_id              : required - patient ID (used for naming purposes).
+    output_fn           : optional - name of the HDF5 file, saved under the patient directory
+                                     (under `processed_nrrd_path`). Defaults to "pred_softmax.h5".
+    output_dtype        : optional - output data type, between uint8, uint16 or float32. Defaults to uint8.
+    structure_list      : optional - list of the structures whose probability maps are stored in the
+                                     `.npz` file (see `postprocessing.numpy_to_nrrd`). Defaults to the
+                                     structure list for the SegTHOR challenge (background = 0 included).
+    chunk_shape         : optional - shape (z, y, x) of the compressed chunks. Defaults to (16, 128, 128).
+    compression_level   : optional - gzip compression level (0-9). Defaults to 4.
+
+  Returns:
+    output_path : path to the HDF5 file.
+  """
+
+  assert(output_dtype in ["uint8", "uint16", "float32"])
+
+  pred_softmax_path = os.path.join(model_output_folder, pat_id + ".npz")
+
+  # parse the NRRD header only - we will make use of it to store the geometry
+  ct_nrrd_path = os.path.join(processed_nrrd_path, pat_id, pat_id + "_CT.nrrd")
+
+  ct_reader = sitk.ImageFileReader()
+  ct_reader.SetFileName(ct_nrrd_path)
+  ct_reader.ReadImageInformation()
+
+  output_path = os.path.join(processed_nrrd_path, pat_id, output_fn)
+
+  # float32 values are stored as they are, integers are rescaled between 0 and the dtype max
+  scale = 1.0 if output_dtype == "float32" else float(np.iinfo(output_dtype).max)
+
+  # write to a temporary file first, so that a partial file is never mistaken for a complete one
+  with h5py.File(output_path + ".tmp", "w") as h5_file:
+    h5_file.attrs["spacing"] = ct_reader.GetSpacing()
+    h5_file.attrs["origin"] = ct_reader.GetOrigin()
+    h5_file.attrs["direction"] = ct_reader.GetDirection()
+    h5_file.attrs["scale"] = scale
+    h5_file.attrs["structure_list"] = list(structure_list)
+
+    for channel_softmax, structure in zip(postprocessing.iter_npz_channels(pred_softmax_path),
+                                          structure_list):
+      pred_softmax_segmask = postprocessing.quantize_softmax(channel_softmax, output_dtype)
+
+      h5_file.create_dataset(structure, data = pred_softmax_segmask,
+                             chunks = tuple(min(c, s) for c, s in zip(chunk_shape, pred_softmax_segmask.shape)),
+                             compression = "gzip" if compression_level > 0 else None,
+                             compression_opts = compression_level if compression_level > 0 else None,
+                             shuffle = output_dtype != "uint8")
+
+  os.replace(output_path + ".tmp", output_path)
+
+  return output_path
+
+# ----------------------------------
+# ----------------------------------
+
+def read_h5_probmap(path_to_h5_file, structure, roi = None, as_probability = True):
+
+  """
+  Read (a region of) the probability map of a single structure from a file written by
+  `numpy_to_h5`. Only the chunks overlapping the requested region are decompressed.
+
+  Arguments:
+    path_to_h5_file : required - path to the HDF5 file.
+    structure       : required - name of the structure (e.g., "Heart").
+    roi             : optional - tuple of slices (z, y, x) selecting the region to read, e.g.,
+                                 `(slice(100, 120), slice(None), slice(None))` for a slab.
+                                 Defaults to None (the whole volume).
+    as_probability  : optional - whether to convert the stored (quantized) values back to
+                                 float32 probabilities between 0 and 1. Defaults to True.
+
+  Returns:
+    probmap  : numpy array (z, y, x) storing the requested region.
+    geometry : dictionary storing the "spacing", "origin" and "direction" of the volume
+               (SimpleITK convention, i.e., x, y, z ordering).
+  """
+
+  with h5py.File(path_to_h5_file, "r") as h5_file:
+    dataset = h5_file[structure]
+    probmap = dataset[roi if roi is not None else ()]
+
+    geometry = {key : tuple(float(val) for val in h5_file.attrs[key])
+                for key in ["spacing", "origin", "direction"]}
+
+    if as_probability:
+      probmap = np.divide(probmap, h5_file.attrs["scale"], dtype = np.float32)
+
+  return probmap, geometry
+
+# ----------------------------------
+# ----------------------------------
@@ -12,8 +12,51 @@
 
 import os
 import time
+import shutil
+import tempfile
 import subprocess
 
+from . import staging
+from . import preprocessing
+from . import instrumentation
+
+# nnU-Net task `nnUNet_predict` is run with
+NNUNET_TASK_NAME = "Task055_SegTHOR"
+
+
+def _nnunet_predict_command(model_input_folder, model_output_folder, nnunet_model,
+                            use_tta = False, export_prob_maps = False,
+                            num_threads_preprocessing = None, num_threads_nifti_save = None):
+
+  """
+  Build the `nnUNet_predict` command line (see `process_patient_nnunet`).
+  """
+
+  bash_command = list()
+  bash_command += ["nnUNet_predict"]
+  bash_command += ["--input_folder", "%s"%model_input_folder]
+  bash_command += ["--output_folder", "%s"%model_output_folder]
+  bash_command += ["--task_name", NNUNET_TASK_NAME]
+  bash_command += ["--model", "%s"%nnunet_model]
+  
+  if use_tta == False:
+    bash_command += ["--disable_tta"]
+  
+  if export_prob_maps == True:
+    bash_command += ["--save_npz"]
+
+  if num_threads_preprocessing is not None:
+    bash_command += ["--num_threads_preprocessing", "%g"%num_threads_preprocessing]
+
+  if num_threads_nifti_save is not None:
+    bash_command += ["--num_threads_nifti_save", "%g"%num_threads_nifti_save]
+
+  return bash_command
+
+# ----------------------------------
+# ----------------------------------
+
+@instrumentation.instrumented("nnunet_inference")
 def process_patient_nnunet(model_input_folder, model_output_folder, nnunet_model,
                            use_tta = False, export_prob_maps = False):
 
@@ -48,21 +91,140 @@ def process_patient_nnunet(model_input_folder, model_output_folder, nnunet_model
   #       to set manually all the arguments that the user is not intended
   #       to fiddle with; so stick with the bash executable
 
-  bash_command = list()
-  bash_command += ["nnUNet_predict"]
-  bash_command += ["--input_folder", "%s"%model_input_folder]
-  bash_command += ["--output_folder", "%s"%model_output_folder]
-  bash_command += ["--task_name", "Task055_SegTHOR"]
-  bash_command += ["--model", "%s"%nnunet_model]
-  
-  if use_tta == False:
-    bash_command += ["--disable_tta"]
-  
-  if export_prob_maps == True:
-    bash_command += ["--save_npz"]
+  bash_command = _nnunet_predict_command(model_input_folder, model_output_folder, nnunet_model,
+                                         use_tta = use_tta, export_prob_maps = export_prob_maps)
 
   bash_return = subprocess.run(bash_command, check = True, text = True)
 
   elapsed = time.time() - start_time
 
-  print("Done in %g seconds."%elapsed)
\ No newline at end of file
+  print("Done in %g seconds."%elapsed)
+
+# ----------------------------------
+# ----------------------------------
+
+@instrumentation.instrumented("nnunet_batch_inference")
+def process_batch_nnunet(processed_nifti_path, model_input_folder, model_output_folder,
+                         pat_id_list, nnunet_model, use_tta = False, export_prob_maps = False,
+                         num_threads_preprocessing = 6, num_threads_nifti_save = 2):
+
+  """
+  Infer the thoracic organs at risk segmentation maps for a batch of patients, with a single
+  `nnUNet_predict` invocation - so that the model is loaded only once for the whole batch.
+  The patients are staged in a subfolder of `model_input_folder` created for the batch (with its
+  own staging manifest), so that only the patients of the batch are inferred - and the staged
+  files are removed after the inference.
+
+  Arguments:
+    processed_nifti_path      : required - path to the folder where the preprocessed NIfTI data are stored.
+    model_input_folder        : required - path to the folder where the batch subfolder (storing the data
+                                           to be inferred) is created.
+    model_output_folder       : required - path to the folder where the inferred segmentation masks will be stored.
+    pat_id_list               : required - list of the IDs of the patients to process.
+    nnunet_model              : required - pre-trained nnU-Net model to use during the inference phase.
+    use_tta                   : optional - whether to use or not test time augmentation (TTA). Defaults to False.
+    export_prob_maps          : optional - whether to export or not softmax probabilities. Defaults to False.
+    num_threads_preprocessing : optional - number of nnU-Net preprocessing workers. Defaults to 6.
+    num_threads_nifti_save    : optional - number of nnU-Net export workers. Defaults to 2.
+
+  Returns:
+    status_dict : dictionary storing, for each patient, the status of the inference ("done",
+                  "skipped" - `nnUNet_predict` does not overwrite the outputs found already -
+                  or "failed"), the path to the inferred segmentation mask, the time elapsed
+                  between the start of the batch and the moment the output was written
+                  ("elapsed") and the time spent on the patient ("duration"; both None if
+                  the patient was skipped).
+  """
+
+  assert(nnunet_model in ["2d", "3d_lowres", "3d_fullres", "3d_cascade_fullres"])
+
+  # outputs from a previous run - `nnUNet_predict` skips these patients
+  previous_mtime_dict = dict()
+
+  for pat_id in pat_id_list:
+    pred_nifti_path = os.path.join(model_output_folder, pat_id + ".nii.gz")
+
+    if os.path.exists(pred_nifti_path):
+      previous_mtime_dict[pat_id] = os.path.getmtime(pred_nifti_path)
+
+  # stage the patients of the batch only, in a subfolder of their own - anything else found
+  # in the input folder (e.g., left over by an interrupted batch) is not inferred
+  os.makedirs(model_input_folder, exist_ok = True)
+
+  batch_input_folder = tempfile.mkdtemp(prefix = "batch_", dir = model_input_folder)
+  batch_manifest_path = staging.default_manifest_path(batch_input_folder)
+
+  try:
+    for pat_id in pat_id_list:
+      preprocessing.prep_input_data(processed_nifti_path = processed_nifti_path,
+                                    model_input_folder = batch_input_folder,
+                                    pat_id = pat_id,
+                                    manifest_path = batch_manifest_path)
+
+    start_time = time.time()
+
+    print("Running `nnUNet_predict` with `%s` model on %g patients..."%(nnunet_model, len(pat_id_list)))
+
+    bash_command = _nnunet_predict_command(batch_input_folder, model_output_folder, nnunet_model,
+                                           use_tta = use_tta, export_prob_maps = export_prob_maps,
+                                           num_threads_preprocessing = num_threads_preprocessing,
+                                           num_threads_nifti_save = num_threads_nifti_save)
+
+    bash_return = subprocess.run(bash_command, check = False, text = True)
+
+    elapsed = time.time() - start_time
+
+    print("Done in %g seconds (return code %g)."%(elapsed, bash_return.returncode))
+
+  finally:
+    if os.path.exists(batch_manifest_path):
+      staging.cleanup_staged(batch_manifest_path)
+      os.remove(batch_manifest_path)
+
+    shutil.rmtree(batch_input_folder, ignore_errors = True)
+
+  # map the outputs back to the patient IDs
+  status_dict = dict()
+
+  for pat_id in pat_id_list:
+    pred_nifti_path = os.path.join(model_output_folder, pat_id + ".nii.gz")
+
+    status_dict[pat_id] = {"status" : "failed", "pred_nifti_path" : None,
+                           "elapsed" : None, "duration" : None}
+
+    if not os.path.exists(pred_nifti_path):
+      continue
+
+    status_dict[pat_id]["pred_nifti_path"] = pred_nifti_path
+
+    if os.path.getmtime(pred_nifti_path) == previous_mtime_dict.get(pat_id):
+      status_dict[pat_id]["status"] = "skipped"
+    else:
+      status_dict[pat_id]["status"] = "done"
+      status_dict[pat_id]["elapsed"] = max(os.path.getmtime(pred_nifti_path) - start_time, 0.0)
+
+  # nnU-Net exports the cases one after the other, so the time between two consecutive
+  # outputs is a good estimate of the time spent on each patient (the skipped patients
+  # take no time)
+  done_id_list = sorted([pat_id for pat_id in status_dict if status_dict[pat_id]["status"] == "done"],
+                        key = lambda pat_id: status_dict[pat_id]["elapsed"])
+
+  previous_elapsed = 0.0
+  for pat_id in done_id_list:
+    status_dict[pat_id]["duration"] = status_dict[pat_id]["elapsed"] - previous_elapsed
+    previous_elapsed = status_dict[pat_id]["elapsed"]
+
+  num_failed = len([pat_id for pat_id in status_dict if status_dict[pat_id]["status"] == "failed"])
+
+  num_skipped = len([pat_id for pat_id in status_dict if status_dict[pat_id]["status"] == "skipped"])
+
+  if num_skipped > 0:
+    print("Output found already for %g patients - skipped by `nnUNet_predict`."%(num_skipped))
+
+  if num_failed > 0:
+    print("WARNING: no output found for %g patients."%(num_failed))
+
+  return status_dict
+
+# ----------------------------------
+# ----------------------------------
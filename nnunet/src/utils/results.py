@@ -0,0 +1,272 @@
+"""
+    ----------------------------------------
+    IDC-MedImA-misc - results logging utils
+    ----------------------------------------
+
+    ----------------------------------------
+    Author: Dennis Bontempi
+    Email:  dennis_bontempi@dfci.harvard.edu
+    ----------------------------------------
+
+"""
+
+import os
+import time
+import sqlite3
+import threading
+
+from contextlib import closing
+
+import pandas as pd
+
+
+class BigQueryBackend:
+
+  """
+  Write rows to BigQuery tables of a given dataset, sharing a single `bigquery.Client`
+  (created lazily, on first use) across all the tables.
+  """
+
+  def __init__(self, project_name, dataset_name):
+    self.project_name = project_name
+    self.dataset_name = dataset_name
+    self._client = None
+    self._lock = threading.Lock()
+
+  def client(self):
+
+    # imported here, so that the local backends can be used without the BigQuery client installed
+    from google.cloud import bigquery
+
+    with self._lock:
+      if self._client is None:
+        self._client = bigquery.Client(project = self.project_name)
+    return self._client
+
+  def table_id(self, table_name):
+    return ".".join([self.project_name, self.dataset_name, table_name])
+
+  def fetch_keys(self, table_name, key_column):
+
+    from google.cloud.exceptions import NotFound
+
+    query = "SELECT DISTINCT %s AS key FROM `%s`"%(key_column, self.table_id(table_name))
+
+    try:
+      return set(row["key"] for row in self.client().query(query).result())
+    except NotFound:
+      return set()
+
+  def insert_rows(self, table_name, row_list):
+
+    error_list = self.client().insert_rows_json(table = self.table_id(table_name),
+                                                json_rows = row_list,
+                                                skip_invalid_rows = False,
+                                                ignore_unknown_values = False)
+
+    if error_list:
+      raise RuntimeError("Insertion into %s failed: %s"%(self.table_id(table_name), error_list))
+
+# ----------------------------------
+# ----------------------------------
+
+class SQLiteBackend:
+
+  """
+  Stand-in for `BigQueryBackend` (e.g., for testing purposes): the rows are stored in the
+  tables of a local SQLite database. Tables are created on the first insertion, with the
+  columns of the first row.
+  """
+
+  def __init__(self, db_path):
+    self.db_path = db_path
+    self._lock = threading.Lock()
+
+  def _table_exists(self, connection, table_name):
+    return connection.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = ?",
+                              (table_name,)).fetchone() is not None
+
+  def fetch_keys(self, table_name, key_column):
+
+    with self._lock, closing(sqlite3.connect(self.db_path)) as connection, connection:
+      if not self._table_exists(connection, table_name):
+        return set()
+
+      return set(row[0] for row in connection.execute('SELECT DISTINCT "%s" FROM "%s"'%(key_column, table_name)))
+
+  def insert_rows(self, table_name, row_list):
+
+    column_list = list(row_list[0].keys())
+
+    with self._lock, closing(sqlite3.connect(self.db_path)) as connection, connection:
+      if not self._table_exists(connection, table_name):
+        connection.execute('CREATE TABLE "%s" (%s)'%(table_name, ", ".join('"%s"'%column for column in column_list)))
+
+      connection.executemany('INSERT INTO "%s" (%s) VALUES (%s)'%(table_name,
+                                                                ", ".join('"%s"'%column for column in column_list),
+                                                                ", ".join("?" for _ in column_list)),
+                             [tuple(row.get(column) for column in column_list) for row in row_list])
+
+# ----------------------------------
+# ----------------------------------
+
+class ParquetBackend:
+
+  """
+  Stand-in for `BigQueryBackend` (e.g., for testing purposes): every flush is stored as a
+  Parquet file under `root_path`/<table_name>/ (requires `pyarrow` or `fastparquet`).
+  """
+
+  def __init__(self, root_path):
+    self.root_path = root_path
+    self._lock = threading.Lock()
+    self._part_count = 0
+
+  def fetch_keys(self, table_name, key_column):
+
+    table_path = os.path.join(self.root_path, table_name)
+
+    if not os.path.isdir(table_path):
+      return set()
+
+    key_set = set()
+
+    for fn in sorted(os.listdir(table_path)):
+      if fn.endswith(".parquet"):
+        key_set.update(pd.read_parquet(os.path.join(table_path, fn), columns = [key_column])[key_column])
+
+    return key_set
+
+  def insert_rows(self, table_name, row_list):
+
+    table_path = os.path.join(self.root_path, table_name)
+
+    with self._lock:
+      os.makedirs(table_path, exist_ok = True)
+      self._part_count += 1
+      part_fn = "part-%d-%d-%05d.parquet"%(time.time()*1000, os.getpid(), self._part_count)
+
+    # write to a temporary file first, so that a partial file is never read back
+    part_path = os.path.join(table_path, part_fn)
+    pd.DataFrame(row_list).to_parquet(part_path + ".tmp", index = False)
+    os.replace(part_path + ".tmp", part_path)
+
+# ----------------------------------
+# ----------------------------------
+
+class ResultsWriter:
+
+  """
+  Buffered sink for the per-series logs (e.g., the nnU-Net and BPR timing tables): rows are
+  deduplicated by `key_column` against the keys already in the table (fetched once, with a
+  single query, and cached locally) and inserted in bulk - when `max_rows` rows are buffered,
+  when the oldest buffered row is older than `max_delay` seconds (checked at every `append`),
+  and when the writer is closed. Replaces the notebooks' `append_row_to_bq_table_with_query`,
+  which ran one COUNT query and one insertion per row.
+
+  Can be used as a context manager, so that the buffered rows are flushed on exit:
+
+    with ResultsWriter(BigQueryBackend(project_name, dataset_name), table_name) as writer:
+      for series_id in series_id_list:
+        ...
+        writer.append(row_dict)
+  """
+
+  def __init__(self, backend, table_name, key_column = "SeriesInstanceUID", max_rows = 50, max_delay = 300):
+
+    """
+    Arguments:
+      backend    : required - backend the rows are written to (`BigQueryBackend`, `SQLiteBackend`
+                              or `ParquetBackend`).
+      table_name : required - name of the table.
+      key_column : optional - column used to deduplicate the rows. Defaults to "SeriesInstanceUID".
+      max_rows   : optional - number of buffered rows triggering a flush. Defaults to 50.
+      max_delay  : optional - maximum time (in seconds) a row is kept in the buffer. Defaults to 300.
+    """
+
+    self.backend = backend
+    self.table_name = table_name
+    self.key_column = key_column
+    self.max_rows = max_rows
+    self.max_delay = max_delay
+
+    self._key_set = None
+    self._buffer = list()
+    self._buffer_start_time = None
+    self._lock = threading.RLock()
+
+  # ----------------------------------
+
+  def append(self, row):
+
+    """
+    Buffer a row for insertion, unless a row with the same key is already in the table
+    (or in the buffer).
+
+    Arguments:
+      row : required - dictionary storing the row to insert (must include `key_column`).
+
+    Returns:
+      appended : True if the row was buffered, False if it was a duplicate.
+    """
+
+    key = row[self.key_column]
+
+    with self._lock:
+      if self._key_set is None:
+        self._key_set = set(self.backend.fetch_keys(self.table_name, self.key_column))
+
+      if key in self._key_set:
+        print("Cannot insert row because %s %s exists in table %s"%(self.key_column, key, self.table_name))
+        return False
+
+      self._key_set.add(key)
+      self._buffer.append(dict(row))
+
+      if self._buffer_start_time is None:
+        self._buffer_start_time = time.time()
+
+      if len(self._buffer) >= self.max_rows or time.time() - self._buffer_start_time >= self.max_delay:
+        self.flush()
+
+    return True
+
+  # ----------------------------------
+
+  def flush(self):
+
+    """
+    Insert all the buffered rows with a single call to the backend. If the insertion fails,
+    the rows are kept in the buffer (and the exception is raised).
+
+    Returns:
+      num_rows : number of rows inserted.
+    """
+
+    with self._lock:
+      if not self._buffer:
+        return 0
+
+      self.backend.insert_rows(self.table_name, self._buffer)
+
+      num_rows = len(self._buffer)
+      print("Inserted %g rows into table %s."%(num_rows, self.table_name))
+
+      self._buffer = list()
+      self._buffer_start_time = None
+
+    return num_rows
+
+  # ----------------------------------
+
+  def close(self):
+    self.flush()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.close()
+
+# ----------------------------------
+# ----------------------------------
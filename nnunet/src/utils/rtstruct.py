@@ -0,0 +1,273 @@
+"""
+    ----------------------------------------
+    IDC-MedImA-misc - DICOM RTSTRUCT utils
+    ----------------------------------------
+
+    ----------------------------------------
+    Author: Dennis Bontempi
+    Email:  dennis_bontempi@dfci.harvard.edu
+    ----------------------------------------
+
+"""
+
+import re
+
+import numpy as np
+import pydicom
+
+from . import dicomseg
+
+# (3006,0050) ContourData
+_CONTOUR_DATA_TAG = 0x30060050
+
+
+def _contour_points(contour_item):
+
+  """
+  Decode the ContourData of a contour as a (N, 3) array - straight from the raw value, when
+  the element was not parsed yet (much faster than pydicom's per-value DS conversion).
+  """
+
+  value = contour_item.get_item(_CONTOUR_DATA_TAG).value
+
+  if isinstance(value, bytes):
+    point_array = np.array(value.decode("ascii").strip(" \x00").split("\\"), dtype = np.float64)
+  else:
+    point_array = np.array(value, dtype = np.float64)
+
+  return point_array.reshape(-1, 3)
+
+# ----------------------------------
+# ----------------------------------
+
+def read_rtstruct_rois(dcm_rt):
+
+  """
+  List the ROIs of a DICOM RTSTRUCT, without decoding any contour.
+
+  Arguments:
+    dcm_rt : required - path to the DICOM RTSTRUCT file, or the pydicom Dataset.
+
+  Returns:
+    roi_list : list (in StructureSetROISequence order) of dictionaries storing the "number",
+               the "name", the display "color" (R, G, B) and the list of "contours" (the
+               ContourSequence items, not decoded) of every ROI.
+  """
+
+  if not isinstance(dcm_rt, pydicom.Dataset):
+    dcm_rt = pydicom.dcmread(dcm_rt)
+
+  contour_dict = dict()
+
+  for roi_contour in getattr(dcm_rt, "ROIContourSequence", list()):
+    contour_dict[int(roi_contour.ReferencedROINumber)] = {"color" : [int(val) for val in getattr(roi_contour, "ROIDisplayColor", [255, 0, 0])],
+                                                          "contours" : list(getattr(roi_contour, "ContourSequence", list()))}
+
+  roi_list = list()
+
+  for roi in dcm_rt.StructureSetROISequence:
+    roi_number = int(roi.ROINumber)
+    roi_contours = contour_dict.get(roi_number, {"color" : [255, 0, 0], "contours" : list()})
+
+    roi_list.append({"number" : roi_number,
+                     "name" : str(roi.ROIName),
+                     "color" : roi_contours["color"],
+                     "contours" : roi_contours["contours"]})
+
+  return roi_list
+
+# ----------------------------------
+# ----------------------------------
+
+def _fill_polygons(polygon_list, rows, columns):
+
+  """
+  Rasterize a list of polygons (arrays of (x, y) vertices, in pixel units) on a single slice:
+  a pixel is inside if its center is - with the even-odd rule across all the polygons, so
+  that the contours of the holes (inner contours) are carved out, like plastimatch does.
+  All the edge/row crossings of all the polygons are computed at once.
+  """
+
+  x0_list, y0_list, x1_list, y1_list = list(), list(), list(), list()
+
+  for polygon in polygon_list:
+    next_polygon = np.roll(polygon, -1, axis = 0)
+    x0_list.append(polygon[:, 0])
+    y0_list.append(polygon[:, 1])
+    x1_list.append(next_polygon[:, 0])
+    y1_list.append(next_polygon[:, 1])
+
+  x0, y0 = np.concatenate(x0_list), np.concatenate(y0_list)
+  x1, y1 = np.concatenate(x1_list), np.concatenate(y1_list)
+
+  mask = np.zeros((rows, columns), dtype = bool)
+
+  # rows `j` crossed by every edge: min(y0, y1) <= j < max(y0, y1) - half-open, so that every
+  # vertex is counted once (and the horizontal edges never)
+  row_start = np.clip(np.ceil(np.minimum(y0, y1)), 0, rows).astype(np.int64)
+  row_end = np.clip(np.ceil(np.maximum(y0, y1)), 0, rows).astype(np.int64)
+  num_crossings = row_end - row_start
+
+  if num_crossings.sum() == 0:
+    return mask
+
+  edge_idx = np.repeat(np.arange(len(x0)), num_crossings)
+  row_idx = row_start[edge_idx] + np.arange(len(edge_idx)) - np.repeat(np.cumsum(num_crossings) - num_crossings,
+                                                                       num_crossings)
+
+  # abscissa of every crossing - the pixels right of it (center included) toggle in/out
+  x_crossing = x0[edge_idx] + (row_idx - y0[edge_idx])*(x1[edge_idx] - x0[edge_idx])/(y1[edge_idx] - y0[edge_idx])
+  col_idx = np.clip(np.ceil(x_crossing), 0, columns).astype(np.int64)
+
+  # only the rows spanned by the polygons are filled
+  row_min, row_max = int(row_idx.min()), int(row_idx.max()) + 1
+
+  toggle_count = np.zeros((row_max - row_min, columns + 1), dtype = np.int32)
+  np.add.at(toggle_count, (row_idx - row_min, col_idx), 1)
+
+  mask[row_min:row_max] = (np.cumsum(toggle_count, axis = 1)[:, :columns] & 1).astype(bool)
+
+  return mask
+
+# ----------------------------------
+# ----------------------------------
+
+def rasterize_rtstruct(dcm_rt, path_to_ct_dir = None, roi_name_list = None, ct_geometry = None):
+
+  """
+  Rasterize the contours of a DICOM RTSTRUCT on the grid of the referenced CT series, in memory
+  - the equivalent of `preprocessing.pypla_dicom_rtstruct_to_nrrd` (plastimatch), with no
+  subprocess and no NRRD round trip. Only the ROIs in `roi_name_list` are decoded and filled
+  (the NSCLC-Radiomics RTSTRUCTs carry many more ROIs than the ones evaluated).
+
+  Arguments:
+    dcm_rt         : required - path to the DICOM RTSTRUCT file, or the pydicom Dataset.
+    path_to_ct_dir : optional - path to the folder storing the referenced DICOM CT slices
+                                (required if `ct_geometry` is not provided).
+    roi_name_list  : optional - names of the ROIs to rasterize (case-insensitive, e.g.,
+                                ["Heart", "Esophagus"]). Defaults to None (all the ROIs).
+    ct_geometry    : optional - pre-parsed CT geometry (see `dicomseg.read_ct_geometry`).
+                                Defaults to None (parsed from `path_to_ct_dir`).
+
+  Returns:
+    segmask_dict : dictionary of boolean numpy arrays (z, y, x), indexed by ROI name.
+    geometry     : dictionary storing the "spacing", "origin" and "direction" of the volumes.
+  """
+
+  if ct_geometry is None:
+    ct_geometry = dicomseg.read_ct_geometry(path_to_ct_dir)
+
+  roi_list = read_rtstruct_rois(dcm_rt)
+
+  if roi_name_list is not None:
+    requested_set = set(roi_name.strip().lower() for roi_name in roi_name_list)
+    roi_list = [roi for roi in roi_list if roi["name"].strip().lower() in requested_set]
+
+    found_set = set(roi["name"].strip().lower() for roi in roi_list)
+    for roi_name in roi_name_list:
+      if roi_name.strip().lower() not in found_set:
+        print("ROI `%s` not found in the RTSTRUCT - skipping."%(roi_name))
+
+  geometry = dicomseg.ct_geometry_to_sitk(ct_geometry)
+
+  orientation = np.array(ct_geometry["image_orientation"], dtype = np.float64)
+  row_vector, col_vector = orientation[:3], orientation[3:]
+  z_vector = np.cross(row_vector, col_vector)
+
+  position_all = np.array(ct_geometry["image_position_list"], dtype = np.float64)
+  ct_z_all = position_all @ z_vector
+
+  # pixel spacing: (between the rows, between the columns)
+  row_spacing, col_spacing = [float(val) for val in ct_geometry["pixel_spacing"]]
+  rows, columns = ct_geometry["rows"], ct_geometry["columns"]
+  num_slices = len(position_all)
+
+  # contours farther than half a slice from every CT slice are not on the grid
+  z_tolerance = 0.5*abs(geometry["spacing"][2]) + 1e-3
+
+  segmask_dict = dict()
+
+  for roi in roi_list:
+    slice_polygon_dict = dict()
+
+    for contour in roi["contours"]:
+      if str(getattr(contour, "ContourGeometricType", "CLOSED_PLANAR")) != "CLOSED_PLANAR":
+        continue
+
+      point_array = _contour_points(contour)
+
+      if len(point_array) < 3:
+        continue
+
+      slice_idx = int(np.abs(ct_z_all - (point_array @ z_vector).mean()).argmin())
+
+      if abs(ct_z_all[slice_idx] - (point_array @ z_vector).mean()) > z_tolerance:
+        continue
+
+      # (x, y) coordinates in pixel units - integer values at the pixel centers
+      relative_point_array = point_array - position_all[slice_idx]
+      polygon = np.column_stack([relative_point_array @ row_vector/col_spacing,
+                                 relative_point_array @ col_vector/row_spacing])
+
+      slice_polygon_dict.setdefault(slice_idx, list()).append(polygon)
+
+    segmask = np.zeros((num_slices, rows, columns), dtype = bool)
+
+    for slice_idx, polygon_list in slice_polygon_dict.items():
+      segmask[slice_idx] = _fill_polygons(polygon_list, rows, columns)
+
+    segmask_dict[roi["name"]] = segmask
+
+  return segmask_dict, geometry
+
+# ----------------------------------
+# ----------------------------------
+
+def roi_file_name(roi_name):
+
+  """
+  Name of the NRRD file storing a ROI mask - the characters that are not safe in a file name
+  are replaced with underscores (like plastimatch does).
+  """
+
+  return re.sub(r"[^A-Za-z0-9_\-\.]", "_", roi_name.strip())
+
+# ----------------------------------
+# ----------------------------------
+
+def export_rtstruct_nrrd(segmask_dict, geometry, path_to_output_dir, rt_list_path = None, color_dict = None):
+
+  """
+  Optional NRRD sink for `rasterize_rtstruct`: write one `<ROIName>.nrrd` file per ROI and,
+  optionally, the list of the exported structures in plastimatch's `--output-ss-list` format
+  (one "index|R G B|name" line per ROI).
+
+  Arguments:
+    segmask_dict       : required - dictionary of boolean numpy arrays (z, y, x), indexed by ROI name.
+    geometry           : required - dictionary storing the "spacing", "origin" and "direction" of the volumes.
+    path_to_output_dir : required - path to the folder where the NRRD files will be written.
+    rt_list_path       : optional - path to the structure list file. Defaults to None (not written).
+    color_dict         : optional - dictionary storing the display color of every ROI (see
+                                    `read_rtstruct_rois`). Defaults to None (red).
+
+  Returns:
+    nrrd_path_list : list of the paths to the NRRD files.
+  """
+
+  nrrd_path_list = dicomseg.export_segmasks_nrrd(segmask_dict = {roi_file_name(roi_name) : segmask
+                                                                 for roi_name, segmask in segmask_dict.items()},
+                                                 geometry = geometry,
+                                                 path_to_output_dir = path_to_output_dir)
+
+  if rt_list_path is not None:
+    color_dict = color_dict if color_dict is not None else dict()
+
+    with open(rt_list_path, "w") as fp:
+      for idx, roi_name in enumerate(segmask_dict):
+        fp.write("%d|%s|%s\n"%(idx, " ".join(str(val) for val in color_dict.get(roi_name, [255, 0, 0])),
+                               roi_file_name(roi_name)))
+
+  return nrrd_path_list
+
+# ----------------------------------
+# ----------------------------------
@@ -0,0 +1,161 @@
+"""
+    ----------------------------------------
+    IDC-MedImA-misc - CT series index utils
+    ----------------------------------------
+
+    ----------------------------------------
+    Author: Dennis Bontempi
+    Email:  dennis_bontempi@dfci.harvard.edu
+    ----------------------------------------
+
+"""
+
+import os
+
+import numpy as np
+import pydicom
+
+from concurrent.futures import ThreadPoolExecutor
+
+# header attributes needed to build the index (everything else is skipped while parsing)
+INDEX_TAG_LIST = ["SOPInstanceUID", "SOPClassUID", "SeriesInstanceUID", "ImagePositionPatient",
+                  "ImageOrientationPatient", "PixelSpacing", "SliceThickness", "Rows", "Columns"]
+
+
+def default_index_path(path_to_ct_dir):
+
+  """
+  Path to the cached index of a series. The index is stored next to the sorted data
+  (e.g., `sorted/<pat_id>/CT_index.npz`), not inside the series folder, so that it is
+  never picked up as a DICOM file.
+  """
+
+  return os.path.normpath(path_to_ct_dir) + "_index.npz"
+
+# ----------------------------------
+# ----------------------------------
+
+def _read_header(path_to_file):
+
+  return pydicom.dcmread(path_to_file, stop_before_pixels = True, specific_tags = INDEX_TAG_LIST)
+
+# ----------------------------------
+# ----------------------------------
+
+def build_series_index(path_to_ct_dir, num_workers = 8, use_cache = True, index_path = None):
+
+  """
+  Build (or load from the cache) the index of a DICOM CT series: the slices ordered by
+  the projection of ImagePositionPatient on the slice normal, with their SOPInstanceUIDs
+  and positions, plus the orientation and spacing of the series. Only the header
+  attributes needed are parsed (in a pool of threads), and the pixel data is never read.
+
+  Arguments:
+    path_to_ct_dir : required - path to the folder storing the DICOM CT slices.
+    num_workers    : optional - number of threads used to parse the headers. Defaults to 8.
+    use_cache      : optional - whether to load/store the index from/to `index_path`.
+                                The cache is rebuilt if the content of the folder changed.
+                                Defaults to True.
+    index_path     : optional - path to the cached index. Defaults to `default_index_path`.
+
+  Returns:
+    series_index : dictionary of numpy arrays storing, for the ordered slices, "file_name",
+                   "sop_instance_uid", "image_position" (N x 3) and "z_position", and
+                   for the series "image_orientation", "pixel_spacing" (row, column),
+                   "slice_thickness", "rows", "columns", "sop_class_uid" and "series_instance_uid".
+  """
+
+  if index_path is None:
+    index_path = default_index_path(path_to_ct_dir)
+
+  fn_list = sorted(os.listdir(path_to_ct_dir))
+
+  if use_cache and os.path.exists(index_path):
+    series_index = load_series_index(index_path)
+
+    # cheap staleness check - the set of files must be the same
+    if sorted(series_index["file_name"].tolist()) == fn_list:
+      return series_index
+
+  with ThreadPoolExecutor(max_workers = num_workers) as executor:
+    dcm_list = list(executor.map(_read_header, [os.path.join(path_to_ct_dir, fn) for fn in fn_list]))
+
+  orientation = np.array(dcm_list[0].ImageOrientationPatient, dtype = np.float64)
+  z_vector = np.cross(orientation[:3], orientation[3:])
+
+  position_all = np.array([dcm.ImagePositionPatient for dcm in dcm_list], dtype = np.float64)
+  z_all = position_all @ z_vector
+  sorted_ind = np.argsort(z_all)
+
+  reference_dcm = dcm_list[sorted_ind[0]]
+
+  series_index = dict()
+  series_index["file_name"] = np.array(fn_list)[sorted_ind]
+  series_index["sop_instance_uid"] = np.array([str(dcm.SOPInstanceUID) for dcm in dcm_list])[sorted_ind]
+  series_index["image_position"] = position_all[sorted_ind]
+  series_index["z_position"] = z_all[sorted_ind]
+  series_index["image_orientation"] = orientation
+  series_index["pixel_spacing"] = np.array(reference_dcm.PixelSpacing, dtype = np.float64)
+  series_index["slice_thickness"] = np.float64(getattr(reference_dcm, "SliceThickness", 0.0) or 0.0)
+  series_index["rows"] = np.int64(reference_dcm.Rows)
+  series_index["columns"] = np.int64(reference_dcm.Columns)
+  series_index["sop_class_uid"] = np.array(str(reference_dcm.SOPClassUID))
+  series_index["series_instance_uid"] = np.array(str(reference_dcm.SeriesInstanceUID))
+
+  if use_cache:
+    save_series_index(series_index, index_path)
+
+  return series_index
+
+# ----------------------------------
+# ----------------------------------
+
+def save_series_index(series_index, index_path):
+
+  """
+  Store a series index (see `build_series_index`) as an `.npz` file, atomically.
+  """
+
+  # `np.savez` appends the extension if it is missing - make sure the temporary file has one
+  tmp_index_path = index_path + ".tmp.npz"
+  np.savez(tmp_index_path, **series_index)
+  os.replace(tmp_index_path, index_path)
+
+# ----------------------------------
+# ----------------------------------
+
+def load_series_index(index_path):
+
+  """
+  Load a series index stored by `save_series_index`.
+  """
+
+  with np.load(index_path, allow_pickle = False) as npz_file:
+    return {key : npz_file[key] for key in npz_file.files}
+
+# ----------------------------------
+# ----------------------------------
+
+def order_dicom_files_image_position(dcm_directory):
+
+  """
+  Orders the dicom files according to image position and orientation - drop-in replacement
+  for the notebooks' function of the same name, backed by the (cached) series index.
+
+  Arguments:
+    dcm_directory : input directory of dcm files to put in order
+
+  Outputs:
+    files_sorted   : dcm files in sorted order
+    sop_all_sorted : the SOPInstanceUIDs in sorted order
+    pos_all_sorted : the image position in sorted order
+  """
+
+  series_index = build_series_index(dcm_directory)
+
+  files_sorted = np.array([os.path.join(dcm_directory, fn) for fn in series_index["file_name"]])
+
+  return files_sorted, series_index["sop_instance_uid"], series_index["z_position"]
+
+# ----------------------------------
+# ----------------------------------
@@ -0,0 +1,209 @@
+"""
+    ----------------------------------------
+    IDC-MedImA-misc - shape features utils
+    ----------------------------------------
+
+    ----------------------------------------
+    Author: Dennis Bontempi
+    Email:  dennis_bontempi@dfci.harvard.edu
+    ----------------------------------------
+
+"""
+
+import time
+
+import numpy as np
+import pandas as pd
+import SimpleITK as sitk
+
+from scipy import ndimage
+from scipy.spatial import ConvexHull
+from skimage.measure import marching_cubes
+
+from concurrent.futures import ThreadPoolExecutor
+
+# 3D shape features computed (same names and definitions as pyradiomics' `original_shape_*`,
+# see `nnunet_shape_features_code_mapping.csv`)
+SHAPE_FEATURE_LIST = ["Elongation", "Flatness", "LeastAxisLength", "MajorAxisLength",
+                      "Maximum3DDiameter", "MeshVolume", "MinorAxisLength", "Sphericity",
+                      "SurfaceArea", "SurfaceVolumeRatio", "VoxelVolume", "Compactness1",
+                      "Compactness2", "SphericalDisproportion"]
+
+
+def _max_pairwise_distance(points, chunk_size = 256):
+
+  # the two farthest points of a set are vertices of its convex hull
+  if len(points) > 4:
+    try:
+      points = points[ConvexHull(points).vertices]
+    except Exception:
+      pass
+
+  max_dist_sq = 0.0
+
+  for start in range(0, len(points), chunk_size):
+    diff = points[start:start + chunk_size, np.newaxis, :] - points[np.newaxis, :, :]
+    max_dist_sq = max(max_dist_sq, float(np.einsum("ijk,ijk->ij", diff, diff).max()))
+
+  return np.sqrt(max_dist_sq)
+
+# ----------------------------------
+# ----------------------------------
+
+def _label_shape_features(segmask, spacing, shape_feature_list):
+
+  """
+  Shape features of a single (cropped) binary mask. `spacing` follows the array (z, y, x) ordering.
+  """
+
+  feature_dict = dict()
+
+  num_voxels = int(np.count_nonzero(segmask))
+  voxel_volume = num_voxels*float(np.prod(spacing))
+
+  # triangle mesh of the mask surface (vertices at the edge midpoints, like pyradiomics) -
+  # the mask is padded so that the surface is always closed
+  padded_segmask = np.pad(segmask, 1).astype(np.float32)
+  verts, faces, _, _ = marching_cubes(padded_segmask, level = 0.5, spacing = tuple(spacing),
+                                      allow_degenerate = True)
+
+  a, b, c = verts[faces[:, 0]], verts[faces[:, 1]], verts[faces[:, 2]]
+
+  surface_area = float(0.5*np.linalg.norm(np.cross(b - a, c - a), axis = 1).sum())
+  mesh_volume = float(abs(np.einsum("ij,ij->i", a, np.cross(b, c)).sum())/6.0)
+
+  # eigenvalues of the covariance of the physical coordinates of the voxels, in ascending order
+  coords = np.argwhere(segmask)*np.asarray(spacing, dtype = np.float64)
+  coords -= coords.mean(axis = 0)
+  eigenvalues = np.linalg.eigvalsh(coords.T @ coords/num_voxels)
+  eigenvalues = np.clip(eigenvalues, 0, None)
+
+  least_eig, minor_eig, major_eig = eigenvalues
+
+  feature_dict["VoxelVolume"] = voxel_volume
+  feature_dict["MeshVolume"] = mesh_volume
+  feature_dict["SurfaceArea"] = surface_area
+  feature_dict["SurfaceVolumeRatio"] = surface_area/mesh_volume if mesh_volume > 0 else np.nan
+
+  feature_dict["Sphericity"] = (36*np.pi*mesh_volume**2)**(1.0/3)/surface_area
+  feature_dict["Compactness1"] = mesh_volume/np.sqrt(np.pi*surface_area**3)
+  feature_dict["Compactness2"] = 36*np.pi*mesh_volume**2/surface_area**3
+  feature_dict["SphericalDisproportion"] = (surface_area/(36*np.pi*mesh_volume**2)**(1.0/3)
+                                            if mesh_volume > 0 else np.nan)
+
+  feature_dict["MajorAxisLength"] = 4*np.sqrt(major_eig)
+  feature_dict["MinorAxisLength"] = 4*np.sqrt(minor_eig)
+  feature_dict["LeastAxisLength"] = 4*np.sqrt(least_eig)
+  feature_dict["Elongation"] = np.sqrt(minor_eig/major_eig) if major_eig > 0 else np.nan
+  feature_dict["Flatness"] = np.sqrt(least_eig/major_eig) if major_eig > 0 else np.nan
+
+  if "Maximum3DDiameter" in shape_feature_list:
+    feature_dict["Maximum3DDiameter"] = _max_pairwise_distance(verts)
+
+  return {feature : float(feature_dict[feature]) for feature in shape_feature_list}
+
+# ----------------------------------
+# ----------------------------------
+
+def compute_shape_features(label_array, spacing, label_dict, shape_feature_list = SHAPE_FEATURE_LIST,
+                           num_workers = 4):
+
+  """
+  Compute the 3D shape features of all the structures of a label map in a single pass - the
+  equivalent of the notebooks' `split_nii` followed by `compute_pyradiomics_3D_features`,
+  without writing (and re-reading) one full-size volume per structure. Every structure is
+  cropped to its bounding box (all the bounding boxes are found with one scan of the label
+  map), and the structures are processed in parallel.
+
+  Arguments:
+    label_array        : required - numpy array (z, y, x) storing the (integer) label map.
+    spacing            : required - voxel spacing (SimpleITK convention, i.e., x, y, z ordering).
+    label_dict         : required - dictionary mapping the label values to the structure names
+                                    (e.g., {1 : "Esophagus", 2 : "Heart", ...}).
+    shape_feature_list : optional - list of the shape features to compute (e.g., the `shape_feature`
+                                    column of `nnunet_shape_features_code_mapping.csv`).
+                                    Defaults to all the supported features (`SHAPE_FEATURE_LIST`).
+    num_workers        : optional - number of threads used to process the structures. Defaults to 4.
+
+  Returns:
+    features_df : pandas DataFrame storing, for every structure found in the label map, the
+                  "ReferencedSegment" (label value), the "label_name" and the shape features.
+  """
+
+  assert(all(feature in SHAPE_FEATURE_LIST for feature in shape_feature_list))
+
+  label_array = np.asarray(label_array)
+
+  if not np.issubdtype(label_array.dtype, np.integer):
+    label_array = label_array.astype(np.int32)
+
+  # (z, y, x) ordering, like the array
+  spacing = tuple(float(val) for val in spacing[::-1])
+
+  # bounding boxes of all the labels with a single scan - `find_objects` returns the box of
+  # label `n` at position `n - 1` (None if the label is not found)
+  bbox_list = ndimage.find_objects(label_array)
+
+  job_list = list()
+
+  for label_value in sorted(label_dict.keys()):
+    if label_value <= 0 or label_value > len(bbox_list) or bbox_list[label_value - 1] is None:
+      continue
+
+    job_list.append((label_value, bbox_list[label_value - 1]))
+
+  def _process(job):
+    label_value, bbox = job
+    return _label_shape_features(label_array[bbox] == label_value, spacing, shape_feature_list)
+
+  with ThreadPoolExecutor(max_workers = num_workers) as executor:
+    feature_dict_list = list(executor.map(_process, job_list))
+
+  row_list = list()
+
+  for (label_value, _), feature_dict in zip(job_list, feature_dict_list):
+    row = {"ReferencedSegment" : label_value, "label_name" : label_dict[label_value]}
+    row.update(feature_dict)
+    row_list.append(row)
+
+  return pd.DataFrame(row_list, columns = ["ReferencedSegment", "label_name"] + list(shape_feature_list))
+
+# ----------------------------------
+# ----------------------------------
+
+def compute_shape_features_from_file(path_to_label_file, label_dict, shape_feature_list = SHAPE_FEATURE_LIST,
+                                     num_workers = 4):
+
+  """
+  Compute the 3D shape features of all the structures of a label map stored as NIfTI/NRRD
+  (e.g., the nnU-Net prediction) - see `compute_shape_features`. The label map is read once,
+  as an integer volume.
+
+  Arguments:
+    path_to_label_file : required - path to the label map (e.g., `<pat_id>.nii.gz`).
+    label_dict         : required - dictionary mapping the label values to the structure names.
+    shape_feature_list : optional - list of the shape features to compute. Defaults to all the
+                                    supported features (`SHAPE_FEATURE_LIST`).
+    num_workers        : optional - number of threads used to process the structures. Defaults to 4.
+
+  Returns:
+    features_df : pandas DataFrame storing the shape features (see `compute_shape_features`).
+  """
+
+  start_time = time.time()
+
+  sitk_label = sitk.ReadImage(path_to_label_file, sitk.sitkUInt8)
+
+  features_df = compute_shape_features(label_array = sitk.GetArrayViewFromImage(sitk_label),
+                                       spacing = sitk_label.GetSpacing(),
+                                       label_dict = label_dict,
+                                       shape_feature_list = shape_feature_list,
+                                       num_workers = num_workers)
+
+  elapsed = time.time() - start_time
+  print("Shape features computed in %g seconds."%elapsed)
+
+  return features_df
+
+# ----------------------------------
+# ----------------------------------
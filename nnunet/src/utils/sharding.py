@@ -0,0 +1,550 @@
+"""
+    ----------------------------------------
+    IDC-MedImA-misc - cohort sharding utils
+    ----------------------------------------
+
+    ----------------------------------------
+    Author: Dennis Bontempi
+    Email:  dennis_bontempi@dfci.harvard.edu
+    ----------------------------------------
+
+"""
+
+import os
+import json
+import time
+import uuid
+import heapq
+import socket
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+
+def estimate_series_cost(cohort_df, group_by = "SeriesInstanceUID", instance_weight = 1.0,
+                         extent_weight = 0.4):
+
+  """
+  Estimate the (relative) processing cost of every series of a cohort. The download and the
+  conversions scale with the number of slices, while the inference scales with the extent of
+  the volume (the CT is resampled to the spacing of the model), so:
+
+    cost = `instance_weight`*num_instances + `extent_weight`*extent (mm)
+
+  The number of instances is taken from the `num_instances` column (see, e.g., `NLST_query.txt`),
+  or counted from the rows of the table (one per object, like the BigQuery result); the extent
+  from the `min_SliceLocation`/`max_SliceLocation` columns, or estimated as the number of
+  instances times `min_difference` (the slice spacing). If neither is available (e.g., the
+  `zenodo_*_series_analyzed.csv` tables), every series has the same cost.
+
+  Arguments:
+    cohort_df       : required - Pandas dataframe storing the cohort (one row per series or per object).
+    group_by        : optional - column identifying the series. Defaults to "SeriesInstanceUID".
+    instance_weight : optional - cost of a single slice. Defaults to 1.
+    extent_weight   : optional - cost of a mm of extent (about one slice every 2.5 mm once resampled).
+                                 Defaults to 0.4.
+
+  Returns:
+    cost_df : pandas DataFrame storing, for every series (in order of appearance), the `group_by`
+              column, the "num_instances", the "extent" (mm, NaN if unknown) and the "cost".
+  """
+
+  grouped = cohort_df.groupby(group_by, sort = False)
+
+  cost_df = pd.DataFrame({group_by : list(grouped.groups.keys())})
+
+  if "num_instances" in cohort_df.columns:
+    cost_df["num_instances"] = grouped["num_instances"].max().values.astype(np.float64)
+  elif len(cost_df) < len(cohort_df):
+    cost_df["num_instances"] = grouped.size().values.astype(np.float64)
+  else:
+    cost_df["num_instances"] = np.nan
+
+  if "min_SliceLocation" in cohort_df.columns and "max_SliceLocation" in cohort_df.columns:
+    cost_df["extent"] = (grouped["max_SliceLocation"].max() - grouped["min_SliceLocation"].min()).abs().values
+  elif "min_difference" in cohort_df.columns:
+    cost_df["extent"] = cost_df["num_instances"].values*grouped["min_difference"].min().values.astype(np.float64)
+  else:
+    cost_df["extent"] = np.nan
+
+  cost = instance_weight*cost_df["num_instances"].fillna(0) + extent_weight*cost_df["extent"].fillna(0)
+
+  if not cost.gt(0).any():
+    print("No size information found for the series - assuming the same cost for all of them.")
+    cost[:] = 1.0
+
+  # a series with missing information costs as much as the median one
+  cost_df["cost"] = cost.where(cost > 0, cost[cost > 0].median())
+
+  return cost_df
+
+# ----------------------------------
+# ----------------------------------
+
+def plan_shards(cohort_df, num_shards, group_by = "SeriesInstanceUID", **kwargs):
+
+  """
+  Split a cohort in `num_shards` shards of (roughly) the same total cost, so that no worker
+  gets all the large series (e.g., the 600-slice NLST series). The series are assigned from
+  the most to the least expensive, each to the shard with the lowest total cost so far
+  (longest-processing-time-first).
+
+  Arguments:
+    cohort_df  : required - Pandas dataframe storing the cohort (see `estimate_series_cost`).
+    num_shards : required - number of shards (e.g., of worker nodes).
+    group_by   : optional - column identifying the series. Defaults to "SeriesInstanceUID".
+    **kwargs   : optional - weights of the cost model (see `estimate_series_cost`).
+
+  Returns:
+    plan_df : pandas DataFrame storing, for every series, the `group_by` column, the estimated
+              "cost" (and its components) and the "shard" - sorted by shard, then by decreasing cost.
+  """
+
+  assert(num_shards > 0)
+
+  start_time = time.time()
+
+  plan_df = estimate_series_cost(cohort_df, group_by = group_by, **kwargs)
+  plan_df = plan_df.sort_values("cost", ascending = False, kind = "stable").reset_index(drop = True)
+
+  # (total cost, shard) for every shard
+  shard_heap = [(0.0, shard) for shard in range(num_shards)]
+  shard_list = list()
+
+  for cost in plan_df["cost"].values:
+    total_cost, shard = heapq.heappop(shard_heap)
+    shard_list.append(shard)
+    heapq.heappush(shard_heap, (total_cost + cost, shard))
+
+  plan_df["shard"] = shard_list
+  plan_df = plan_df.sort_values(["shard", "cost"], ascending = [True, False], kind = "stable").reset_index(drop = True)
+
+  shard_cost = plan_df.groupby("shard")["cost"].sum()
+
+  elapsed = time.time() - start_time
+  print("%g series split in %g shards in %g seconds (cost per shard: min %g, max %g, mean %g)."%(len(plan_df),
+                                                                                               num_shards, elapsed,
+                                                                                               shard_cost.min(),
+                                                                                               shard_cost.max(),
+                                                                                               shard_cost.mean()))
+
+  return plan_df
+
+# ----------------------------------
+# ----------------------------------
+
+def write_shards(plan_df, cohort_df, output_path, group_by = "SeriesInstanceUID"):
+
+  """
+  Write the subset of the cohort assigned to every shard to `output_path`/shard_%03d.csv
+  (e.g., to start every worker node on its own CSV).
+
+  Returns:
+    shard_path_list : list of the paths to the CSV files, one per shard.
+  """
+
+  os.makedirs(output_path, exist_ok = True)
+
+  shard_path_list = list()
+
+  for shard, shard_plan_df in plan_df.groupby("shard"):
+    shard_df = cohort_df[cohort_df[group_by].isin(shard_plan_df[group_by])]
+
+    shard_path = os.path.join(output_path, "shard_%03d.csv"%(shard))
+    shard_df.to_csv(shard_path, index = False)
+
+    shard_path_list.append(shard_path)
+
+  return shard_path_list
+
+# ----------------------------------
+# ----------------------------------
+
+class LeaseQueue:
+
+  """
+  Coordinator-less work queue on a shared directory (e.g., an NFS or a Filestore mount): every
+  worker node claims the next series by atomically creating a lease file (`O_CREAT | O_EXCL`),
+  processes it, then marks it as done. The workers claim the series of their own shard first
+  (most expensive first), then help with the series of the other shards - so that a slow node
+  never holds up the end of the run.
+
+  Layout of `root_path`:
+    plan.csv             : the plan (see `plan_shards`), written once by `publish`.
+    leases/<series>.json : lease of a series being processed (worker, claim time) - the mtime is
+                           refreshed by `renew`; a lease older than `lease_ttl` is considered
+                           abandoned (e.g., the node was preempted) and can be claimed again.
+    done/<series>.json   : record of a processed series.
+    failed/<series>.json : record of the failed attempts of a series.
+
+    queue = LeaseQueue(root_path, worker_id = "node-03")
+    for series_id in queue.iter_claims(shard = 3):
+      ...
+      queue.complete(series_id)
+  """
+
+  def __init__(self, root_path, worker_id = None, lease_ttl = 7200, max_attempts = 3,
+               group_by = "SeriesInstanceUID"):
+
+    """
+    Arguments:
+      root_path    : required - path to the shared directory.
+      worker_id    : optional - ID of the worker. Defaults to <hostname>-<pid>.
+      lease_ttl    : optional - time (in seconds) after which a lease that was not renewed is
+                                considered abandoned. Defaults to 7200.
+      max_attempts : optional - number of failed attempts after which a series is not claimed
+                                anymore. Defaults to 3.
+      group_by     : optional - column of the plan identifying the series. Defaults to "SeriesInstanceUID".
+    """
+
+    self.root_path = root_path
+    self.worker_id = worker_id if worker_id is not None else "%s-%d"%(socket.gethostname(), os.getpid())
+    self.lease_ttl = lease_ttl
+    self.max_attempts = max_attempts
+    self.group_by = group_by
+
+    self.plan_path = os.path.join(root_path, "plan.csv")
+    self.leases_path = os.path.join(root_path, "leases")
+    self.done_path = os.path.join(root_path, "done")
+    self.failed_path = os.path.join(root_path, "failed")
+
+    for path in [self.leases_path, self.done_path, self.failed_path]:
+      os.makedirs(path, exist_ok = True)
+
+    self._plan_df = None
+
+  # ----------------------------------
+
+  def _entry_path(self, dir_path, series_id):
+    return os.path.join(dir_path, str(series_id).replace(os.sep, "_") + ".json")
+
+  def _write_json(self, path, content):
+
+    # write to a temporary file first, so that a partial file is never read
+    fd, tmp_path = tempfile.mkstemp(prefix = ".tmp_", dir = os.path.dirname(path))
+
+    with os.fdopen(fd, "w") as fp:
+      json.dump(content, fp)
+
+    os.replace(tmp_path, path)
+
+  def _read_json(self, path):
+
+    try:
+      with open(path, "r") as fp:
+        return json.load(fp)
+    except (OSError, ValueError):
+      return None
+
+  # ----------------------------------
+
+  def publish(self, plan_df):
+
+    """
+    Store the plan (see `plan_shards`) in the shared directory - once, before the workers start.
+    """
+
+    plan_df.to_csv(self.plan_path + ".tmp", index = False)
+    os.replace(self.plan_path + ".tmp", self.plan_path)
+
+    self._plan_df = None
+
+  # ----------------------------------
+
+  def plan(self):
+
+    if self._plan_df is None:
+      self._plan_df = pd.read_csv(self.plan_path, dtype = {self.group_by : str})
+
+    return self._plan_df
+
+  # ----------------------------------
+
+  def _num_failures(self, series_id):
+
+    failed = self._read_json(self._entry_path(self.failed_path, series_id))
+
+    return len(failed["attempt_list"]) if failed is not None else 0
+
+  # ----------------------------------
+
+  def _reclaim_expired(self, lease_path):
+
+    """
+    Remove an expired lease, so that it can be claimed again. Returns True if it was removed.
+
+    Several workers can find the same lease expired: the removal runs under a `<lease>.reclaim`
+    lock (`O_CREAT | O_EXCL`), and the lease is first renamed to a unique name and checked
+    again - so that a fresh lease, created by the worker that reclaimed it first, is put back
+    instead of being removed.
+    """
+
+    lock_path = lease_path + ".reclaim"
+
+    try:
+      lock_fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+      # another worker is reclaiming the lease - unless it crashed while holding the lock
+      try:
+        if time.time() - os.path.getmtime(lock_path) > min(self.lease_ttl, 60):
+          os.remove(lock_path)
+      except OSError:
+        pass
+
+      return False
+
+    os.close(lock_fd)
+
+    try:
+      expired_path = "%s.expired.%s.%s"%(lease_path, self.worker_id, uuid.uuid4().hex)
+
+      try:
+        os.rename(lease_path, expired_path)
+      except OSError:
+        # released in the meantime - nothing to remove
+        return True
+
+      if time.time() - os.path.getmtime(expired_path) > self.lease_ttl:
+        os.remove(expired_path)
+        return True
+
+      # not the expired lease (it was renewed, or reclaimed already) - put it back
+      try:
+        os.link(expired_path, lease_path)
+      except FileExistsError:
+        print("WARNING: could not restore the lease at %s."%(lease_path))
+
+      os.remove(expired_path)
+      return False
+
+    finally:
+      os.remove(lock_path)
+
+  # ----------------------------------
+
+  def _try_lease(self, series_id):
+
+    """
+    Try to claim a series. Returns True if the lease was acquired.
+    """
+
+    lease_path = self._entry_path(self.leases_path, series_id)
+    lease = {"worker_id" : self.worker_id, "claim_time" : time.time()}
+
+    for _ in range(2):
+      try:
+        fd = os.open(lease_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+      except FileExistsError:
+        try:
+          expired = time.time() - os.path.getmtime(lease_path) > self.lease_ttl
+        except OSError:
+          # the lease was released in the meantime - try again
+          continue
+
+        if not expired or not self._reclaim_expired(lease_path):
+          return False
+
+        print("Lease of %s expired - claiming it again."%(series_id))
+        continue
+
+      with os.fdopen(fd, "w") as fp:
+        json.dump(lease, fp)
+
+      # the series could have been completed between the listing and the claim
+      if os.path.exists(self._entry_path(self.done_path, series_id)):
+        os.remove(lease_path)
+        return False
+
+      return True
+
+    return False
+
+  # ----------------------------------
+
+  def claim(self, shard = None, max_items = 1):
+
+    """
+    Claim up to `max_items` series that are neither done, nor leased by another worker (nor
+    failed `max_attempts` times) - the series of `shard` first, then the ones of the other
+    shards, most expensive first.
+
+    Returns:
+      series_id_list : list of the IDs of the claimed series (empty if there is nothing left to claim).
+    """
+
+    plan_df = self.plan()
+
+    done_set = set(fn[:-len(".json")] for fn in os.listdir(self.done_path) if fn.endswith(".json"))
+    leased_set = set(fn[:-len(".json")] for fn in os.listdir(self.leases_path) if fn.endswith(".json"))
+
+    if shard is not None:
+      order = np.lexsort((-plan_df["cost"].values, plan_df["shard"].values != shard))
+    else:
+      order = np.argsort(-plan_df["cost"].values, kind = "stable")
+
+    series_id_list = list()
+
+    for series_id in plan_df[self.group_by].values[order]:
+      if len(series_id_list) >= max_items:
+        break
+
+      series_fn = str(series_id).replace(os.sep, "_")
+
+      if series_fn in done_set:
+        continue
+
+      # a lease found by the listing might be expired - let `_try_lease` decide
+      if series_fn in leased_set:
+        lease_path = self._entry_path(self.leases_path, series_id)
+        try:
+          if time.time() - os.path.getmtime(lease_path) <= self.lease_ttl:
+            continue
+        except OSError:
+          pass
+
+      if self._num_failures(series_id) >= self.max_attempts:
+        continue
+
+      if self._try_lease(series_id):
+        series_id_list.append(series_id)
+
+    return series_id_list
+
+  # ----------------------------------
+
+  def iter_claims(self, shard = None):
+
+    """
+    Claim the series one at a time until there is nothing left to claim - the caller is
+    expected to call `complete` (or `fail`) for every series.
+    """
+
+    while True:
+      series_id_list = self.claim(shard = shard)
+
+      if len(series_id_list) == 0:
+        return
+
+      yield series_id_list[0]
+
+  # ----------------------------------
+
+  def _owns_lease(self, lease_path):
+
+    """
+    Whether the lease at `lease_path` exists and was acquired by this worker (and not, e.g.,
+    reclaimed by another worker after it expired).
+    """
+
+    lease = self._read_json(lease_path)
+
+    return lease is not None and lease.get("worker_id") == self.worker_id
+
+  # ----------------------------------
+
+  def renew(self, series_id):
+
+    """
+    Refresh the lease of a series (e.g., every few minutes while processing a large series).
+
+    Returns:
+      renewed : False if the lease is no longer held by this worker (it expired, and was released
+                or reclaimed by another worker) - the series should then be abandoned.
+    """
+
+    lease_path = self._entry_path(self.leases_path, series_id)
+
+    if not self._owns_lease(lease_path):
+      return False
+
+    try:
+      os.utime(lease_path)
+    except FileNotFoundError:
+      return False
+
+    return True
+
+  # ----------------------------------
+
+  def complete(self, series_id, record = None):
+
+    """
+    Mark a series as done (storing `record`, e.g., the timings), then release its lease.
+    """
+
+    done = {"worker_id" : self.worker_id, "done_time" : time.time(), "record" : record}
+
+    self._write_json(self._entry_path(self.done_path, series_id), done)
+    self.release(series_id)
+
+  # ----------------------------------
+
+  def fail(self, series_id, error = None):
+
+    """
+    Record a failed attempt for a series, then release its lease - the series is claimed
+    again (by any worker) until it fails `max_attempts` times.
+    """
+
+    failed_path = self._entry_path(self.failed_path, series_id)
+
+    failed = self._read_json(failed_path) or {"attempt_list" : list()}
+    failed["attempt_list"].append({"worker_id" : self.worker_id, "time" : time.time(),
+                                   "error" : str(error) if error is not None else None})
+
+    self._write_json(failed_path, failed)
+    self.release(series_id)
+
+  # ----------------------------------
+
+  def release(self, series_id):
+
+    """
+    Release the lease of a series - unless it is held by another worker (e.g., the lease of this
+    worker expired and the series was claimed again), whose lease is left in place.
+    """
+
+    lease_path = self._entry_path(self.leases_path, series_id)
+
+    if not self._owns_lease(lease_path):
+      return
+
+    try:
+      os.remove(lease_path)
+    except FileNotFoundError:
+      pass
+
+  # ----------------------------------
+
+  def status(self):
+
+    """
+    Returns:
+      status_dict : dictionary storing the number of series "done", "leased", "failed" (given up
+                    after `max_attempts` failures) and "pending".
+    """
+
+    plan_df = self.plan()
+
+    series_fn_list = [str(series_id).replace(os.sep, "_") for series_id in plan_df[self.group_by].values]
+
+    done_set = set(fn[:-len(".json")] for fn in os.listdir(self.done_path) if fn.endswith(".json"))
+    leased_set = set(fn[:-len(".json")] for fn in os.listdir(self.leases_path) if fn.endswith(".json"))
+
+    status_dict = {"done" : 0, "leased" : 0, "failed" : 0, "pending" : 0}
+
+    for series_id, series_fn in zip(plan_df[self.group_by].values, series_fn_list):
+      if series_fn in done_set:
+        status_dict["done"] += 1
+      elif series_fn in leased_set:
+        status_dict["leased"] += 1
+      elif self._num_failures(series_id) >= self.max_attempts:
+        status_dict["failed"] += 1
+      else:
+        status_dict["pending"] += 1
+
+    return status_dict
+
+# ----------------------------------
+# ----------------------------------
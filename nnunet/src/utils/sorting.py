@@ -0,0 +1,122 @@
+"""
+    ----------------------------------------
+    IDC-MedImA-misc - DICOM sorting utils
+    ----------------------------------------
+
+    ----------------------------------------
+    Author: Dennis Bontempi
+    Email:  dennis_bontempi@dfci.harvard.edu
+    ----------------------------------------
+
+"""
+
+import os
+import time
+import shutil
+
+import pydicom
+
+from concurrent.futures import ThreadPoolExecutor
+
+
+def _safe_path_component(value):
+
+  """
+  Make sure a DICOM attribute value can be used as a single path component.
+  """
+
+  return str(value).strip().replace(os.sep, "_")
+
+# ----------------------------------
+# ----------------------------------
+
+def sort_dicom_file(path_to_file, sorted_base_path, move = True):
+
+  """
+  Place a single DICOM file in the sorted layout used across the pipeline, i.e.,
+  `sorted_base_path`/%PatientID/%Modality/%SOPInstanceUID.dcm (same as running
+  `dicomsort.py -k -u`). Only the three attributes needed are parsed from the header.
+
+  Arguments:
+    path_to_file     : required - path to the (raw) DICOM file.
+    sorted_base_path : required - path to the folder where the sorted data will be stored.
+    move             : optional - whether to move the file (True) or to keep the raw copy and
+                                  hard-link it (False, falls back to copying across filesystems).
+                                  Defaults to True.
+
+  Returns:
+    sorted_file_path : path to the sorted DICOM file.
+  """
+
+  dcm = pydicom.dcmread(path_to_file, stop_before_pixels = True,
+                        specific_tags = ["PatientID", "Modality", "SOPInstanceUID"])
+
+  sorted_dir_path = os.path.join(sorted_base_path,
+                                 _safe_path_component(dcm.PatientID),
+                                 _safe_path_component(dcm.Modality))
+  sorted_file_path = os.path.join(sorted_dir_path,
+                                  _safe_path_component(dcm.SOPInstanceUID) + ".dcm")
+
+  os.makedirs(sorted_dir_path, exist_ok = True)
+
+  # duplicates are reported and ignored (like `dicomsort.py -k`)
+  if os.path.exists(sorted_file_path):
+    print("Skipping duplicate file %s (%s exists already)."%(path_to_file, sorted_file_path))
+
+    if move:
+      os.remove(path_to_file)
+
+    return sorted_file_path
+
+  if move:
+    # `shutil.move` is a rename on the same filesystem, a copy otherwise
+    shutil.move(path_to_file, sorted_file_path)
+  else:
+    try:
+      os.link(path_to_file, sorted_file_path)
+    except OSError:
+      shutil.copy2(path_to_file, sorted_file_path)
+
+  return sorted_file_path
+
+# ----------------------------------
+# ----------------------------------
+
+def sort_dicom_dir(input_dir_path, sorted_base_path, move = True, num_workers = 8):
+
+  """
+  Sort all the DICOM files found (recursively) in a folder, using a pool of threads.
+  In-process replacement for `python src/dicomsort/dicomsort.py -k -u`.
+
+  Arguments:
+    input_dir_path   : required - path to the folder storing the raw DICOM data.
+    sorted_base_path : required - path to the folder where the sorted data will be stored.
+    move             : optional - whether to move the files or to hard-link them (keeping the
+                                  raw copy). See `sort_dicom_file`. Defaults to True.
+    num_workers      : optional - number of threads used to sort the files. Defaults to 8.
+
+  Returns:
+    sorted_file_list : list of the paths to the sorted DICOM files.
+  """
+
+  start_time = time.time()
+  print("\nSorting DICOM files..." )
+
+  path_to_file_list = list()
+
+  for root, _, file_list in os.walk(input_dir_path):
+    path_to_file_list += [os.path.join(root, fn) for fn in file_list]
+
+  with ThreadPoolExecutor(max_workers = num_workers) as executor:
+    sorted_file_list = list(executor.map(lambda path_to_file: sort_dicom_file(path_to_file,
+                                                                              sorted_base_path,
+                                                                              move),
+                                         path_to_file_list))
+
+  elapsed = time.time() - start_time
+  print("Done in %g seconds."%elapsed)
+
+  return sorted_file_list
+
+# ----------------------------------
+# ----------------------------------
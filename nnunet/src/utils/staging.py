@@ -0,0 +1,164 @@
+"""
+    ----------------------------------------
+    IDC-MedImA-misc - staging utils
+    ----------------------------------------
+
+    ----------------------------------------
+    Author: Dennis Bontempi
+    Email:  dennis_bontempi@dfci.harvard.edu
+    ----------------------------------------
+
+"""
+
+import os
+import json
+import shutil
+import threading
+
+# all the writes to the manifests go through this lock (staging can happen from multiple threads)
+_manifest_lock = threading.Lock()
+
+
+def default_manifest_path(model_input_folder):
+
+  """
+  Path to the staging manifest associated to a model input folder. The manifest is stored
+  next to the folder (not inside it), so that it is never picked up as a model input.
+  """
+
+  return os.path.normpath(model_input_folder) + "_staged.jsonl"
+
+# ----------------------------------
+# ----------------------------------
+
+def register_staged(manifest_path, pat_id, path_list):
+
+  """
+  Record a list of files in the staging manifest, so that they are removed by `cleanup_staged`
+  (e.g., the model outputs that should not outlive the run).
+
+  Arguments:
+    manifest_path : required - path to the JSONL staging manifest.
+    pat_id        : required - patient (or series) ID the files belong to.
+    path_list     : required - list of paths to record.
+  """
+
+  with _manifest_lock, open(manifest_path, "a") as fp:
+    for path in path_list:
+      fp.write(json.dumps({"pat_id" : pat_id, "path" : path}) + "\n")
+
+# ----------------------------------
+# ----------------------------------
+
+def stage_file(src_path, dst_path, manifest_path = None, pat_id = None, link_mode = "hardlink"):
+
+  """
+  Stage a file at `dst_path` without duplicating it on disk: the file is hard-linked (or
+  symlinked) and only copied if that is not possible (e.g., across filesystems).
+
+  Arguments:
+    src_path      : required - path to the file to stage.
+    dst_path      : required - path at which the file should be staged.
+    manifest_path : optional - path to the JSONL staging manifest the staged file should be
+                               recorded in. Defaults to None (not recorded).
+    pat_id        : optional - patient (or series) ID, stored in the manifest. Defaults to None.
+    link_mode     : optional - "hardlink", "symlink" or "copy". Defaults to "hardlink".
+
+  Returns:
+    staged_with : how the file was staged ("hardlink", "symlink", "copy" or "exists").
+  """
+
+  assert(link_mode in ["hardlink", "symlink", "copy"])
+
+  if os.path.lexists(dst_path):
+    return "exists"
+
+  staged_with = link_mode
+
+  try:
+    if link_mode == "hardlink":
+      os.link(src_path, dst_path)
+    elif link_mode == "symlink":
+      os.symlink(os.path.abspath(src_path), dst_path)
+    else:
+      shutil.copy(src_path, dst_path)
+
+  except OSError:
+    staged_with = "copy"
+    shutil.copy(src_path, dst_path)
+
+  if manifest_path is not None:
+    register_staged(manifest_path, pat_id, [dst_path])
+
+  return staged_with
+
+# ----------------------------------
+# ----------------------------------
+
+def _read_manifest(manifest_path):
+
+  record_list = list()
+
+  with open(manifest_path, "r") as fp:
+    for line in fp:
+      try:
+        record_list.append(json.loads(line))
+      except ValueError:
+        continue
+
+  return record_list
+
+# ----------------------------------
+# ----------------------------------
+
+def cleanup_staged(manifest_path, pat_id = None):
+
+  """
+  Remove the files recorded in the staging manifest (only the links/copies - the original
+  files are never touched). The manifest is first swapped with the list of the entries to
+  keep, so an interrupted cleanup never leaves entries that point to half-removed runs:
+  the pending removals are finished by the next call.
+
+  Arguments:
+    manifest_path : required - path to the JSONL staging manifest.
+    pat_id        : optional - only remove the files staged for this patient (or series) ID.
+                               Defaults to None (remove everything).
+
+  Returns:
+    removed_list : list of the paths that were removed.
+  """
+
+  pending_path = manifest_path + ".cleanup"
+
+  with _manifest_lock:
+    to_remove = _read_manifest(pending_path) if os.path.exists(pending_path) else list()
+
+    if os.path.exists(manifest_path):
+      record_list = _read_manifest(manifest_path)
+
+      to_remove += [record for record in record_list if pat_id is None or record["pat_id"] == pat_id]
+      to_keep = [record for record in record_list if not (pat_id is None or record["pat_id"] == pat_id)]
+
+      # write the pending removals first, then swap the manifest (atomic on POSIX)
+      with open(pending_path + ".tmp", "w") as fp:
+        fp.writelines(json.dumps(record) + "\n" for record in to_remove)
+      os.replace(pending_path + ".tmp", pending_path)
+
+      with open(manifest_path + ".tmp", "w") as fp:
+        fp.writelines(json.dumps(record) + "\n" for record in to_keep)
+      os.replace(manifest_path + ".tmp", manifest_path)
+
+    removed_list = list()
+
+    for record in to_remove:
+      if os.path.lexists(record["path"]):
+        os.remove(record["path"])
+        removed_list.append(record["path"])
+
+    if os.path.exists(pending_path):
+      os.remove(pending_path)
+
+  return removed_list
+
+# ----------------------------------
+# ----------------------------------
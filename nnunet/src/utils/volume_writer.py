@@ -0,0 +1,231 @@
+"""
+    ----------------------------------------
+    IDC-MedImA-misc - compressed volume writer utils
+    ----------------------------------------
+
+    ----------------------------------------
+    Author: Dennis Bontempi
+    Email:  dennis_bontempi@dfci.harvard.edu
+    ----------------------------------------
+
+"""
+
+import os
+import zlib
+import struct
+import collections
+
+import SimpleITK as sitk
+
+from concurrent.futures import ThreadPoolExecutor
+
+# gzip compression level (0-9) of every type of output - see `set_compression_level`.
+# The CT volumes and the probability maps get the level SimpleITK uses by default (same
+# size), the label maps compress fast at any level; the intermediate volumes (e.g., the
+# cropped CT staged for the inference) are only read back by the next stage, so they
+# are written favouring speed over size
+_level_dict = {"ct" : 2, "softmax" : 2, "label" : 6, "intermediate" : 1}
+
+# size of the blocks compressed in parallel (deflate window: 32 kB)
+_BLOCK_SIZE = 4*2**20
+_WINDOW_SIZE = 32*2**10
+
+# gzip header: magic, deflate, no flags, no mtime, no extra flags, unknown OS
+_GZIP_HEADER = b"\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff"
+
+
+def set_compression_level(output_type, level):
+
+  """
+  Set the compression level used by `write_volume` for a type of output.
+
+  Arguments:
+    output_type : required - type of output (e.g., "ct", "label", "softmax" or "intermediate").
+    level       : required - gzip compression level, from 0 (no compression - raw encoding for
+                             NRRD files) to 9.
+  """
+
+  assert(0 <= level <= 9)
+
+  _level_dict[output_type] = level
+
+# ----------------------------------
+# ----------------------------------
+
+def get_compression_level(output_type):
+
+  """
+  Compression level used by `write_volume` for a type of output (2 for unknown types).
+  """
+
+  return _level_dict.get(output_type, 2)
+
+# ----------------------------------
+# ----------------------------------
+
+def _deflate_block(block, dictionary, level, is_last):
+
+  """
+  Compress a block as a raw deflate stream ending on a byte boundary (or with the final block,
+  if `is_last`), primed with the last 32 kB of the previous block - so that the compressed blocks
+  can be concatenated in a single deflate stream, like pigz does.
+  """
+
+  if len(dictionary) > 0:
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS, zdict = dictionary)
+  else:
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+
+  return compressor.compress(block) + compressor.flush(zlib.Z_FINISH if is_last else zlib.Z_SYNC_FLUSH)
+
+# ----------------------------------
+# ----------------------------------
+
+def gzip_file(input_fp, output_fp, num_bytes, level = 6, num_threads = None, block_size = _BLOCK_SIZE):
+
+  """
+  Gzip `num_bytes` read from `input_fp` to `output_fp`, compressing blocks of `block_size` bytes
+  in parallel (zlib releases the GIL). The output is a single, standard gzip member.
+
+  Arguments:
+    input_fp    : required - file object to read the data from (from its current position).
+    output_fp   : required - file object to write the compressed data to.
+    num_bytes   : required - number of bytes to compress.
+    level       : optional - gzip compression level (0-9). Defaults to 6.
+    num_threads : optional - number of compression threads. Defaults to None (up to 8, one per CPU).
+    block_size  : optional - size of the blocks compressed in parallel. Defaults to 4 MB.
+  """
+
+  num_threads = num_threads if num_threads is not None else min(8, os.cpu_count() or 1)
+
+  output_fp.write(_GZIP_HEADER)
+
+  crc = 0
+  dictionary = b""
+  num_read = 0
+
+  # the compressed blocks are written in order, keeping a bounded number of blocks in flight
+  future_queue = collections.deque()
+
+  with ThreadPoolExecutor(max_workers = num_threads) as executor:
+    while True:
+      block = input_fp.read(min(block_size, num_bytes - num_read))
+      num_read += len(block)
+
+      is_last = num_read >= num_bytes or len(block) == 0
+      crc = zlib.crc32(block, crc)
+
+      future_queue.append(executor.submit(_deflate_block, block, dictionary, level, is_last))
+      dictionary = block[-_WINDOW_SIZE:]
+
+      while len(future_queue) > 2*num_threads or (is_last and len(future_queue) > 0):
+        output_fp.write(future_queue.popleft().result())
+
+      if is_last:
+        break
+
+  assert(num_read == num_bytes)
+
+  output_fp.write(struct.pack("<II", crc & 0xffffffff, num_bytes & 0xffffffff))
+
+# ----------------------------------
+# ----------------------------------
+
+def _nrrd_header_size(fp):
+
+  """
+  Size of the header of a NRRD file with attached data (up to the first empty line).
+  """
+
+  header_size = 0
+
+  for line in fp:
+    header_size += len(line)
+
+    if line in [b"\n", b"\r\n"]:
+      return header_size
+
+  raise ValueError("Header end not found in the NRRD file.")
+
+# ----------------------------------
+# ----------------------------------
+
+def write_volume(sitk_image, output_path, output_type = "label", level = None, num_threads = None):
+
+  """
+  Write a volume to a compressed NRRD (`.nrrd`) or NIfTI (`.nii.gz`) file, compressing it with
+  several threads - a drop-in replacement for `sitk.WriteImage(..., useCompression = True)`,
+  which compresses single-threaded. The header is written by SimpleITK (to an uncompressed
+  temporary file, next to the output), so the geometry is stored exactly as before. The file
+  is written atomically (a partial output is never left at `output_path`).
+
+  Arguments:
+    sitk_image  : required - SimpleITK image to write.
+    output_path : required - path to the output file (`.nrrd` or `.nii.gz`; any other
+                             extension is written by SimpleITK as it is, like single-threaded
+                             writes).
+    output_type : optional - type of output, selecting the compression level (see
+                             `set_compression_level`). Defaults to "label".
+    level       : optional - gzip compression level (0-9), overriding the one of `output_type`.
+                             Defaults to None.
+    num_threads : optional - number of compression threads. Defaults to None (up to 8, one per CPU).
+
+  Returns:
+    output_path : path to the output file.
+  """
+
+  level = level if level is not None else get_compression_level(output_type)
+  num_threads = num_threads if num_threads is not None else min(8, os.cpu_count() or 1)
+
+  if output_path.endswith(".nrrd"):
+    tmp_suffix = ".nrrd"
+  elif output_path.endswith(".nii.gz"):
+    tmp_suffix = ".nii"
+  else:
+    tmp_suffix = None
+
+  if tmp_suffix is None or num_threads == 1:
+    # nothing to parallelize - the zlib bundled with SimpleITK is at least as fast as Python's
+    sitk.WriteImage(sitk_image, output_path, useCompression = level > 0, compressionLevel = level)
+    return output_path
+
+  # uncompressed volume written by SimpleITK, and compressed output being written
+  tmp_path = output_path + ".tmp" + tmp_suffix
+  part_path = output_path + ".part"
+
+  try:
+    sitk.WriteImage(sitk_image, tmp_path, useCompression = False)
+
+    if tmp_suffix == ".nrrd" and level == 0:
+      # no compression - raw NRRD, as written
+      os.replace(tmp_path, output_path)
+      return output_path
+
+    with open(tmp_path, "rb") as input_fp, open(part_path, "wb") as output_fp:
+      if tmp_suffix == ".nrrd":
+        # attached header (plain text), then the data - only the data is compressed
+        header_size = _nrrd_header_size(input_fp)
+        input_fp.seek(0)
+        header = input_fp.read(header_size)
+
+        assert(b"encoding: raw" in header)
+        output_fp.write(header.replace(b"encoding: raw", b"encoding: gzip"))
+
+      else:
+        # the whole `.nii` file (header and data) is compressed
+        header_size = 0
+
+      gzip_file(input_fp, output_fp, num_bytes = os.path.getsize(tmp_path) - header_size,
+                level = level, num_threads = num_threads)
+
+    os.replace(part_path, output_path)
+
+  finally:
+    for path in [tmp_path, part_path]:
+      if os.path.exists(path):
+        os.remove(path)
+
+  return output_path
+
+# ----------------------------------
+# ----------------------------------